@@ -0,0 +1,220 @@
+# Офлайн-проверка выгрузок чатов и каналов тем же конвейером, что и у бота, без Telegram.
+#   python batch.py messages.jsonl --output verdicts.jsonl --concurrency 8
+#   python batch.py export.csv --output verdicts.jsonl --text-field message --id-field message_id
+#   cat messages.jsonl | python batch.py - --output verdicts.jsonl
+# Результат пишется построчно в JSONL; при повторном запуске уже готовые записи (ok, skipped)
+# пропускаются, записи с ошибкой или неполной экспертизой проверяются заново. Строки, которые не
+# удалось разобрать (JSON, CSV, не UTF-8), записываются один раз со статусом invalid и id вида
+# "line:N" по номеру строки файла, чтение продолжается. --concurrency — общий предел запросов
+# к провайдерам на весь запуск (дублирующие запросы HEDGE_* идут сверх него)
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import sys
+import time
+from typing import Iterator, Optional, Set, Tuple
+
+import major
+
+# Статусы, после которых запись при возобновлении не проверяется заново
+# (invalid — чтобы испорченная строка не дописывалась в результат при каждом запуске)
+DONE_STATUSES = ("ok", "skipped", "invalid")
+
+
+def message_text(value) -> str:
+    # В выгрузке Telegram Desktop текст бывает списком строк и фрагментов с разметкой
+    if isinstance(value, list):
+        return "".join(part if isinstance(part, str) else str(part.get("text", "")) for part in value)
+    return "" if value is None else str(value)
+
+
+class SourceLines:
+    # Строки файла в байтах декодируются по одной: строка не в UTF-8 портит только себя,
+    # следующий вызов читает дальше. number — номер последней прочитанной строки файла
+    def __init__(self, handle):
+        self.handle = handle
+        self.number = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        line = self.handle.readline()
+        if not line:
+            raise StopIteration
+        self.number += 1
+        return line.decode("utf-8")
+
+
+def read_records(path: str, fmt: str, text_field: str, id_field: str) -> Iterator[Tuple[str, Optional[str], str]]:
+    # Записи (id, текст, ошибка): испорченная строка не останавливает чтение, а становится записью invalid.
+    # Без поля id запись получает номер своей строки, испорченная — "line:N", чтобы не совпасть с настоящими id
+    handle = sys.stdin.buffer if path == "-" else open(path, "rb")
+    lines = SourceLines(handle)
+    rows = csv.DictReader(lines) if fmt == "csv" else lines
+    try:
+        while True:
+            try:
+                row = next(rows)
+                if fmt != "csv":
+                    if not row.strip():
+                        continue
+                    row = json.loads(row)
+                if not isinstance(row, dict):
+                    raise ValueError(f"ожидался объект, получен {type(row).__name__}")
+                record_id = row.get(id_field)
+                text = message_text(row.get(text_field))
+            except StopIteration:
+                return
+            # UnicodeDecodeError и JSONDecodeError — подклассы ValueError
+            except (ValueError, AttributeError, csv.Error) as e:
+                yield f"line:{lines.number}", None, str(e)
+                continue
+            yield str(lines.number if record_id in (None, "") else record_id), text, ""
+    finally:
+        if handle is not sys.stdin.buffer:
+            handle.close()
+
+
+def load_done(path: str) -> Set[str]:
+    # Запись с ошибкой не отменяет готовую запись с тем же id: повторный анализ не нужен
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Оборванная последняя строка прерванного запуска
+                continue
+            if record.get("status") in DONE_STATUSES:
+                done.add(str(record.get("id")))
+    return done
+
+
+async def analyze_record(record_id: str, text: str, config: major.ConfigSnapshot, min_length: int,
+                         llm_slots: asyncio.Semaphore) -> dict:
+    text = text.strip()
+    if len(text) <= min_length:
+        return {"id": record_id, "status": "skipped", "reason": "short"}
+    windows = major.split_text_windows(text)
+    if len(windows) > major.MAX_WINDOWS_PER_JOB:
+        return {"id": record_id, "status": "skipped", "reason": "too_long"}
+    major.bind_log_context(job_id=record_id)
+    major.job_deadline.set(time.monotonic() + major.JOB_DEADLINE)
+    started_at = time.monotonic()
+    article_results, unchecked, total_units = await major.analyze_windows(
+        windows, config.prompt_template, config.articles, semaphore=llm_slots
+    )
+    found = [
+        number for number in config.articles
+        if number in article_results and "Applicability: Yes" in article_results[number]
+    ]
+    return {
+        "id": record_id,
+        "status": "partial" if unchecked else "ok",
+        "articles": found,
+        "report": major.clean_report("\n".join(article_results[number] for number in found)) if found else "",
+        "unchecked": unchecked,
+        "units": total_units,
+        "seconds": round(time.monotonic() - started_at, 2),
+    }
+
+
+async def run_batch(args) -> dict:
+    config = major.get_config()
+    if config is None:
+        raise SystemExit(major.config_error)
+    done = load_done(args.output)
+    fmt = args.format or ("csv" if args.input.lower().endswith(".csv") else "jsonl")
+    records = read_records(args.input, fmt, args.text_field, args.id_field)
+    queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, args.concurrency) * 2)
+    # Общий предел запросов к провайдерам на все сообщения, а не на каждое
+    llm_slots = asyncio.Semaphore(max(1, args.concurrency))
+    counts = {"ok": 0, "partial": 0, "skipped": 0, "error": 0, "invalid": 0, "resumed": 0, "found": 0}
+    loop = asyncio.get_running_loop()
+
+    async def producer():
+        # Чтение в потоке: вход может быть медленным потоком (stdin), цикл событий не блокируется
+        while True:
+            record = await loop.run_in_executor(None, next, records, None)
+            if record is None:
+                break
+            if record[0] in done:
+                counts["resumed"] += 1
+                continue
+            if record[1] is None:
+                logging.error("Этап: Запись %s не разобрана: %s", record[0], record[2])
+                write_result({"id": record[0], "status": "invalid", "error": record[2]})
+                continue
+            await queue.put(record[:2])
+        for _ in range(max(1, args.concurrency)):
+            await queue.put(None)
+
+    with open(args.output, "a", encoding="utf-8") as output:
+        def write_result(result: dict):
+            counts[result["status"]] += 1
+            counts["found"] += bool(result.get("articles"))
+            # Запись сразу на диск: прерванный запуск продолжится с этого места
+            output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            output.flush()
+
+        async def worker():
+            while True:
+                record = await queue.get()
+                if record is None:
+                    return
+                record_id, text = record
+                try:
+                    result = await analyze_record(record_id, text, config, args.min_length, llm_slots)
+                except Exception as e:
+                    logging.error("Этап: Ошибка анализа записи %s: %s", record_id, e)
+                    result = {"id": record_id, "status": "error", "error": str(e)}
+                write_result(result)
+
+        started_at = time.monotonic()
+        await asyncio.gather(producer(), *(worker() for _ in range(max(1, args.concurrency))))
+        elapsed = time.monotonic() - started_at
+    major.save_provider_stats()
+    analyzed = counts["ok"] + counts["partial"] + counts["error"]
+    return {
+        **counts,
+        "analyzed": analyzed,
+        "elapsed_seconds": elapsed,
+        "messages_per_minute": analyzed / elapsed * 60 if elapsed > 0 else 0.0,
+        "provider_calls": int(sum(major.PROVIDER_OUTCOMES.values.values())),
+    }
+
+
+def print_summary(summary: dict):
+    print("Итоги проверки:")
+    for key in ("analyzed", "ok", "partial", "error", "invalid", "skipped", "resumed", "found",
+                "elapsed_seconds", "messages_per_minute", "provider_calls"):
+        value = summary[key]
+        print(f"  {key}: {value:.2f}" if isinstance(value, float) else f"  {key}: {value}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Офлайн-проверка выгрузки сообщений конвейером бота")
+    parser.add_argument("input", help="файл JSONL или CSV, «-» — читать JSONL/CSV из stdin")
+    parser.add_argument("--output", required=True, help="JSONL с результатами, он же контрольная точка")
+    parser.add_argument("--format", choices=("jsonl", "csv"), help="формат входа (по умолчанию по расширению)")
+    parser.add_argument("--text-field", default="text", help="поле с текстом сообщения")
+    parser.add_argument("--id-field", default="id", help="поле с идентификатором (нет — номер строки)")
+    parser.add_argument("--concurrency", type=int, default=4, help="запросов к провайдерам одновременно на весь запуск")
+    parser.add_argument("--min-length", type=int, default=50, help="более короткие сообщения пропускаются, как в боте")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    summary = asyncio.run(run_batch(args))
+    print_summary(summary)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+# Офлайн-бенчмарк бота: фальшивые провайдеры g4f, локальная замена Telegram Bot API и генератор нагрузки.
+#   python bench.py --users 20 --messages-per-user 3 --latency-mean 4 --timeout-rate 0.05 --output bench.json
+#   python bench.py --users 20 --baseline bench.json
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import random
+import tempfile
+import time
+from typing import Dict, Optional, Tuple
+
+from aiohttp import web
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+import major
+
+BENCH_TOKEN = "123456:BENCH-TOKEN"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Major", "username": "major_bench_bot"}
+
+SAMPLE_TEXTS = [
+    "Сегодня отличная погода, пошли гулять в парк с собакой, а потом купим мороженое и сходим в кино.",
+    "Все менты продажные, а судья берёт взятки, долой эту власть, пора выходить на улицы и что-то менять.",
+    "Наши доблестные войска снова освобождают очередной город, а по телевизору рассказывают совсем другое.",
+    "Вчера в храме батюшка опять освящал машины за деньги, по-моему это уже полный цирк и кощунство.",
+    "Подскажите, пожалуйста, хороший рецепт борща, чтобы был насыщенный и красный, как у бабушки в деревне.",
+    "Соседи снова устроили ремонт в шесть утра, терпеть это больше невозможно, напишу жалобу в управляющую компанию.",
+]
+
+# Ответы, после которых обработка сообщения считается завершённой
+TERMINAL_TEXTS = (
+    "Состава преступления не обнаружено",
+    "Извините, мы не принимаем",
+    "Ошибка",
+)
+
+
+class FakeResponse:
+    def __init__(self, content: str):
+        message = type("FakeMessage", (), {"content": content})()
+        self.choices = [type("FakeChoice", (), {"message": message})()]
+
+
+# Подменяет request_completion: задержка, ошибки, таймауты, отказы и ответы без кириллицы по заданным долям
+class FakeProviders:
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.calls = 0
+        self.outcomes: Dict[str, int] = {}
+        config = major.get_config()
+        self.denials = list(config.denials) if config and config.denials else ["Извини, я не могу с этим помочь."]
+        # У каждого провайдера свой множитель скорости, чтобы маршрутизатору было из чего выбирать
+        self.speed = {
+            f"Fake{i}": self.random.lognormvariate(0, args.provider_spread) for i in range(args.providers)
+        }
+
+    def install(self):
+        major.PROVIDER_MODELS.clear()
+        major.PROVIDER_MODELS.update({name: ["fake-model"] for name in self.speed})
+        major.provider_stats.clear()
+        major.model_stats.clear()
+        major.request_completion = self.request_completion
+
+    def _count(self, outcome: str):
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def _latency(self, provider_name: str) -> float:
+        mean = self.args.latency_mean * self.speed.get(provider_name, 1.0)
+        sigma = self.args.latency_sigma
+        # Логнормальное распределение с заданным средним
+        return self.random.lognormvariate(math.log(max(mean, 1e-3)) - sigma ** 2 / 2, sigma)
+
+    def _answer(self, prompt: str) -> str:
+        if "следователь" in prompt:
+            return "Добрый день! Вам придётся с нами побеседовать. Мы всё о вас знаем."
+        if "--- Статья" in prompt:
+            numbers = [line.split()[2] for line in prompt.splitlines() if line.startswith("--- Статья")]
+            # Часть моделей выделяет вердикт жирным — разбор пакетного ответа должен это пережить
+            return "\n".join(
+                f"=== Article {number} ===\n{self._verdict(bold=i % 2 == 1)}" for i, number in enumerate(numbers)
+            )
+        return self._verdict()
+
+    def _verdict(self, bold: bool = False) -> str:
+        applicable = "Yes" if self.random.random() < self.args.yes_rate else "No"
+        verdict = f"**Applicability: {applicable}**" if bold else f"Applicability: {applicable}"
+        return (
+            f"{verdict}\n"
+            "Justification: фрагмент текста проанализирован\n"
+            "Maximum Punishment: лишение свободы на срок до пяти лет\n"
+            "Annotation: Presumed term 5 лет"
+        )
+
+    async def request_completion(self, client, async_client, provider_name, model, prompt, timeout=None,
+                                 early_stop=False):
+        timeout = self.args.call_timeout if timeout is None else min(timeout, self.args.call_timeout)
+        self.calls += 1
+        roll = self.random.random()
+        args = self.args
+        if roll < args.timeout_rate:
+            self._count("timeout")
+            await asyncio.sleep(timeout)
+            raise asyncio.TimeoutError()
+        roll -= args.timeout_rate
+        latency = self._latency(provider_name)
+        if latency > timeout:
+            self._count("timeout")
+            await asyncio.sleep(timeout)
+            raise asyncio.TimeoutError()
+        if roll < args.error_rate:
+            await asyncio.sleep(latency)
+            self._count("error")
+            raise RuntimeError("fake provider error")
+        roll -= args.error_rate
+        if roll < args.denial_rate:
+            outcome, content = "denial", self.random.choice(self.denials)
+        elif roll - args.denial_rate < args.latin_rate:
+            outcome, content = "latin", "I am sorry, but I cannot help with that request."
+        else:
+            outcome, content = "valid", self._answer(prompt)
+        self._count(outcome)
+        if early_stop:
+            # Потоковый ответ: отказ и вердикт "No" видны в начале, дальше бот прерывает поток
+            verdict = major.early_verdict(content)
+            if verdict is not None:
+                self._count("early_stop")
+                await asyncio.sleep(latency * args.stream_verdict_share)
+                return major.StreamedCompletion(
+                    content=content if verdict == "denial" else content.split("\n", 1)[0] + "\n", verdict=verdict
+                )
+            await asyncio.sleep(latency)
+            return major.StreamedCompletion(content=content)
+        await asyncio.sleep(latency)
+        return FakeResponse(content)
+
+
+# Минимальная замена Bot API: getUpdates с долгим опросом и ответы на исходящие методы
+class FakeTelegram:
+    def __init__(self):
+        self.updates = []
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1000)
+        self.new_update = asyncio.Event()
+        self.messages: Dict[Tuple[int, int], dict] = {}
+        self.pending: Dict[Tuple[int, int], asyncio.Future] = {}
+        self.api_calls: Dict[str, int] = {}
+        self.runner: Optional[web.AppRunner] = None
+        self.url = ""
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        app = web.Application()
+        app.router.add_route("POST", "/bot{token}/{method}", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        bound_port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{bound_port}"
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    def inject(self, user_id: int, chat_id: int, text: str) -> asyncio.Future:
+        message = {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group", "title": "bench"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": text,
+        }
+        key = (chat_id, message["message_id"])
+        self.messages[key] = message
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = future
+        self.updates.append({"update_id": next(self.update_ids), "message": message})
+        self.new_update.set()
+        return future
+
+    def _resolve(self, chat_id: int, reply_to: Optional[int], outcome: str):
+        future = self.pending.pop((chat_id, reply_to), None)
+        if future is not None and not future.done():
+            future.set_result(outcome)
+
+    @staticmethod
+    def _reply_to(data) -> Optional[int]:
+        if data.get("reply_to_message_id"):
+            return int(data["reply_to_message_id"])
+        if data.get("reply_parameters"):
+            return int(json.loads(data["reply_parameters"])["message_id"])
+        return None
+
+    def _sent(self, chat_id: int, reply_to: Optional[int], **content) -> dict:
+        message = {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group", "title": "bench"},
+            "from": BOT_USER,
+            **content,
+        }
+        if reply_to is not None and (chat_id, reply_to) in self.messages:
+            message["reply_to_message"] = self.messages[(chat_id, reply_to)]
+        self.messages[(chat_id, message["message_id"])] = message
+        return message
+
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"]
+        self.api_calls[method] = self.api_calls.get(method, 0) + 1
+        data = await request.post()
+        if method == "getMe":
+            result = BOT_USER
+        elif method == "getUpdates":
+            result = await self._get_updates(data)
+        elif method in ("sendMessage", "sendDocument", "sendPhoto"):
+            chat_id = int(data["chat_id"])
+            reply_to = self._reply_to(data)
+            text = data.get("text") or data.get("caption") or ""
+            result = self._sent(chat_id, reply_to, text=text)
+            if method == "sendDocument":
+                self._resolve(chat_id, reply_to, "report")
+            elif any(text.startswith(marker) for marker in TERMINAL_TEXTS):
+                self._resolve(chat_id, reply_to, "error" if text.startswith("Ошибка") else "no_findings")
+        elif method == "editMessageText":
+            chat_id = int(data["chat_id"])
+            result = self.messages.get((chat_id, int(data["message_id"])), True)
+            if isinstance(result, dict):
+                result = {**result, "text": data.get("text", "")}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def _get_updates(self, data):
+        offset = int(data.get("offset", 0) or 0)
+        self.updates = [update for update in self.updates if update["update_id"] >= offset]
+        if not self.updates:
+            self.new_update.clear()
+            try:
+                await asyncio.wait_for(self.new_update.wait(), timeout=float(data.get("timeout", 1) or 1))
+            except asyncio.TimeoutError:
+                pass
+        return list(self.updates)
+
+
+def percentile(values, q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))
+    return ordered[index]
+
+
+async def user_loop(args, telegram: FakeTelegram, user_index: int, rng: random.Random, results: list):
+    user_id = 10_000 + user_index
+    chat_id = -(10_000 + user_index % max(1, args.groups)) if args.groups else user_id
+    for _ in range(args.messages_per_user):
+        started_at = time.monotonic()
+        future = telegram.inject(user_id, chat_id, rng.choice(SAMPLE_TEXTS))
+        try:
+            outcome = await asyncio.wait_for(future, timeout=args.message_timeout)
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+        results.append((outcome, time.monotonic() - started_at))
+
+
+async def run_bench(args) -> dict:
+    major.VERDICT_CACHE_ENABLED = args.cache
+    # Статистика, кэш и хранилище заданий — во временном каталоге: фальшивые задания не должны попасть
+    # в настоящий jobs.sqlite3, иначе бот потом восстановит их и ответит в реальные чаты
+    work_dir = tempfile.mkdtemp(prefix="major-bench-")
+    major.PROVIDER_STATS_FILE = os.path.join(work_dir, "provider_stats.json")
+    major.JOB_STORE_FILE = os.path.join(work_dir, "jobs.sqlite3")
+    # Кэш с фальшивыми вердиктами и file_id фальшивого Telegram бот потом отдал бы настоящим пользователям
+    major.VERDICT_CACHE_FILE = os.path.join(work_dir, "verdict_cache.sqlite3")
+    major.ASSET_FILE_IDS_FILE = os.path.join(work_dir, "file_ids.json")
+    major.asset_file_ids.clear()
+    providers = FakeProviders(args)
+    providers.install()
+
+    telegram = FakeTelegram()
+    await telegram.start()
+    bot = Bot(token=BENCH_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(telegram.url)))
+    dp = major.build_dispatcher(bot)
+    polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, polling_timeout=1))
+
+    rng = random.Random(args.seed)
+    results = []
+    started_at = time.monotonic()
+    try:
+        await asyncio.gather(*(
+            user_loop(args, telegram, i, random.Random(rng.random()), results) for i in range(args.users)
+        ))
+    finally:
+        elapsed = time.monotonic() - started_at
+        await dp.stop_polling()
+        await asyncio.gather(polling, return_exceptions=True)
+        await bot.session.close()
+        await telegram.stop()
+
+    latencies = [latency for outcome, latency in results if outcome != "timeout"]
+    outcomes: Dict[str, int] = {}
+    for outcome, _ in results:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    return {
+        "messages": len(results),
+        "completed": len(latencies),
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_per_minute": round(len(latencies) / elapsed * 60, 3) if elapsed else 0.0,
+        "latency_p50": percentile(latencies, 0.50),
+        "latency_p95": percentile(latencies, 0.95),
+        "latency_p99": percentile(latencies, 0.99),
+        "provider_calls": providers.calls,
+        "provider_calls_per_message": round(providers.calls / len(results), 3) if results else 0.0,
+        "provider_outcomes": providers.outcomes,
+        "message_outcomes": outcomes,
+        "telegram_calls": telegram.api_calls,
+    }
+
+
+def print_report(report: dict, baseline: Optional[dict]):
+    def fmt(value):
+        return "—" if value is None else (f"{value:.2f}" if isinstance(value, float) else str(value))
+
+    print("Результаты бенчмарка:")
+    for key in ("messages", "completed", "elapsed_seconds", "throughput_per_minute",
+                "latency_p50", "latency_p95", "latency_p99", "provider_calls_per_message"):
+        line = f"  {key}: {fmt(report[key])}"
+        if baseline and isinstance(report[key], (int, float)) and isinstance(baseline.get(key), (int, float)):
+            line += f" (база {fmt(baseline[key])}, разница {report[key] - baseline[key]:+.2f})"
+        print(line)
+    print(f"  provider_outcomes: {report['provider_outcomes']}")
+    print(f"  message_outcomes: {report['message_outcomes']}")
+    print(f"  telegram_calls: {report['telegram_calls']}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк бота с фальшивыми провайдерами и Telegram")
+    parser.add_argument("--users", type=int, default=10, help="число одновременных пользователей")
+    parser.add_argument("--messages-per-user", type=int, default=2, help="сообщений от каждого пользователя подряд")
+    parser.add_argument("--groups", type=int, default=0, help="разместить пользователей в N группах (0 — личные чаты)")
+    parser.add_argument("--providers", type=int, default=8, help="число фальшивых провайдеров")
+    parser.add_argument("--provider-spread", type=float, default=0.5, help="разброс скорости провайдеров (сигма)")
+    parser.add_argument("--latency-mean", type=float, default=3.0, help="средняя задержка ответа провайдера, с")
+    parser.add_argument("--latency-sigma", type=float, default=0.6, help="сигма логнормальной задержки")
+    parser.add_argument("--call-timeout", type=float, default=60.0, help="таймаут одного запроса, с")
+    parser.add_argument("--timeout-rate", type=float, default=0.02, help="доля зависающих запросов")
+    parser.add_argument("--error-rate", type=float, default=0.05, help="доля запросов с ошибкой")
+    parser.add_argument("--denial-rate", type=float, default=0.05, help="доля ответов-отказов из denials.txt")
+    parser.add_argument("--latin-rate", type=float, default=0.02, help="доля ответов без кириллицы")
+    parser.add_argument("--stream-verdict-share", type=float, default=0.15,
+                        help="доля задержки до вердикта \"No\" или отказа в потоковом ответе (досрочная остановка)")
+    parser.add_argument("--yes-rate", type=float, default=0.2, help="доля вердиктов Applicability: Yes")
+    parser.add_argument("--message-timeout", type=float, default=1800.0, help="сколько ждать обработки сообщения, с")
+    parser.add_argument("--cache", action="store_true", help="не отключать кэш вердиктов")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    parser.add_argument("--baseline", help="сравнить с ранее сохранёнными результатами")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    report = asyncio.run(run_bench(args))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
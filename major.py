@@ -1,37 +1,251 @@
 import asyncio
+import atexit
+import contextvars
+import functools
+import hashlib
 import re
+import sqlite3
+import unicodedata
 import g4f
-from g4f.client import Client
+from g4f.client import AsyncClient, Client
 import json
 import uuid
 import os
 import random
+import socket
+import sys
+import threading
 import time
 import logging
+import multiprocessing
+import queue
 from collections import deque
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
+from dataclasses import asdict, dataclass, field
+from types import MappingProxyType
+from typing import Awaitable, Callable, Dict, List, Mapping, Optional, Pattern, Tuple
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from aiogram import Bot, Dispatcher, F
 from aiogram.filters import Command
-from aiogram.types import Message, FSInputFile
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import Message, FSInputFile, BufferedInputFile
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 
-# Логирование этапа импорта
-logging.basicConfig(level=logging.DEBUG)
+# Логирование: уровень, формат (text или json) и доля отправляемых пошаговых DEBUG-сообщений
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+LOG_STEP_SAMPLE_RATE = float(os.environ.get("LOG_STEP_SAMPLE_RATE", "1.0"))
+LOG_FIELDS = ("job_id", "user_id", "article", "provider", "model")
+
+# Поля контекста (задание, пользователь, статья, провайдер, модель) наследуются задачами asyncio
+log_context: contextvars.ContextVar = contextvars.ContextVar("log_context", default={})
+
+def bind_log_context(**fields):
+    log_context.set({**log_context.get(), **fields})
+
+class LogContextFilter(logging.Filter):
+    def filter(self, record):
+        # Пошаговые DEBUG-сообщения прореживаются ещё до постановки в очередь
+        if record.levelno <= logging.DEBUG and LOG_STEP_SAMPLE_RATE < 1.0 and random.random() >= LOG_STEP_SAMPLE_RATE:
+            return False
+        context = log_context.get()
+        for name in LOG_FIELDS:
+            setattr(record, name, context.get(name))
+        return True
+
+class DeferredQueueHandler(QueueHandler):
+    # В отличие от QueueHandler, не форматирует запись в потоке цикла событий:
+    # сообщение собирается из аргументов уже в потоке QueueListener
+    def prepare(self, record):
+        return record
+
+class TextLogFormatter(logging.Formatter):
+    def format(self, record):
+        line = super().format(record)
+        context = " ".join(f"{name}={getattr(record, name)}" for name in LOG_FIELDS if getattr(record, name, None) is not None)
+        return f"{line} [{context}]" if context else line
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        for name in LOG_FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                data[name] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+def setup_logging():
+    stream_handler = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        stream_handler.setFormatter(JsonLogFormatter())
+    else:
+        stream_handler.setFormatter(TextLogFormatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    listener = QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+setup_logging()
 logging.info("Этап: Импорт всех модулей завершён")
 
 BOT_TOKEN = "ВАШ_ТОКЕН"
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 ARTICLES = ["148", "205.2", "207.3", "230", "280", "280.1", "282", "298.1", "319", "354.1"]
 DENIALS_FILE = os.path.join(BASE_DIR, "denials.txt")
-user_queue = deque()
-user_busy: Dict[int, bool] = {}
+ARTICLES_FILE = os.path.join(BASE_DIR, "articles.json")
+PROMPT_FILE = os.path.join(BASE_DIR, "prompt.txt")
+PROMPT2_FILE = os.path.join(BASE_DIR, "prompt2.txt")
+TRIGGERS_FILE = os.path.join(BASE_DIR, "triggers.json")
+PROMPT_BATCH_FILE = os.path.join(BASE_DIR, "prompt_batch.txt")
+# Предварительный лексический отбор статей: off — выключен, on — статьи ниже порога
+# получают "No" без запроса к провайдеру, audit — считаем оценку, но всё равно спрашиваем модель
+PREFILTER_MODE = os.environ.get("PREFILTER_MODE", "off")
+PREFILTER_THRESHOLD = float(os.environ.get("PREFILTER_THRESHOLD", "1.0"))
+PREFILTER_TRIGGER_WEIGHT = 1.0
+PREFILTER_ARTICLE_WEIGHT = 0.5
+PREFILTER_STEM_LENGTH = 6
+# Режим анализа: per_article — один запрос на статью, batch — несколько статей в одном запросе.
+# ARTICLE_BATCH_SIZE — статей в пакете; ARTICLE_BATCH_LIMITS — JSON {"провайдер": макс. статей}
+# для провайдеров с небольшим контекстным окном (по умолчанию лимит равен ARTICLE_BATCH_SIZE).
+# Пакет нарезается под лимит и бюджет контекста провайдера, которого выбирает маршрутизатор
+ANALYSIS_MODE = os.environ.get("ANALYSIS_MODE", "per_article")
+ARTICLE_BATCH_SIZE = int(os.environ.get("ARTICLE_BATCH_SIZE", "5"))
+ARTICLE_BATCH_LIMITS: Dict[str, int] = json.loads(os.environ.get("ARTICLE_BATCH_LIMITS", "{}"))
+# Бюджет контекста: размер промпта оценивается в токенах по числу символов; CONTEXT_BUDGETS — JSON
+# {"провайдер" или "провайдер/модель": макс. токенов промпта}, DEFAULT_CONTEXT_BUDGET — для остальных
+# (0 — без лимита). Промпт, который не помещается, провайдеру не отправляется
+PROMPT_CHARS_PER_TOKEN = float(os.environ.get("PROMPT_CHARS_PER_TOKEN", "3"))
+DEFAULT_CONTEXT_BUDGET = int(os.environ.get("DEFAULT_CONTEXT_BUDGET", "16000"))
+CONTEXT_BUDGETS: Dict[str, int] = json.loads(os.environ.get("CONTEXT_BUDGETS", "{}"))
+# Как часто проверять mtime файлов статей, промптов и отказов для горячей перезагрузки
+CONFIG_RELOAD_INTERVAL = 5
+# Длинные тексты режутся на перекрывающиеся окна по границам предложений: размер окна
+# и перекрытие в символах, предел окон на одно задание и на пользователя за час
+TEXT_WINDOW_SIZE = int(os.environ.get("TEXT_WINDOW_SIZE", "2000"))
+TEXT_WINDOW_OVERLAP = int(os.environ.get("TEXT_WINDOW_OVERLAP", "200"))
+MAX_WINDOWS_PER_JOB = int(os.environ.get("MAX_WINDOWS_PER_JOB", "5"))
+USER_WINDOWS_PER_HOUR = int(os.environ.get("USER_WINDOWS_PER_HOUR", "60"))
+# Сколько статей одного запроса анализируется параллельно (1 = последовательно)
+ARTICLE_CONCURRENCY = int(os.environ.get("ARTICLE_CONCURRENCY", "5"))
+# Таймаут одного запроса к провайдеру и размер пула потоков для синхронных провайдеров
+LLM_CALL_TIMEOUT = 60
+LLM_THREAD_WORKERS = int(os.environ.get("LLM_THREAD_WORKERS", "8"))
+# Бюджет времени задания: общий срок, запас на финальный ответ (prompt2) и запас, после которого
+# зависшее задание снимается воркером. Таймаут попытки — ATTEMPT_TIMEOUT_FACTOR × p95 задержки
+# полных успешных ответов модели (или провайдера) на запросы того же вида (статья, пакет, финальный
+# ответ; ответы, прерванные на вердикте "No", не учитываются), в пределах [MIN_ATTEMPT_TIMEOUT, LLM_CALL_TIMEOUT]
+# и не дольше остатка бюджета
+JOB_DEADLINE = float(os.environ.get("JOB_DEADLINE", "300"))
+PROMPT2_RESERVE = float(os.environ.get("PROMPT2_RESERVE", "60"))
+JOB_DEADLINE_GRACE = float(os.environ.get("JOB_DEADLINE_GRACE", "60"))
+ATTEMPT_TIMEOUT_FACTOR = float(os.environ.get("ATTEMPT_TIMEOUT_FACTOR", "2"))
+MIN_ATTEMPT_TIMEOUT = float(os.environ.get("MIN_ATTEMPT_TIMEOUT", "10"))
+ATTEMPT_TIMEOUT_MIN_SAMPLES = 5
+# Потоковое чтение ответов по одной статье: вердикт "No" и отказ распознаются по ходу ответа,
+# и запрос прерывается, не дожидаясь обоснования (только для асинхронных провайдеров)
+STREAM_EARLY_STOP = os.environ.get("STREAM_EARLY_STOP", "1") == "1"
+# Дублирующие (hedged) запросы: задержка перед дублем, сколько запускать сразу,
+# предел одновременных запросов на один вызов и на весь бот (1 = без дублей)
+HEDGE_DELAY = float(os.environ.get("HEDGE_DELAY", "15"))
+HEDGE_TOP_K = int(os.environ.get("HEDGE_TOP_K", "1"))
+HEDGE_MAX_PER_REQUEST = int(os.environ.get("HEDGE_MAX_PER_REQUEST", "2"))
+HEDGE_GLOBAL_MAX = int(os.environ.get("HEDGE_GLOBAL_MAX", "8"))
+# Лимиты Telegram на исходящие сообщения: общий, для личного чата и для группы (сообщений в секунду),
+# и минимальный интервал между правками одного сообщения с прогрессом
+TELEGRAM_GLOBAL_RATE = 25
+TELEGRAM_PRIVATE_CHAT_RATE = 1
+TELEGRAM_GROUP_CHAT_RATE = 20 / 60
+TELEGRAM_CHAT_BURST = 5
+TELEGRAM_MAX_RETRIES = 3
+PROGRESS_EDIT_INTERVAL = 1.5
+# Необязательный архив отчётов на диске: каталог (пусто — не сохранять), предел числа файлов и возраста
+REPORT_SPOOL_DIR = os.environ.get("REPORT_SPOOL_DIR", "")
+REPORT_SPOOL_MAX_FILES = int(os.environ.get("REPORT_SPOOL_MAX_FILES", "500"))
+REPORT_SPOOL_MAX_AGE = 7 * 24 * 3600
+# Метрики: администраторы бота для /stats (id через запятую) и адрес HTTP-эндпоинта
+# в формате Prometheus (порт 0 — эндпоинт выключен)
+ADMIN_IDS = {int(x) for x in os.environ.get("ADMIN_IDS", "").split(",") if x.strip()}
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+# Количество воркеров, одновременно обрабатывающих анализы разных пользователей
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+# Допуск в очередь: предел ожидающих заданий всего и в одном чате. Личные чаты и /analyze идут
+# раньше пассивных сообщений из групп; такие сообщения не принимаются, если в очереди уже
+# QUEUE_SHED_DEPTH заданий, и вытесняются из полной очереди ради приоритетных
+QUEUE_MAX_JOBS = int(os.environ.get("QUEUE_MAX_JOBS", "100"))
+QUEUE_MAX_PER_CHAT = int(os.environ.get("QUEUE_MAX_PER_CHAT", "10"))
+QUEUE_SHED_DEPTH = int(os.environ.get("QUEUE_SHED_DEPTH", "30"))
+PRIORITY_HIGH = 0
+PRIORITY_LOW = 1
+# Оценка времени ожидания: число последних заданий для средней длительности и значение, пока их нет
+QUEUE_ETA_SAMPLES = 50
+QUEUE_ETA_DEFAULT = 60.0
+# Режим приёма обновлений: polling (один процесс) или webhook (aiohttp-приложение принимает обновления
+# и раздаёт их процессам-воркерам; обновления одного пользователя всегда попадают в один и тот же процесс)
+RUN_MODE = os.environ.get("RUN_MODE", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", str(os.cpu_count() or 2)))
+WEBHOOK_DRAIN_TIMEOUT = float(os.environ.get("WEBHOOK_DRAIN_TIMEOUT", "30"))
+
+# Маршрутизация провайдеров: сглаживание EWMA, порог ошибок подряд для размыкания
+# автомата, начальное и максимальное время размыкания, файл сохранённой статистики
+EWMA_ALPHA = 0.3
+BREAKER_FAILURE_THRESHOLD = 3
+BREAKER_OPEN_SECONDS = 120
+BREAKER_MAX_OPEN_SECONDS = 1800
+PROVIDER_STATS_FILE = os.path.join(BASE_DIR, "provider_stats.json")
+PROVIDER_STATS_SAVE_INTERVAL = 60
+# Статичные файлы (QR-код, бланк) загружаются в Telegram один раз: file_id сохраняется в этом файле
+ASSET_FILE_IDS_FILE = os.path.join(BASE_DIR, "file_ids.json")
+
+# Кэш вердиктов: файл базы, время жизни записи и максимальное число записей (LRU)
+VERDICT_CACHE_ENABLED = os.environ.get("VERDICT_CACHE_ENABLED", "1") == "1"
+VERDICT_CACHE_FILE = os.path.join(BASE_DIR, "verdict_cache.sqlite3")
+VERDICT_CACHE_TTL = 7 * 24 * 3600
+VERDICT_CACHE_MAX_ENTRIES = 5000
+# Время последнего использования (для LRU) обновляется не чаще раза в этот интервал
+VERDICT_CACHE_TOUCH_INTERVAL = 3600
+# Кэш читается в цикле событий: занятый другим процессом файл ждём не дольше этого и работаем без кэша
+VERDICT_CACHE_BUSY_TIMEOUT = float(os.environ.get("VERDICT_CACHE_BUSY_TIMEOUT", "0.2"))
 
-provider_failures = {}
+# Постоянная очередь заданий: SQLite-файл, общий для процессов (и хостов с общим диском).
+# Воркер берёт задание в аренду на JOB_LEASE_SECONDS и продлевает её, пока работает; задания
+# с истёкшей арендой подбираются заново, готовые вердикты по статьям не пересчитываются
+JOB_STORE_ENABLED = os.environ.get("JOB_STORE_ENABLED", "1") == "1"
+JOB_STORE_FILE = os.environ.get("JOB_STORE_FILE", os.path.join(BASE_DIR, "jobs.sqlite3"))
+JOB_LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", "120"))
+JOB_STORE_POLL_INTERVAL = float(os.environ.get("JOB_STORE_POLL_INTERVAL", "5"))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+# Вызовы хранилища идут в цикле событий: при блокировке другим процессом ждём не дольше этого
+# и откладываем запись (завершение задания повторяется опросом хранилища)
+JOB_STORE_BUSY_TIMEOUT = float(os.environ.get("JOB_STORE_BUSY_TIMEOUT", "0.2"))
+# Задания старше этого срока не восстанавливаются (пользователь уже не ждёт), завершённые — удаляются
+JOB_MAX_AGE = float(os.environ.get("JOB_MAX_AGE", "21600"))
+JOB_STORE_WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+# Обработчики, которые можно восстановить из хранилища по имени
+JOB_HANDLER_NAMES = ("analyze_command", "text_message")
+
+hedge_in_flight = 0
 
 # Загрузка провайдеров из файла
 def load_providers(file_path):
-    logging.info(f"Этап: Загрузка провайдеров из файла {file_path}")
+    logging.info("Этап: Загрузка провайдеров из файла %s", file_path)
     provider_models = {}
     try:
         with open(file_path, "r", encoding="utf-8") as f:
@@ -41,270 +255,2297 @@ def load_providers(file_path):
                     continue
                 provider, models = line.split(": ", 1)
                 provider_models[provider] = models.split(",")
-        logging.info(f"Этап: Провайдеры успешно загружены: {provider_models}")
+        logging.info("Этап: Провайдеры успешно загружены: %s", len(provider_models))
         return provider_models
     except FileNotFoundError:
-        logging.error(f"Этап: Файл {file_path} не найден")
+        logging.error("Этап: Файл %s не найден", file_path)
         return {}
     except Exception as e:
-        logging.error(f"Этап: Ошибка при чтении {file_path}: {str(e)}")
+        logging.error("Этап: Ошибка при чтении %s: %s", file_path, e)
         return {}
 
+# Таблица маршрутов: модель с возможностями (контекст, русский язык, потоковый и асинхронный режимы)
+# и задержкой по результатам пробы. Файл ROUTES_FILE пишет команда `python major.py probe-routes`;
+# если его нет, используется providerslist.txt без моделей, заведомо непригодных для текстового промпта
+@dataclass(frozen=True)
+class ModelRoute:
+    provider: str
+    model: str
+    context_tokens: Optional[int] = None
+    russian: bool = True
+    streaming: bool = True
+    async_ok: bool = True
+    latency: Optional[float] = None
+
+ROUTES_FILE = os.environ.get("ROUTES_FILE", os.path.join(BASE_DIR, "routes.json"))
+# Персоны-агенты, генерация и распознавание изображений, речь и эмбеддинги
+MODEL_EXCLUDE = re.compile(
+    r" Agent$|image|vision|flux|dall-?e|sdxl|stable-diffusion|midjourney|whisper|tts|embed|-vl\b|-ocr\b",
+    re.IGNORECASE
+)
+PROBE_PROMPT = "Ответь одним словом по-русски: какого цвета ясное небо днём?"
+PROBE_TIMEOUT = float(os.environ.get("PROBE_TIMEOUT", "30"))
+PROBE_CONCURRENCY = int(os.environ.get("PROBE_CONCURRENCY", "8"))
+MODEL_ROUTES: Dict[str, ModelRoute] = {}
+
+def load_routes(file_path):
+    # Возвращает провайдер -> модели в порядке ранга или None, если файла маршрутов нет
+    if not os.path.exists(file_path):
+        return None
+    logging.info("Этап: Загрузка таблицы маршрутов из %s", file_path)
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            entries = json.load(f)
+        provider_models = {}
+        for entry in entries:
+            route = ModelRoute(**entry)
+            if not route.russian:
+                continue
+            MODEL_ROUTES[f"{route.provider}/{route.model}"] = route
+            provider_models.setdefault(route.provider, []).append(route.model)
+        logging.info("Этап: Маршрутов загружено: %s, провайдеров: %s", len(MODEL_ROUTES), len(provider_models))
+        return provider_models
+    except Exception as e:
+        logging.error("Этап: Ошибка при чтении %s, используется список провайдеров: %s", file_path, e)
+        MODEL_ROUTES.clear()
+        return None
+
+def usable_models(provider_models):
+    pruned = {}
+    for provider, models in provider_models.items():
+        models = [m.strip() for m in models if m.strip() and not MODEL_EXCLUDE.search(m)]
+        if models:
+            pruned[provider] = models
+    return pruned
+
 # Загружаем провайдеры
 PROVIDERS_FILE = os.path.join(BASE_DIR, "providerslist.txt")
-PROVIDER_MODELS = load_providers(PROVIDERS_FILE)
+PROVIDER_MODELS = load_routes(ROUTES_FILE)
+if PROVIDER_MODELS is None:
+    PROVIDER_MODELS = usable_models(load_providers(PROVIDERS_FILE))
+
+# Метрики: гистограммы и счётчики с метками, выводятся в текстовом формате Prometheus
+HISTOGRAM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+
+class Histogram:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.series: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.series.get(key)
+        if series is None:
+            # Счётчики по корзинам, затем сумма и количество
+            series = self.series[key] = [0] * len(HISTOGRAM_BUCKETS) + [0.0, 0]
+        for i, bound in enumerate(HISTOGRAM_BUCKETS):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, series in self.series.items():
+            for i, bound in enumerate(HISTOGRAM_BUCKETS):
+                lines.append(f"{self.name}_bucket{format_labels(key + (('le', str(bound)),))} {series[i]}")
+            lines.append(f"{self.name}_bucket{format_labels(key + (('le', '+Inf'),))} {series[-1]}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {series[-2]:.6f}")
+            lines.append(f"{self.name}_count{format_labels(key)} {series[-1]}")
+        return lines
+
+    def quantile(self, q: float, **labels) -> Optional[float]:
+        # Оценка квантиля по корзинам с линейной интерполяцией; без меток — по всем сериям
+        selected = [series for key, series in self.series.items() if all(item in key for item in labels.items())]
+        total = sum(series[-1] for series in selected)
+        if not total:
+            return None
+        rank = q * total
+        lower, previous = 0.0, 0
+        for i, bound in enumerate(HISTOGRAM_BUCKETS):
+            count = sum(series[i] for series in selected)
+            if count >= rank:
+                fraction = (rank - previous) / (count - previous) if count > previous else 1.0
+                return lower + (bound - lower) * fraction
+            lower, previous = bound, count
+        return float(HISTOGRAM_BUCKETS[-1])
+
+    def totals(self, **labels) -> Tuple[int, float]:
+        selected = [series for key, series in self.series.items() if all(item in key for item in labels.items())]
+        return sum(series[-1] for series in selected), sum(series[-2] for series in selected)
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{format_labels(key)} {value:g}" for key, value in self.values.items())
+        return lines
+
+    def total(self, **labels) -> float:
+        return sum(v for key, v in self.values.items() if all(item in key for item in labels.items()))
+
+def format_labels(key) -> str:
+    if not key:
+        return ""
+    escaped = (f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for name, value in key)
+    return "{" + ",".join(escaped) + "}"
+
+QUEUE_WAIT = Histogram("major_queue_wait_seconds", "Время ожидания задания в очереди")
+JOB_DURATION = Histogram("major_job_duration_seconds", "Время выполнения задания от постановки в очередь до завершения")
+ARTICLE_LATENCY = Histogram("major_article_llm_seconds", "Время анализа одной статьи моделью")
+PROMPT2_LATENCY = Histogram("major_prompt2_seconds", "Время финальной обработки отчёта (prompt2)")
+PROVIDER_LATENCY = Histogram("major_provider_call_seconds", "Время запроса к провайдеру по провайдеру, модели и исходу")
+TELEGRAM_LATENCY = Histogram("major_telegram_call_seconds", "Время исходящих вызовов Telegram API")
+PROVIDER_OUTCOMES = Counter("major_provider_outcomes_total", "Исходы запросов к провайдерам (success, denial, timeout, error)")
+BREAKER_OPENS = Counter("major_provider_breaker_open_total", "Сколько раз провайдер или модель исключались автоматом")
+JOBS_TOTAL = Counter("major_jobs_total", "Завершённые задания по исходу")
+PROMPT_TOKENS = Counter("major_prompt_tokens_total", "Оценка токенов в отправленных промптах")
+ATTEMPT_LATENCY = Histogram(
+    "major_attempt_full_seconds", "Время полных успешных ответов по провайдеру, модели и виду запроса (для таймаутов)"
+)
+STREAM_EARLY_STOPS = Counter("major_stream_early_stops_total", "Потоковые ответы, прерванные досрочно (no, denial)")
+SINGLEFLIGHT_JOINS = Counter("major_singleflight_joins_total", "Запросы, присоединённые к уже идущему анализу того же текста")
+METRICS = [QUEUE_WAIT, JOB_DURATION, ARTICLE_LATENCY, PROMPT2_LATENCY, PROVIDER_LATENCY, ATTEMPT_LATENCY, TELEGRAM_LATENCY,
+           PROVIDER_OUTCOMES, BREAKER_OPENS, JOBS_TOTAL, STREAM_EARLY_STOPS, PROMPT_TOKENS, SINGLEFLIGHT_JOINS]
+
+def collected_values():
+    # Величины, которые считываются в момент запроса метрик: (имя, тип, описание, значение)
+    return [
+        ("major_queue_depth", "gauge", "Заданий в очереди", len(user_queue)),
+        ("major_jobs_in_flight", "gauge", "Выполняющихся заданий", len(user_busy)),
+        ("major_hedges_in_flight", "gauge", "Дублирующих запросов в полёте", hedge_in_flight),
+        ("major_cache_hits_total", "counter", "Попадания в кэш вердиктов", cache_counters["hits"]),
+        ("major_cache_misses_total", "counter", "Промахи кэша вердиктов", cache_counters["misses"]),
+        ("major_cache_evictions_total", "counter", "Вытеснения из кэша вердиктов", cache_counters["evictions"]),
+        ("major_prefilter_skipped_total", "counter", "Статьи, отсеянные предотбором", prefilter_counters["skipped"]),
+        ("major_providers_open", "gauge", "Провайдеры с разомкнутым автоматом",
+         sum(1 for stats in provider_stats.values() if stats.state != "closed"))
+    ]
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for name, kind, help_text, value in collected_values():
+        lines.extend((f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"))
+    return "\n".join(lines) + "\n"
+
+def format_seconds(value: Optional[float]) -> str:
+    return "—" if value is None else f"{value:.1f} с"
+
+def stats_summary() -> str:
+    # Краткая сводка для команды /stats
+    lines = ["Статистика бота:"]
+    for title, histogram in (
+        ("Ожидание в очереди", QUEUE_WAIT),
+        ("Задание целиком", JOB_DURATION),
+        ("Статья (LLM)", ARTICLE_LATENCY),
+        ("prompt2", PROMPT2_LATENCY),
+        ("Вызов провайдера", PROVIDER_LATENCY),
+        ("Вызов Telegram", TELEGRAM_LATENCY)
+    ):
+        count, _ = histogram.totals()
+        lines.append(
+            f"{title}: {count} шт., p50 {format_seconds(histogram.quantile(0.5))}, "
+            f"p95 {format_seconds(histogram.quantile(0.95))}"
+        )
+    outcomes = ", ".join(
+        f"{outcome} {PROVIDER_OUTCOMES.total(outcome=outcome):g}" for outcome in ("success", "denial", "timeout", "error")
+    )
+    lines.append(f"Исходы запросов: {outcomes}")
+    lines.append(f"Исключений провайдеров: {BREAKER_OPENS.total(target='provider'):g}, моделей: {BREAKER_OPENS.total(target='model'):g}")
+    for name, _, help_text, value in collected_values():
+        lines.append(f"{help_text}: {value}")
+    return "\n".join(lines)
+
+metrics_runner = None
+
+async def start_metrics_server():
+    global metrics_runner
+    if METRICS_PORT <= 0:
+        return
+    from aiohttp import web
+
+    async def metrics_handler(request):
+        return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    metrics_runner = web.AppRunner(app)
+    await metrics_runner.setup()
+    await web.TCPSite(metrics_runner, METRICS_HOST, METRICS_PORT).start()
+    logging.info("Этап: Метрики доступны на http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+
+async def stop_metrics_server():
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+
+@dataclass
+class TargetStats:
+    latency_ewma: Optional[float] = None
+    attempts: int = 0
+    successes: int = 0
+    denials: int = 0
+    timeouts: int = 0
+    errors: int = 0
+    consecutive_failures: int = 0
+    state: str = "closed"  # closed / open / half_open
+    opened_at: float = 0.0
+    open_seconds: float = BREAKER_OPEN_SECONDS
+    recent_errors: deque = field(default_factory=lambda: deque(maxlen=5))
+    probe_in_flight: bool = False
+    # Лимит промпта в токенах, выученный по ошибкам переполнения контекста
+    context_limit: Optional[int] = None
+    # Для провайдера: модели с ошибками подряд (автомат размыкается, только если их несколько)
+    failing_models: set = field(default_factory=set)
+
+    def to_dict(self):
+        return {
+            "latency_ewma": self.latency_ewma,
+            "attempts": self.attempts,
+            "successes": self.successes,
+            "denials": self.denials,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "consecutive_failures": self.consecutive_failures,
+            "state": self.state,
+            "opened_at": self.opened_at,
+            "open_seconds": self.open_seconds,
+            "recent_errors": list(self.recent_errors),
+            "context_limit": self.context_limit
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls(**{k: v for k, v in data.items() if k not in ("recent_errors", "probe_in_flight")})
+        stats.recent_errors.extend(data.get("recent_errors", []))
+        # Зонд, прерванный перезапуском, снова размыкает автомат
+        if stats.state == "half_open":
+            stats.state = "open"
+        return stats
+
+# Статистика по провайдеру и по паре "провайдер/модель"
+provider_stats: Dict[str, TargetStats] = {}
+model_stats: Dict[str, TargetStats] = {}
+provider_stats_saved_at = 0.0
+# Фоновая запись статистики (не больше одной сразу) и блокировка файла между ней и записью при остановке
+provider_stats_save_future: Optional[asyncio.Future] = None
+provider_stats_lock = threading.Lock()
+# Ключи, изменённые этим процессом после последнего сохранения: при записи они перекрывают данные
+# других процессов-воркеров в общем файле, остальные записи берутся из файла
+provider_stats_dirty: set = set()
+
+def load_provider_stats():
+    logging.info("Этап: Загрузка статистики провайдеров из %s", PROVIDER_STATS_FILE)
+    try:
+        with open(PROVIDER_STATS_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        provider_stats.update({k: TargetStats.from_dict(v) for k, v in data.get("providers", {}).items()})
+        model_stats.update({k: TargetStats.from_dict(v) for k, v in data.get("models", {}).items()})
+        logging.info("Этап: Загружена статистика %s провайдеров и %s моделей", len(provider_stats), len(model_stats))
+    except FileNotFoundError:
+        logging.info("Этап: Сохранённой статистики провайдеров нет, начинаем с нуля")
+    except Exception as e:
+        logging.error("Этап: Ошибка при чтении статистики провайдеров: %s", e)
+
+def read_json_file(path: str) -> dict:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logging.error("Этап: Ошибка при чтении %s: %s", path, e)
+        return {}
+
+def write_json_file(path: str, data: dict):
+    # Временный файл свой у каждого процесса, чтобы воркеры не писали в один и тот же .tmp
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_file, path)
+    except Exception as e:
+        logging.error("Этап: Ошибка при сохранении %s: %s", path, e)
+
+def snapshot_provider_stats() -> dict:
+    # Снимок делается в цикле событий: {раздел: {ключ: (данные, изменён ли этим процессом)}}
+    global provider_stats_saved_at
+    provider_stats_saved_at = time.time()
+    snapshot = {
+        section: {key: (value.to_dict(), (section, key) in provider_stats_dirty) for key, value in stats.items()}
+        for section, stats in (("providers", provider_stats), ("models", model_stats))
+    }
+    provider_stats_dirty.clear()
+    return snapshot
+
+def write_provider_stats(snapshot: dict):
+    # Чтение, слияние и запись файла; из пула потоков и при остановке — по очереди, через блокировку
+    with provider_stats_lock:
+        data = read_json_file(PROVIDER_STATS_FILE)
+        for section, entries in snapshot.items():
+            merged = data.setdefault(section, {})
+            for key, (value, dirty) in entries.items():
+                if dirty or key not in merged:
+                    merged[key] = value
+        write_json_file(PROVIDER_STATS_FILE, data)
+
+def save_provider_stats():
+    write_provider_stats(snapshot_provider_stats())
+
+def schedule_provider_stats_save():
+    # Периодическое сохранение не блокирует цикл событий: файл пишется в пуле потоков
+    global provider_stats_save_future
+    if provider_stats_save_future is not None and not provider_stats_save_future.done():
+        return
+    provider_stats_save_future = asyncio.get_running_loop().run_in_executor(
+        None, write_provider_stats, snapshot_provider_stats()
+    )
+
+def model_key(provider: str, model: str) -> str:
+    return f"{provider}/{model}"
+
+def breaker_allows(stats: TargetStats, now: float) -> bool:
+    if stats.state == "closed":
+        return True
+    if stats.state == "open" and now - stats.opened_at >= stats.open_seconds:
+        stats.state = "half_open"
+    # В полуоткрытом состоянии пропускаем ровно один пробный запрос
+    return stats.state == "half_open" and not stats.probe_in_flight
+
+def expected_time_to_valid(stats: TargetStats) -> float:
+    # Ожидаемое время до валидного ответа: средняя задержка / вероятность валидного ответа
+    latency = stats.latency_ewma if stats.latency_ewma is not None else LLM_CALL_TIMEOUT / 4
+    p_valid = (stats.successes + 1) / (stats.attempts + 2)
+    return latency / p_valid
+
+def weighted_order(items, weight):
+    # Случайная перестановка без возвращения с весами (Efraimidis–Spirakis)
+    return sorted(items, key=lambda item: random.random() ** (1.0 / max(weight(item), 1e-9)), reverse=True)
+
+def _update_target(stats: TargetStats, outcome: str, latency: float, error: Optional[str], now: float,
+                   model: Optional[str] = None):
+    # model передаётся для статистики провайдера: одна плохая модель не исключает весь провайдер
+    stats.attempts += 1
+    if latency is not None:
+        stats.latency_ewma = latency if stats.latency_ewma is None else (
+            EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * stats.latency_ewma
+        )
+    if outcome == "success":
+        stats.successes += 1
+    elif outcome == "denial":
+        stats.denials += 1
+    elif outcome == "timeout":
+        stats.timeouts += 1
+    else:
+        stats.errors += 1
+    if error:
+        stats.recent_errors.append(f"{int(now)}: {error[:200]}")
+
+    was_probe = stats.probe_in_flight
+    stats.probe_in_flight = False
+    if outcome in ("success", "denial"):
+        # Провайдер отвечает — автомат замыкается, отказ модели не считается поломкой
+        stats.consecutive_failures = 0
+        stats.failing_models.clear()
+        if stats.state != "closed":
+            logging.info("Этап: Автомат замкнут после успешного пробного запроса")
+        stats.state = "closed"
+        stats.open_seconds = BREAKER_OPEN_SECONDS
+        return
+    stats.consecutive_failures += 1
+    if model is not None:
+        stats.failing_models.add(model)
+    failures = len(stats.failing_models) if model is not None else stats.consecutive_failures
+    if stats.state == "half_open" or was_probe:
+        stats.open_seconds = min(stats.open_seconds * 2, BREAKER_MAX_OPEN_SECONDS)
+        stats.state = "open"
+        stats.opened_at = now
+    elif failures >= BREAKER_FAILURE_THRESHOLD:
+        stats.state = "open"
+        stats.opened_at = now
+
+def record_outcome(provider: str, model: str, outcome: str, latency: Optional[float] = None, error: Optional[str] = None):
+    now = time.time()
+    p_stats = provider_stats.setdefault(provider, TargetStats())
+    m_stats = model_stats.setdefault(model_key(provider, model), TargetStats())
+    was_open = p_stats.state
+    was_model_open = m_stats.state
+    _update_target(p_stats, outcome, latency, error, now, model=model)
+    _update_target(m_stats, outcome, latency, error, now)
+    provider_stats_dirty.update({("providers", provider), ("models", model_key(provider, model))})
+    PROVIDER_OUTCOMES.inc(outcome=outcome)
+    if latency is not None:
+        PROVIDER_LATENCY.observe(latency, provider=provider, model=model, outcome=outcome)
+    if p_stats.state == "open" and was_open != "open":
+        BREAKER_OPENS.inc(target="provider", provider=provider)
+        logging.info("Этап: Провайдер %s исключён на %.0f с", provider, p_stats.open_seconds)
+    if m_stats.state == "open" and was_model_open != "open":
+        BREAKER_OPENS.inc(target="model", provider=provider)
+        logging.info("Этап: Модель %s/%s исключена на %.0f с", provider, model, m_stats.open_seconds)
+    if now - provider_stats_saved_at > PROVIDER_STATS_SAVE_INTERVAL:
+        schedule_provider_stats_save()
+
+def release_probe(provider: str, model: str):
+    # Отменённый (проигравший) запрос не должен держать пробный слот
+    for stats in (provider_stats.get(provider), model_stats.get(model_key(provider, model))):
+        if stats is not None:
+            stats.probe_in_flight = False
+
+def provider_batch_limit(provider: str) -> int:
+    return max(1, ARTICLE_BATCH_LIMITS.get(provider, ARTICLE_BATCH_SIZE))
+
+CONTEXT_ERROR = re.compile(r"context.{0,20}(?:length|window|limit)|too (?:long|large)|maximum.{0,20}tokens|token limit", re.IGNORECASE)
+
+def estimate_tokens(text: str) -> int:
+    return int(len(text) / PROMPT_CHARS_PER_TOKEN) + 1
+
+def context_budget(provider: str, model: str) -> Optional[int]:
+    configured = CONTEXT_BUDGETS.get(model_key(provider, model), CONTEXT_BUDGETS.get(provider, DEFAULT_CONTEXT_BUDGET))
+    stats = model_stats.get(model_key(provider, model))
+    route = MODEL_ROUTES.get(model_key(provider, model))
+    limits = [
+        limit for limit in (configured, stats.context_limit if stats else None, route.context_tokens if route else None)
+        if limit
+    ]
+    return min(limits) if limits else None
+
+def fits_context(provider: str, model: str, prompt_tokens: int) -> bool:
+    budget = context_budget(provider, model)
+    return budget is None or prompt_tokens <= budget
+
+def model_available(provider: str, model: str, prompt_tokens: int, now: float) -> bool:
+    return fits_context(provider, model, prompt_tokens) and breaker_allows(
+        model_stats.setdefault(model_key(provider, model), TargetStats()), now
+    )
+
+def record_context_overflow(provider: str, model: str, prompt_tokens: int):
+    # Провайдер отверг промпт как слишком длинный: больше такие промпты этой модели не отправляем
+    stats = model_stats.setdefault(model_key(provider, model), TargetStats())
+    limit = max(1, prompt_tokens - 1)
+    if stats.context_limit is None or limit < stats.context_limit:
+        stats.context_limit = limit
+        provider_stats_dirty.add(("models", model_key(provider, model)))
+        logging.info("Этап: Лимит контекста %s/%s снижен до %s токенов", provider, model, limit)
+
+def select_targets(avoid_providers=(), min_batch_size: int = 1, prompt_tokens: int = 0):
+    # Провайдер выбирается с весом 1 / ожидаемое время до валидного ответа
+    now = time.time()
+    active_providers = [
+        p for p in PROVIDER_MODELS
+        if PROVIDER_MODELS[p] and p not in avoid_providers and provider_batch_limit(p) >= min_batch_size
+        and breaker_allows(provider_stats.setdefault(p, TargetStats()), now)
+        and any(model_available(p, m, prompt_tokens, now) for m in PROVIDER_MODELS[p])
+    ]
+    if not active_providers:
+        return None
+    selected_provider = weighted_order(
+        active_providers, lambda p: 1.0 / expected_time_to_valid(provider_stats[p])
+    )[0]
+    models = [m for m in PROVIDER_MODELS[selected_provider] if model_available(selected_provider, m, prompt_tokens, now)]
+    if not models:
+        return None
+    models = weighted_order(
+        models, lambda m: 1.0 / expected_time_to_valid(model_stats[model_key(selected_provider, m)])
+    )
+    return selected_provider, models
+
+def claim_target(provider: str, model: str):
+    # Запрос к полуоткрытому провайдеру/модели становится пробным
+    for stats in (provider_stats[provider], model_stats[model_key(provider, model)]):
+        if stats.state == "half_open":
+            stats.probe_in_flight = True
+
+def seed_route_latency():
+    # Задержка из пробы служит начальной оценкой, пока нет собственной статистики
+    for key, route in MODEL_ROUTES.items():
+        if route.latency is None:
+            continue
+        stats = model_stats.setdefault(key, TargetStats())
+        if stats.latency_ewma is None:
+            stats.latency_ewma = route.latency
+        p_stats = provider_stats.setdefault(route.provider, TargetStats())
+        if p_stats.attempts == 0 and (p_stats.latency_ewma is None or route.latency < p_stats.latency_ewma):
+            p_stats.latency_ewma = route.latency
+
+load_provider_stats()
+seed_route_latency()
+
+# Общие клиенты g4f на весь процесс: создаются при первом запросе и переиспользуются всеми вызовами
+llm_clients: Optional[Tuple[Client, AsyncClient]] = None
+
+def get_llm_clients() -> Tuple[Client, AsyncClient]:
+    global llm_clients
+    if llm_clients is None:
+        logging.info("Этап: Создание общих клиентов g4f")
+        llm_clients = (Client(), AsyncClient())
+    return llm_clients
+
+@dataclass
+class AnalysisJob:
+    handler_func: Callable[[Message, Bot], Awaitable[None]]
+    message: Message
+    bot: Bot
+    user_id: int
+    chat_id: int
+    enqueued_at: float = field(default_factory=time.monotonic)
+    job_id: str = field(default_factory=lambda: uuid.uuid4().hex[:8])
+    task: Optional[asyncio.Task] = None
+    done: Optional[asyncio.Future] = None
+    priority: int = PRIORITY_HIGH
+    # Сообщение с местом в очереди и ожидаемым временем, правится на месте
+    status_message: Optional[Message] = None
+    # Задание записано в хранилище; если запись не удалась, оно выполняется только в памяти
+    stored: bool = True
+
+# Ожидающие задания по пользователям и занятые пользователи (user_id -> задание)
+user_queue: Dict[int, AnalysisJob] = {}
+user_busy: Dict[int, AnalysisJob] = {}
+# Очереди заданий по (приоритету, чату) и порядок обхода чатов внутри приоритета (round-robin)
+chat_jobs: Dict[Tuple[int, int], deque] = {}
+chat_rotation: Dict[int, deque] = {PRIORITY_HIGH: deque(), PRIORITY_LOW: deque()}
+# Длительности выполнения последних заданий для оценки времени ожидания
+recent_job_durations: deque = deque(maxlen=QUEUE_ETA_SAMPLES)
+job_signal: Optional[asyncio.Semaphore] = None
+job_workers: list = []
+# Идентификатор выполняющегося задания, наследуется задачами анализа статей (для контрольных точек)
+current_job_id: contextvars.ContextVar = contextvars.ContextVar("current_job_id", default=None)
+# Срок (time.monotonic) текущего этапа задания, наследуется задачами анализа и запросами к провайдерам
+job_deadline: contextvars.ContextVar = contextvars.ContextVar("job_deadline", default=None)
+
+def remaining_budget() -> Optional[float]:
+    deadline = job_deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+def budget_left() -> bool:
+    remaining = remaining_budget()
+    return remaining is None or remaining > 0
+job_store_db: Optional[sqlite3.Connection] = None
+job_store_poller_task: Optional[asyncio.Task] = None
+# Завершения заданий, не записанные из-за блокировки: job_id -> (состояние, время)
+job_store_pending_finish: Dict[str, Tuple[str, float]] = {}
+
+def get_job_store() -> Optional[sqlite3.Connection]:
+    global job_store_db
+    if not JOB_STORE_ENABLED:
+        return None
+    if job_store_db is None:
+        logging.info("Этап: Открытие хранилища заданий %s", JOB_STORE_FILE)
+        try:
+            db = sqlite3.connect(JOB_STORE_FILE, timeout=JOB_STORE_BUSY_TIMEOUT)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "job_id TEXT PRIMARY KEY, user_id INTEGER NOT NULL, chat_id INTEGER NOT NULL, "
+                "message_id INTEGER NOT NULL, handler TEXT NOT NULL, message TEXT NOT NULL, state TEXT NOT NULL, "
+                "worker TEXT, lease_until REAL NOT NULL DEFAULT 0, attempts INTEGER NOT NULL DEFAULT 0, "
+                "created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created_at)")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints ("
+                "job_id TEXT NOT NULL, article TEXT NOT NULL, result TEXT NOT NULL, PRIMARY KEY (job_id, article))"
+            )
+            db.commit()
+            job_store_db = db
+        except Exception as e:
+            logging.error("Этап: Хранилище заданий недоступно: %s", e)
+            return None
+    return job_store_db
+
+def job_store_add(job: "AnalysisJob") -> bool:
+    db = get_job_store()
+    if db is None:
+        return False
+    now = time.time()
+    try:
+        db.execute(
+            "INSERT OR IGNORE INTO jobs (job_id, user_id, chat_id, message_id, handler, message, state, worker, "
+            "lease_until, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?, ?, ?)",
+            (job.job_id, job.user_id, job.chat_id, job.message.message_id, job.handler_func.__name__,
+             job.message.model_dump_json(exclude_none=True), JOB_STORE_WORKER_ID, now + JOB_LEASE_SECONDS, now, now)
+        )
+        db.commit()
+        return True
+    except Exception as e:
+        logging.error("Этап: Не удалось сохранить задание %s: %s", job.job_id, e)
+        db.rollback()
+        return False
+
+def job_store_claim(job: "AnalysisJob") -> bool:
+    # Аренда выдаётся одному воркеру, и только если у пользователя нет другого выполняющегося задания.
+    # Задание, которое не удалось записать в хранилище, выполняется только в памяти
+    db = get_job_store()
+    if db is None or not job.stored:
+        return True
+    now = time.time()
+    try:
+        cursor = db.execute(
+            "UPDATE jobs SET state = 'running', worker = ?, lease_until = ?, attempts = attempts + 1, updated_at = ? "
+            "WHERE job_id = ? AND attempts < ? AND ((state = 'queued' AND (worker = ? OR lease_until < ?)) "
+            "OR (state = 'running' AND lease_until < ?)) "
+            "AND NOT EXISTS (SELECT 1 FROM jobs AS other WHERE other.user_id = jobs.user_id "
+            "AND other.job_id != jobs.job_id AND other.state = 'running' AND other.lease_until >= ?)",
+            (JOB_STORE_WORKER_ID, now + JOB_LEASE_SECONDS, now, job.job_id, JOB_MAX_ATTEMPTS,
+             JOB_STORE_WORKER_ID, now, now, now)
+        )
+        if cursor.rowcount == 1:
+            db.commit()
+            return True
+        row = db.execute("SELECT state, worker FROM jobs WHERE job_id = ?", (job.job_id,)).fetchone()
+        if row is None:
+            # Строки нет — задание не теряем, выполняем его в памяти
+            db.commit()
+            return True
+        if row == ("queued", JOB_STORE_WORKER_ID):
+            # Задание наше, но взять его нельзя (у пользователя выполняется другое или попытки исчерпаны):
+            # закрываем строку, иначе её аренда продлевалась бы, а после перезапуска задание восстановилось бы
+            db.execute(
+                "UPDATE jobs SET state = 'superseded', worker = NULL, lease_until = 0, updated_at = ? "
+                "WHERE job_id = ? AND worker = ? AND state = 'queued'",
+                (now, job.job_id, JOB_STORE_WORKER_ID)
+            )
+            db.execute("DELETE FROM checkpoints WHERE job_id = ?", (job.job_id,))
+        db.commit()
+        return False
+    except sqlite3.Error as e:
+        # Без хранилища продолжаем как обычная очередь в памяти
+        logging.error("Этап: Не удалось взять задание %s в аренду: %s", job.job_id, e)
+        db.rollback()
+        return True
+
+def job_store_renew(job: "AnalysisJob") -> bool:
+    db = get_job_store()
+    if db is None:
+        return True
+    now = time.time()
+    try:
+        cursor = db.execute(
+            "UPDATE jobs SET lease_until = ?, updated_at = ? WHERE job_id = ? AND worker = ? AND state = 'running'",
+            (now + JOB_LEASE_SECONDS, now, job.job_id, JOB_STORE_WORKER_ID)
+        )
+        db.commit()
+        return cursor.rowcount == 1
+    except sqlite3.Error as e:
+        logging.error("Этап: Не удалось продлить аренду задания %s: %s", job.job_id, e)
+        db.rollback()
+        return True
+
+def job_store_finish(job: "AnalysisJob", state: str):
+    # state: done / failed / cancelled / shed; задание в аренде у другого воркера не трогаем
+    _job_store_finish(job.job_id, state, time.time())
+
+def _job_store_finish(job_id: str, state: str, finished_at: float) -> bool:
+    db = get_job_store()
+    if db is None:
+        return True
+    try:
+        db.execute(
+            "UPDATE jobs SET state = ?, lease_until = 0, updated_at = ? "
+            "WHERE job_id = ? AND (worker = ? OR state = 'queued')",
+            (state, finished_at, job_id, JOB_STORE_WORKER_ID)
+        )
+        db.execute("DELETE FROM checkpoints WHERE job_id = ?", (job_id,))
+        db.commit()
+        job_store_pending_finish.pop(job_id, None)
+        return True
+    except sqlite3.Error as e:
+        # Иначе задание останется "running" и после истечения аренды будет выполнено повторно
+        logging.warning("Этап: Не удалось завершить задание %s в хранилище, повторим позже: %s", job_id, e)
+        db.rollback()
+        job_store_pending_finish[job_id] = (state, finished_at)
+        return False
+
+def job_store_retry_pending():
+    for job_id, (state, finished_at) in list(job_store_pending_finish.items()):
+        if not _job_store_finish(job_id, state, finished_at):
+            return
+
+def job_store_release(job: "AnalysisJob"):
+    # Остановка процесса: возвращаем задание в очередь, контрольные точки сохраняются
+    db = get_job_store()
+    if db is None:
+        return
+    try:
+        db.execute(
+            "UPDATE jobs SET state = 'queued', lease_until = 0, updated_at = ? WHERE job_id = ? AND worker = ? AND state = 'running'",
+            (time.time(), job.job_id, JOB_STORE_WORKER_ID)
+        )
+        db.commit()
+    except sqlite3.Error as e:
+        logging.error("Этап: Не удалось вернуть задание %s в очередь: %s", job.job_id, e)
+        db.rollback()
+
+def job_store_checkpoints(job_id: Optional[str]) -> Dict[str, str]:
+    # Без задания (пакетный режим batch.py) хранилище не открываем
+    if job_id is None:
+        return {}
+    db = get_job_store()
+    if db is None:
+        return {}
+    try:
+        return dict(db.execute("SELECT article, result FROM checkpoints WHERE job_id = ?", (job_id,)).fetchall())
+    except sqlite3.Error as e:
+        logging.error("Этап: Не удалось прочитать контрольные точки задания %s: %s", job_id, e)
+        return {}
+
+def job_store_checkpoint(job_id: Optional[str], article_number: str, result: str):
+    # Без задания (пакетный режим batch.py) хранилище не открываем
+    if job_id is None:
+        return
+    db = get_job_store()
+    if db is None:
+        return
+    try:
+        db.execute(
+            "INSERT OR REPLACE INTO checkpoints (job_id, article, result) VALUES (?, ?, ?)",
+            (job_id, article_number, result)
+        )
+        db.commit()
+    except sqlite3.Error as e:
+        logging.error("Этап: Не удалось сохранить контрольную точку задания %s: %s", job_id, e)
+        db.rollback()
+
+def job_store_copy_checkpoints(source_job_id: Optional[str], target_job_id: Optional[str]):
+    # Подписчик, присоединившийся к общему анализу, получает уже готовые контрольные точки
+    if source_job_id is None or target_job_id is None or source_job_id == target_job_id:
+        return
+    db = get_job_store()
+    if db is None:
+        return
+    try:
+        db.execute(
+            "INSERT OR IGNORE INTO checkpoints (job_id, article, result) "
+            "SELECT ?, article, result FROM checkpoints WHERE job_id = ?",
+            (target_job_id, source_job_id)
+        )
+        db.commit()
+    except sqlite3.Error as e:
+        logging.error("Этап: Не удалось скопировать контрольные точки задания %s: %s", source_job_id, e)
+        db.rollback()
+
+def job_store_recoverable() -> list:
+    # Чистка: исчерпавшие попытки и устаревшие задания закрываются, старые завершённые удаляются
+    db = get_job_store()
+    if db is None:
+        return []
+    now = time.time()
+    try:
+        return _job_store_recoverable(db, now)
+    except sqlite3.Error as e:
+        # Хранилище занято другим процессом — попробуем на следующем опросе
+        logging.warning("Этап: Хранилище заданий занято, опрос отложен: %s", e)
+        db.rollback()
+        return []
+
+def _job_store_recoverable(db: sqlite3.Connection, now: float) -> list:
+    db.execute(
+        "UPDATE jobs SET state = 'failed', updated_at = ? WHERE state IN ('queued', 'running') "
+        "AND lease_until < ? AND attempts >= ?",
+        (now, now, JOB_MAX_ATTEMPTS)
+    )
+    db.execute(
+        "UPDATE jobs SET state = 'expired', updated_at = ? WHERE state IN ('queued', 'running') "
+        "AND lease_until < ? AND created_at < ?",
+        (now, now, now - JOB_MAX_AGE)
+    )
+    db.execute("DELETE FROM checkpoints WHERE job_id IN (SELECT job_id FROM jobs WHERE state NOT IN ('queued', 'running'))")
+    db.execute("DELETE FROM jobs WHERE state NOT IN ('queued', 'running') AND updated_at < ?", (now - JOB_MAX_AGE,))
+    db.commit()
+    # Задания в очереди живого процесса остаются у него (он продлевает их аренду): иначе сломалась бы
+    # привязка чата к процессу в режиме webhook. Забираем только задания с истёкшей арендой.
+    # Продлеваются только задания, которые этот процесс действительно держит в памяти
+    local_jobs = [job.job_id for job in (*user_queue.values(), *user_busy.values())]
+    db.executemany(
+        "UPDATE jobs SET lease_until = ? WHERE job_id = ? AND worker = ? AND state = 'queued'",
+        [(now + JOB_LEASE_SECONDS, job_id, JOB_STORE_WORKER_ID) for job_id in local_jobs]
+    )
+    db.commit()
+    return db.execute(
+        "SELECT job_id, user_id, chat_id, handler, message FROM jobs "
+        "WHERE state IN ('queued', 'running') AND lease_until < ? AND (worker IS NULL OR worker != ?) "
+        "ORDER BY created_at LIMIT 100",
+        (now, JOB_STORE_WORKER_ID)
+    ).fetchall()
+
+def recover_job(row, bot: Bot):
+    job_id, user_id, chat_id, handler_name, raw_message = row
+    local = user_busy.get(user_id) or user_queue.get(user_id)
+    if local is not None:
+        return
+    handler = globals().get(handler_name) if handler_name in JOB_HANDLER_NAMES else None
+    try:
+        message = Message.model_validate_json(raw_message, context={"bot": bot})
+    except Exception as e:
+        logging.error("Этап: Задание %s не восстановить: %s", job_id, e)
+        handler = None
+    if handler is None:
+        get_job_store().execute("UPDATE jobs SET state = 'failed', updated_at = ? WHERE job_id = ?", (time.time(), job_id))
+        get_job_store().commit()
+        return
+    enqueue_job(AnalysisJob(
+        handler_func=handler, message=message, bot=bot, user_id=user_id, chat_id=chat_id, job_id=job_id,
+        priority=job_priority(handler, message)
+    ))
+    logging.info("Этап: Задание %s пользователя %s восстановлено из хранилища", job_id, user_id)
+
+async def job_store_poller(bot: Bot):
+    while True:
+        try:
+            job_store_retry_pending()
+            for row in job_store_recoverable():
+                recover_job(row, bot)
+        except Exception as e:
+            logging.error("Этап: Ошибка опроса хранилища заданий: %s", e)
+        await asyncio.sleep(JOB_STORE_POLL_INTERVAL)
+
+async def start_job_store_poller(bot: Bot):
+    global job_store_poller_task
+    if get_job_store() is None:
+        return
+    job_store_poller_task = asyncio.create_task(job_store_poller(bot))
+
+async def stop_job_store_poller():
+    if job_store_poller_task is not None:
+        job_store_poller_task.cancel()
+        await asyncio.gather(job_store_poller_task, return_exceptions=True)
+
+def _job_signal() -> asyncio.Semaphore:
+    global job_signal
+    if job_signal is None:
+        job_signal = asyncio.Semaphore(0)
+    return job_signal
+
+def job_priority(handler_func, message: Message) -> int:
+    # Явная команда и личный чат важнее длинных сообщений, случайно подхваченных в группе
+    if handler_func is analyze_command or message.chat.type == "private":
+        return PRIORITY_HIGH
+    return PRIORITY_LOW
+
+def enqueue_job(job: AnalysisJob):
+    user_queue[job.user_id] = job
+    key = (job.priority, job.chat_id)
+    if key not in chat_jobs:
+        chat_jobs[key] = deque()
+        chat_rotation[job.priority].append(job.chat_id)
+    chat_jobs[key].append(job)
+    _job_signal().release()
+
+def next_job() -> Optional[AnalysisJob]:
+    # Сначала приоритетные задания; внутри приоритета по одному из каждого чата по кругу, снятые пропускаем
+    for priority, rotation in sorted(chat_rotation.items()):
+        while rotation:
+            chat_id = rotation.popleft()
+            jobs = chat_jobs[(priority, chat_id)]
+            job = jobs.popleft()
+            if jobs:
+                rotation.append(chat_id)
+            else:
+                del chat_jobs[(priority, chat_id)]
+            if user_queue.get(job.user_id) is job:
+                del user_queue[job.user_id]
+                return job
+    return None
+
+def queue_position(job: AnalysisJob) -> Tuple[int, float]:
+    # Место в очереди (приблизительно: чаты обходятся по кругу) и ожидаемое время до ответа по средней
+    # длительности последних заданий с учётом числа воркеров и уже выполняющихся заданий
+    ahead = sum(
+        1 for other in user_queue.values()
+        if other is not job and (other.priority, other.enqueued_at) < (job.priority, job.enqueued_at)
+    )
+    duration = sum(recent_job_durations) / len(recent_job_durations) if recent_job_durations else QUEUE_ETA_DEFAULT
+    eta = ((ahead + len(user_busy)) // max(1, JOB_WORKERS) + 1) * duration
+    return ahead + 1, eta
+
+def queue_status_text(job: AnalysisJob) -> str:
+    position, eta = queue_position(job)
+    minutes = max(1, round(eta / 60))
+    return f"Гражданин, ваше дело в очереди на рассмотрение: {position}-е. Ориентировочное время ответа — {minutes} мин."
+
+def refresh_queue_status():
+    # Места в очереди сдвинулись: правим сообщения ожидающих. Удалённое сообщение снимает запрос
+    # (и вложенное обновление очереди, поэтому уже снятые задания пропускаем)
+    for job in list(user_queue.values()):
+        if job.status_message is None or user_queue.get(job.user_id) is not job:
+            continue
+        if not queue_progress_edit(
+            bot=job.bot, text=queue_status_text(job), chat_id=job.chat_id, message_id=job.status_message.message_id
+        ):
+            logging.info("Этап: Сообщение об очереди удалено, запрос пользователя %s снят", job.user_id)
+            discard_progress_edits(job.chat_id, job.status_message.message_id)
+            job.status_message = None
+            cancel_user_job(job.user_id)
+
+async def drop_queue_status(job: AnalysisJob):
+    status_message, job.status_message = job.status_message, None
+    if status_message is None:
+        return
+    discard_progress_edits(job.chat_id, status_message.message_id)
+    try:
+        await telegram_call(job.chat_id, status_message.delete)
+    except Exception as e:
+        logging.debug("Этап: Не удалось удалить сообщение об очереди: %s", e)
+
+async def shed_job(job: AnalysisJob, reason: str):
+    # Снятие ожидающего задания при перегрузке: пользователь узнаёт об этом из сообщения об очереди
+    if user_queue.get(job.user_id) is not job:
+        return
+    logging.warning("Этап: Задание %s пользователя %s снято при перегрузке (%s)", job.job_id, job.user_id, reason)
+    JOBS_TOTAL.inc(outcome="shed")
+    job_store_finish(job, "shed")
+    finish_job(job)
+    refresh_queue_status()
+    if job.status_message is not None:
+        await safe_edit_message_text(
+            bot=job.bot,
+            text="Следственный отдел перегружен, ваше дело снято с рассмотрения. Отправьте его позже.",
+            chat_id=job.chat_id,
+            message_id=job.status_message.message_id
+        )
+        job.status_message = None
+
+def finish_job(job: AnalysisJob):
+    if user_queue.get(job.user_id) is job:
+        del user_queue[job.user_id]
+    if user_busy.get(job.user_id) is job:
+        del user_busy[job.user_id]
+    if job.done is not None and not job.done.done():
+        job.done.set_result(None)
+
+def cancel_user_job(user_id: int):
+    # Единая точка отмены: снимает задание из очереди или прерывает выполняющееся
+    job = user_busy.get(user_id) or user_queue.get(user_id)
+    if job is None:
+        return
+    logging.info("Этап: Отмена задания пользователя %s", user_id)
+    if job.task is not None and not job.task.done():
+        job.task.cancel()
+    job_store_finish(job, "cancelled")
+    finish_job(job)
+    refresh_queue_status()
+
+async def run_job(job: AnalysisJob):
+    bind_log_context(job_id=job.job_id, user_id=job.user_id)
+    current_job_id.set(job.job_id)
+    job_deadline.set(time.monotonic() + JOB_DEADLINE)
+    await drop_queue_status(job)
+    await job.handler_func(job.message, job.bot)
+
+async def wait_with_lease(job: AnalysisJob):
+    # Ждём задание, продлевая аренду; потерянная аренда означает, что задание уже у другого воркера.
+    # Задание, пережившее свой срок с запасом, снимается, чтобы не занимать место в очереди
+    hard_deadline = time.monotonic() + JOB_DEADLINE + JOB_DEADLINE_GRACE
+    while not job.task.done():
+        await asyncio.wait({job.task}, timeout=min(JOB_LEASE_SECONDS / 3, max(0.0, hard_deadline - time.monotonic())))
+        if job.task.done():
+            break
+        if time.monotonic() >= hard_deadline:
+            logging.warning("Этап: Задание %s превысило срок, выполнение прервано", job.job_id)
+            job.task.cancel()
+            await asyncio.wait({job.task})
+        elif not job_store_renew(job):
+            logging.warning("Этап: Аренда задания %s потеряна, выполнение прервано", job.job_id)
+            job.task.cancel()
+            await asyncio.wait({job.task})
+
+async def job_worker(worker_id: int):
+    logging.info("Этап: Воркер очереди %s запущен", worker_id)
+    signal = _job_signal()
+    while True:
+        await signal.acquire()
+        job = next_job()
+        if job is None:
+            continue
+        if not job_store_claim(job):
+            logging.info("Этап: Задание %s уже выполняется другим воркером", job.job_id)
+            finish_job(job)
+            await drop_queue_status(job)
+            continue
+        user_busy[job.user_id] = job
+        refresh_queue_status()
+        QUEUE_WAIT.observe(time.monotonic() - job.enqueued_at)
+        started_at = time.monotonic()
+        logging.info(
+            "Этап: Воркер %s взял задание %s пользователя %s, ожидание в очереди %.1f с",
+            worker_id, job.job_id, job.user_id, time.monotonic() - job.enqueued_at
+        )
+        job.task = asyncio.create_task(run_job(job))
+        try:
+            await wait_with_lease(job)
+            outcome = "ok"
+            if job.task.cancelled():
+                outcome = "cancelled"
+                logging.info("Этап: Задание пользователя %s отменено", job.user_id)
+            elif job.task.exception() is not None:
+                outcome = "error"
+                logging.error("Этап: Ошибка в задании пользователя %s: %s", job.user_id, job.task.exception())
+            JOB_DURATION.observe(time.monotonic() - job.enqueued_at)
+            JOBS_TOTAL.inc(outcome=outcome)
+            if outcome == "ok":
+                recent_job_durations.append(time.monotonic() - started_at)
+            job_store_finish(job, {"ok": "done", "cancelled": "cancelled", "error": "failed"}[outcome])
+        except asyncio.CancelledError:
+            job.task.cancel()
+            job_store_release(job)
+            raise
+        finally:
+            finish_job(job)
+            logging.info("Этап: Пользователь %s удалён из очереди и освобождён", job.user_id)
+
+async def start_job_workers():
+    logging.info("Этап: Запуск %s воркеров очереди", JOB_WORKERS)
+    for worker_id in range(max(1, JOB_WORKERS)):
+        job_workers.append(asyncio.create_task(job_worker(worker_id)))
+
+async def stop_job_workers():
+    logging.info("Этап: Остановка воркеров очереди")
+    for worker in job_workers:
+        worker.cancel()
+    await asyncio.gather(*job_workers, return_exceptions=True)
+    job_workers.clear()
 
 async def handle_with_queue(handler_func, message: Message, bot: Bot):
     user_id = message.from_user.id
-    logging.info(f"Этап: Обработка очереди для пользователя {user_id}")
+    logging.debug("Этап: Обработка очереди для пользователя %s", user_id)
     if user_id in user_busy:
-        logging.info(f"Этап: Пользователь {user_id} занят, запрос отклонён")
+        logging.info("Этап: Пользователь %s занят, запрос отклонён", user_id)
         return
     if user_id in user_queue:
-        logging.info(f"Этап: Пользователь {user_id} уже в очереди")
-        await message.answer("Ожидайте гражданин, ваш запрос уже в очереди на обработку.")
+        logging.info("Этап: Пользователь %s уже в очереди", user_id)
+        queued = user_queue[user_id]
+        if queued.status_message is not None:
+            queue_progress_edit(
+                bot=bot, text=queue_status_text(queued), chat_id=queued.chat_id, message_id=queued.status_message.message_id
+            )
+            return
+        await telegram_call(message.chat.id, message.answer, "Ожидайте гражданин, ваш запрос уже в очереди на обработку.")
         return
-    user_queue.append(user_id)
-    logging.info(f"Этап: Пользователь {user_id} добавлен в очередь")
-    while user_queue[0] != user_id:
-        await asyncio.sleep(1)
-    user_busy[user_id] = True
-    try:
-        logging.info(f"Этап: Выполнение функции обработки для пользователя {user_id}")
-        await handler_func(message, bot)
-    finally:
-        user_queue.popleft()
-        user_busy.pop(user_id, None)
-        logging.info(f"Этап: Пользователь {user_id} удалён из очереди и освобождён")
+    job = AnalysisJob(
+        handler_func=handler_func,
+        message=message,
+        bot=bot,
+        user_id=user_id,
+        chat_id=message.chat.id,
+        done=asyncio.get_running_loop().create_future(),
+        priority=job_priority(handler_func, message)
+    )
+    if not await admit_job(job):
+        return
+    job.stored = job_store_add(job)
+    enqueue_job(job)
+    logging.info("Этап: Пользователь %s добавлен в очередь, в очереди %s", user_id, len(user_queue))
+    position, _ = queue_position(job)
+    if position + len(user_busy) > max(1, JOB_WORKERS):
+        # Свободного воркера нет — сообщаем место в очереди; дальше это сообщение правится на месте
+        status_message = await safe_reply(message, queue_status_text(job))
+        if status_message is not None:
+            job.status_message = status_message
+            if user_queue.get(user_id) is not job:
+                await drop_queue_status(job)
+    await job.done
+
+async def admit_job(job: AnalysisJob) -> bool:
+    depth = len(user_queue)
+    if job.priority == PRIORITY_LOW and depth >= min(QUEUE_SHED_DEPTH, QUEUE_MAX_JOBS):
+        logging.info("Этап: Очередь перегружена (%s), сообщение пользователя %s пропущено", depth, job.user_id)
+        JOBS_TOTAL.inc(outcome="shed")
+        return False
+    in_chat = sum(1 for queued in user_queue.values() if queued.chat_id == job.chat_id)
+    if in_chat >= QUEUE_MAX_PER_CHAT:
+        logging.info("Этап: В чате %s уже %s заданий в очереди, запрос отклонён", job.chat_id, in_chat)
+    elif depth < QUEUE_MAX_JOBS:
+        return True
+    else:
+        # Полная очередь: место приоритетному заданию освобождает самое позднее из пассивных
+        victims = [queued for queued in user_queue.values() if queued.priority > job.priority]
+        if victims:
+            await shed_job(max(victims, key=lambda queued: queued.enqueued_at), "вытеснено приоритетным")
+            return True
+        logging.warning("Этап: Очередь заполнена (%s), запрос пользователя %s отклонён", depth, job.user_id)
+    JOBS_TOTAL.inc(outcome="rejected")
+    if job.priority == PRIORITY_HIGH:
+        await safe_reply(job.message, "Гражданин, следственный отдел перегружен. Повторите обращение позже.")
+    return False
 
 def read_file(file_path):
-    logging.info(f"Этап: Чтение файла {file_path}")
+    logging.info("Этап: Чтение файла %s", file_path)
     try:
         with open(file_path, "r", encoding="utf-8") as f:
             content = f.read().strip()
-            logging.info(f"Этап: Файл {file_path} успешно прочитан")
+            logging.info("Этап: Файл %s успешно прочитан", file_path)
             return content
     except FileNotFoundError:
-        logging.error(f"Этап: Файл {file_path} не найден")
+        logging.error("Этап: Файл %s не найден", file_path)
         return f"Ошибка: Файл {file_path} не найден."
     except Exception as e:
-        logging.error(f"Этап: Ошибка при чтении файла {file_path}: {str(e)}")
+        logging.error("Этап: Ошибка при чтении файла %s: %s", file_path, e)
         return f"Ошибка при чтении файла {file_path}: {str(e)}"
 
 def get_denials():
-    logging.info(f"Этап: Загрузка списка отказов из {DENIALS_FILE}")
+    logging.info("Этап: Загрузка списка отказов из %s", DENIALS_FILE)
     try:
         with open(DENIALS_FILE, "r", encoding="utf-8") as f:
             denials = [line.strip().lower() for line in f if line.strip()]
-            logging.info(f"Этап: Список отказов успешно загружен: {denials}")
+            logging.info("Этап: Список отказов успешно загружен: %s фраз", len(denials))
             return denials
     except FileNotFoundError:
-        logging.error(f"Этап: Файл отказов {DENIALS_FILE} не найден")
+        logging.error("Этап: Файл отказов %s не найден", DENIALS_FILE)
         return []
     except Exception as e:
-        logging.error(f"Этап: Ошибка при чтении файла отказов: {str(e)}")
+        logging.error("Этап: Ошибка при чтении файла отказов: %s", e)
         return []
 
 def is_cyrillic(text):
-    logging.info("Этап: Проверка текста на наличие кириллицы")
-    result = any('\u0400' <= char <= '\u04FF' for char in text)
-    logging.info(f"Этап: Результат проверки кириллицы: {result}")
-    return result
+    return any('\u0400' <= char <= '\u04FF' for char in text)
+
+def contains_denial_phrase(response):
+    denial_pattern = current_config.denial_pattern if current_config else None
+    return bool(denial_pattern and denial_pattern.search(unicodedata.normalize("NFC", response.lower())))
 
 def is_denial_response(response):
-    logging.info("Этап: Проверка ответа на наличие фраз отказа")
-    denials = get_denials()
+    logging.debug("Этап: Проверка ответа на наличие фраз отказа")
     if not is_cyrillic(response):
-        logging.info("Этап: Ответ не содержит кириллицу, считается отказом")
+        logging.debug("Этап: Ответ не содержит кириллицу, считается отказом")
         return True
-    result = any(phrase in response.lower() for phrase in denials)
-    logging.info(f"Этап: Результат проверки отказа: {result}")
+    result = contains_denial_phrase(response)
+    logging.debug("Этап: Результат проверки отказа: %s", result)
     return result
 
 def load_articles():
-    json_file = os.path.join(BASE_DIR, "articles.json")
-    logging.info(f"Этап: Загрузка статей из файла {json_file}")
+    json_file = ARTICLES_FILE
+    logging.info("Этап: Загрузка статей из файла %s", json_file)
     try:
         with open(json_file, "r", encoding="utf-8") as f:
             articles = json.load(f)
-            logging.info(f"Этап: Статьи успешно загружены: {articles}")
+            logging.info("Этап: Статьи успешно загружены: %s", len(articles))
             return articles
     except FileNotFoundError:
-        logging.error(f"Этап: Файл {json_file} не найден")
+        logging.error("Этап: Файл %s не найден", json_file)
         return {"error": f"Файл {json_file} не найден."}
     except Exception as e:
-        logging.error(f"Этап: Ошибка при чтении {json_file}: {str(e)}")
+        logging.error("Этап: Ошибка при чтении %s: %s", json_file, e)
         return {"error": f"Ошибка при чтении {json_file}: {str(e)}"}
 
-async def call_g4f_model(prompt: str) -> str:
-    logging.info("Этап: Вызов модели g4f")
+# Служебные фрагменты выгрузки из правовой базы, которые не нужны модели: пометка о редакции,
+# реквизиты кодекса, повтор заголовка, история поправок в скобках и ссылки на соседние статьи
+ARTICLE_BOILERPLATE = re.compile(r"Подготовлена\s+редакция\s+документа с изменениями, не вступившими в силу\s*")
+ARTICLE_FOOTER = re.compile(r"\nОткрыть полный текст документа.*", re.DOTALL)
+ARTICLE_SKIP_LINE = re.compile(r"^(?:УК РФ Статья|\"Уголовный кодекс)")
+ARTICLE_REPEALED = re.compile(r"^Примечани[ея]\. Утратил[ои] силу")
+ARTICLE_AMENDMENT = re.compile(r"\s*\([^()]*(?:ред\.|редакции|введен|утратил|ФЗ)[^()]*\)")
+# Строки, с которых начинается новый структурный блок; остальные переносы — следы гиперссылок
+ARTICLE_BLOCK_START = re.compile(r"^(?:Статья\s|\d+(?:\.\d+)*\.|[а-я]\)|наказыва|Примечани)")
+
+def compact_article_text(text: str) -> str:
+    text = ARTICLE_FOOTER.sub("", ARTICLE_BOILERPLATE.sub("", text))
+    blocks = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or ARTICLE_SKIP_LINE.match(line):
+            continue
+        # Заголовок статьи всегда остаётся отдельной строкой
+        if len(blocks) > 1 and not ARTICLE_BLOCK_START.match(line):
+            blocks[-1] += " " + line
+        else:
+            blocks.append(line)
+    compact = "\n".join(ARTICLE_AMENDMENT.sub("", block) for block in blocks if not ARTICLE_REPEALED.match(block))
+    compact = re.sub(r"[ \t]+([,.;:)])", r"\1", compact)
+    compact = re.sub(r"\(\s+", "(", compact)
+    compact = re.sub(r"[ \t]{2,}", " ", compact)
+    return "\n".join(line.strip() for line in compact.splitlines() if line.strip())
+
+# Снимок конфигурации: статьи, промпты и отказы загружаются один раз и подменяются целиком.
+# В промпты идут сжатые тексты статей, исходные хранятся в articles_original для сверки
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    version: str
+    prompt_template: str
+    prompt2_template: str
+    articles: Mapping[str, str]
+    articles_original: Mapping[str, str]
+    denials: Tuple[str, ...]
+    denial_pattern: Optional[Pattern]
+    prefilter_index: Mapping[str, Tuple[Tuple[str, float], ...]]
+    batch_prompt_template: Optional[str]
+    mtimes: Tuple
+
+current_config: Optional[ConfigSnapshot] = None
+config_error: Optional[str] = None
+
+def config_mtimes() -> Tuple:
+    return tuple(
+        os.path.getmtime(path) if os.path.exists(path) else None
+        for path in (ARTICLES_FILE, PROMPT_FILE, PROMPT2_FILE, DENIALS_FILE, TRIGGERS_FILE, PROMPT_BATCH_FILE)
+    )
+
+def load_triggers():
+    logging.info("Этап: Загрузка триггеров предварительного отбора из %s", TRIGGERS_FILE)
+    try:
+        with open(TRIGGERS_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        logging.info("Этап: Файл триггеров %s не найден, используются только тексты статей", TRIGGERS_FILE)
+        return {}
+
+def prefilter_tokens(text: str):
+    return re.findall(r"[а-яa-z0-9]+", text.lower().replace("ё", "е"))
+
+def build_prefilter_index(articles, triggers):
+    # Основы слов статей берутся, только если встречаются в одной статье (шаблонные юридические слова отсеиваются)
+    article_stems = {}
+    for number, content in articles.items():
+        for token in prefilter_tokens(content):
+            if len(token) >= PREFILTER_STEM_LENGTH:
+                article_stems.setdefault(token[:PREFILTER_STEM_LENGTH], set()).add(number)
+    index = {}
+    for stem, numbers in article_stems.items():
+        if len(numbers) == 1:
+            index.setdefault(stem, {})[next(iter(numbers))] = PREFILTER_ARTICLE_WEIGHT
+    for number, stems in triggers.items():
+        if number not in articles:
+            continue
+        for stem in stems:
+            index.setdefault(stem.lower().replace("ё", "е"), {})[number] = PREFILTER_TRIGGER_WEIGHT
+    return MappingProxyType({stem: tuple(weights.items()) for stem, weights in index.items()})
+
+def prefilter_scores(text: str, index) -> Dict[str, float]:
+    # Короткие основы (до 3 букв) совпадают только целым словом, длинные — как префикс
+    matched = set()
+    for token in set(prefilter_tokens(text)):
+        if token in index:
+            matched.add(token)
+        for length in range(4, min(len(token), PREFILTER_STEM_LENGTH + 5) + 1):
+            if token[:length] in index:
+                matched.add(token[:length])
+    scores: Dict[str, float] = {}
+    for stem in matched:
+        for number, weight in index[stem]:
+            scores[number] = scores.get(number, 0.0) + weight
+    return scores
+
+prefilter_counters = {"screened": 0, "skipped": 0, "audit_llm_yes": 0, "audit_missed": 0, "audit_saved": 0}
+
+def record_prefilter_audit(article_number: str, would_skip: bool, llm_yes: bool, score: float):
+    if llm_yes:
+        prefilter_counters["audit_llm_yes"] += 1
+        if would_skip:
+            prefilter_counters["audit_missed"] += 1
+            logging.warning("Этап: Предотбор пропустил бы статью %s с вердиктом Yes (оценка %.1f)", article_number, score)
+    elif would_skip:
+        prefilter_counters["audit_saved"] += 1
+    yes = prefilter_counters["audit_llm_yes"]
+    recall = 1.0 - prefilter_counters["audit_missed"] / yes if yes else 1.0
+    logging.info(
+        "Этап: Аудит предотбора: полнота %.3f, сэкономлено бы запросов %s, вердиктов Yes %s",
+        recall, prefilter_counters["audit_saved"], yes
+    )
+
+def build_config_snapshot() -> ConfigSnapshot:
+    # Выбрасывает ValueError с текстом для пользователя, если конфигурация некорректна
+    mtimes = config_mtimes()
+    prompt_template = read_file(PROMPT_FILE)
+    if prompt_template.startswith("Ошибка"):
+        raise ValueError(prompt_template)
+    prompt2_template = read_file(PROMPT2_FILE)
+    if prompt2_template.startswith("Ошибка"):
+        raise ValueError(prompt2_template)
+    for template, name, fields in (
+        (prompt_template, PROMPT_FILE, ("{article_content}", "{user_input}")),
+        (prompt2_template, PROMPT2_FILE, ("{report_content}",))
+    ):
+        missing = [f for f in fields if f not in template]
+        if missing:
+            raise ValueError(f"Ошибка: В шаблоне {name} нет полей {', '.join(missing)}.")
+    articles = load_articles()
+    if "error" in articles:
+        raise ValueError(articles["error"])
+    if not isinstance(articles, dict) or not articles or not all(
+        isinstance(k, str) and isinstance(v, str) for k, v in articles.items()
+    ):
+        raise ValueError(f"Ошибка: Файл {ARTICLES_FILE} должен содержать непустой объект \"номер статьи\": \"текст\".")
+    missing_articles = [a for a in ARTICLES if a not in articles]
+    if missing_articles:
+        logging.warning("Этап: В %s нет статей %s", ARTICLES_FILE, missing_articles)
+    articles_original = articles
+    articles = {
+        number: content if content.startswith("Ошибка") else compact_article_text(content)
+        for number, content in articles_original.items()
+    }
+    logging.info(
+        "Этап: Тексты статей сжаты с %s до %s символов (~%s токенов)",
+        sum(map(len, articles_original.values())), sum(map(len, articles.values())),
+        sum(estimate_tokens(content) for content in articles.values())
+    )
+    # В denials.txt встречается разложенная "й" (и + бреве), поэтому сравниваем в NFC
+    denials = tuple(unicodedata.normalize("NFC", phrase) for phrase in get_denials())
+    # Все фразы отказа собираются в одно регулярное выражение, длинные раньше коротких
+    denial_pattern = re.compile(
+        "|".join(re.escape(phrase) for phrase in sorted(set(denials), key=len, reverse=True))
+    ) if denials else None
+    prefilter_index = build_prefilter_index(articles, load_triggers())
+    # Шаблон пакетного режима необязателен: без него пакетный режим сводится к поштучному
+    batch_prompt_template = None
+    if os.path.exists(PROMPT_BATCH_FILE):
+        batch_prompt_template = read_file(PROMPT_BATCH_FILE)
+        missing = [f for f in ("{articles_block}", "{user_input}") if f not in batch_prompt_template]
+        if batch_prompt_template.startswith("Ошибка") or missing:
+            logging.error("Этап: Шаблон %s некорректен, пакетный режим отключён", PROMPT_BATCH_FILE)
+            batch_prompt_template = None
+    digest = hashlib.sha256()
+    for part in (prompt_template, prompt2_template, batch_prompt_template or "", json.dumps(articles, sort_keys=True, ensure_ascii=False), *denials):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return ConfigSnapshot(
+        version=digest.hexdigest()[:16],
+        prompt_template=prompt_template,
+        prompt2_template=prompt2_template,
+        articles=MappingProxyType(dict(articles)),
+        articles_original=MappingProxyType(dict(articles_original)),
+        denials=denials,
+        denial_pattern=denial_pattern,
+        prefilter_index=prefilter_index,
+        batch_prompt_template=batch_prompt_template,
+        mtimes=mtimes
+    )
+
+def reload_config(force: bool = False) -> bool:
+    global current_config, config_error
+    if not force and current_config is not None and current_config.mtimes == config_mtimes():
+        return False
+    logging.info("Этап: Загрузка снимка конфигурации")
+    try:
+        snapshot = build_config_snapshot()
+    except ValueError as e:
+        # При ошибке продолжаем работать со старым снимком, если он есть
+        config_error = str(e)
+        logging.error("Этап: Конфигурация не загружена: %s", config_error)
+        return False
+    current_config = snapshot
+    config_error = None
+    logging.info("Этап: Загружен снимок конфигурации %s, статей %s", snapshot.version, len(snapshot.articles))
+    return True
+
+def get_config() -> Optional[ConfigSnapshot]:
+    return current_config
+
+async def config_watcher():
+    while True:
+        await asyncio.sleep(CONFIG_RELOAD_INTERVAL)
+        try:
+            reload_config()
+        except Exception as e:
+            logging.error("Этап: Ошибка при перезагрузке конфигурации: %s", e)
+
+config_watcher_task: Optional[asyncio.Task] = None
+
+async def start_config_watcher():
+    global config_watcher_task
+    config_watcher_task = asyncio.create_task(config_watcher())
+
+async def stop_config_watcher():
+    if config_watcher_task is not None:
+        config_watcher_task.cancel()
+
+reload_config(force=True)
+
+# Кэш вердиктов по содержимому: ключ — хэши нормализованного текста, статьи и шаблона
+verdict_cache_db: Optional[sqlite3.Connection] = None
+cache_counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.split())
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def get_verdict_cache() -> Optional[sqlite3.Connection]:
+    global verdict_cache_db
+    if not VERDICT_CACHE_ENABLED:
+        return None
+    if verdict_cache_db is None:
+        logging.info("Этап: Открытие кэша вердиктов %s", VERDICT_CACHE_FILE)
+        try:
+            db = sqlite3.connect(VERDICT_CACHE_FILE, timeout=VERDICT_CACHE_BUSY_TIMEOUT)
+            db.execute("PRAGMA journal_mode=WAL")
+            # Кэш можно потерять при сбое питания: fsync на каждую запись ему не нужен
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS verdicts ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS verdicts_last_used ON verdicts (last_used)")
+            db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            db.commit()
+            verdict_cache_db = db
+        except Exception as e:
+            logging.error("Этап: Кэш вердиктов недоступен: %s", e)
+            return None
+    invalidate_verdict_cache_if_stale()
+    return verdict_cache_db
+
+verdict_cache_checked_version: Optional[str] = None
+
+def invalidate_verdict_cache_if_stale():
+    # Новая версия снимка конфигурации (articles.json, промпты, отказы) сбрасывает весь кэш
+    global verdict_cache_checked_version
+    config = get_config()
+    if config is None or config.version == verdict_cache_checked_version:
+        return
+    row = verdict_cache_db.execute("SELECT value FROM meta WHERE name = 'config_version'").fetchone()
+    if not row or row[0] != config.version:
+        if row:
+            logging.info("Этап: Файлы статей или промптов изменились, кэш вердиктов очищен")
+        verdict_cache_db.execute("DELETE FROM verdicts")
+        verdict_cache_db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('config_version', ?)", (config.version,))
+        verdict_cache_db.commit()
+    # Версия запоминается только после успешной проверки: при занятом файле проверим снова
+    verdict_cache_checked_version = config.version
+
+def verdict_cache_key(kind: str, text: str, template: str, article_number: str = "", article_content: str = "") -> str:
+    return "|".join((
+        kind,
+        content_hash(normalize_text(text)),
+        article_number,
+        content_hash(article_content),
+        content_hash(template)
+    ))
+
+def cache_get(key: str) -> Optional[str]:
+    # Ошибка кэша (файл занят, повреждён) — это промах, а не ошибка задания
+    try:
+        return _cache_get(key)
+    except sqlite3.Error as e:
+        logging.warning("Этап: Кэш вердиктов недоступен, читаем без него: %s", e)
+        if verdict_cache_db is not None:
+            verdict_cache_db.rollback()
+        cache_counters["misses"] += 1
+        return None
+
+def _cache_get(key: str) -> Optional[str]:
+    db = get_verdict_cache()
+    if db is None:
+        return None
+    now = time.time()
+    row = db.execute("SELECT value, created_at, last_used FROM verdicts WHERE key = ?", (key,)).fetchone()
+    if row is None or now - row[1] > VERDICT_CACHE_TTL:
+        if row is not None:
+            db.execute("DELETE FROM verdicts WHERE key = ?", (key,))
+            db.commit()
+        cache_counters["misses"] += 1
+        return None
+    if now - row[2] > VERDICT_CACHE_TOUCH_INTERVAL:
+        # Для вытеснения хватает точности в час, поэтому горячие записи не пишутся на каждое попадание.
+        # Если файл занят, отметку пропускаем: найденный вердикт важнее
+        try:
+            db.execute("UPDATE verdicts SET last_used = ? WHERE key = ?", (now, key))
+            db.commit()
+        except sqlite3.Error as e:
+            logging.debug("Этап: Не удалось обновить время использования записи кэша: %s", e)
+            db.rollback()
+    cache_counters["hits"] += 1
+    logging.debug("Этап: Попадание в кэш вердиктов (попаданий %s, промахов %s)", cache_counters['hits'], cache_counters['misses'])
+    return row[0]
+
+def cache_put(key: str, value: str):
+    # Ошибки провайдеров не кэшируются; неудачная запись в кэш не портит полученный вердикт
+    if value.startswith("Ошибка"):
+        return
+    try:
+        _cache_put(key, value)
+    except sqlite3.Error as e:
+        logging.warning("Этап: Не удалось записать вердикт в кэш: %s", e)
+        if verdict_cache_db is not None:
+            verdict_cache_db.rollback()
+
+def _cache_put(key: str, value: str):
+    db = get_verdict_cache()
+    if db is None:
+        return
+    now = time.time()
+    db.execute(
+        "INSERT OR REPLACE INTO verdicts (key, value, created_at, last_used) VALUES (?, ?, ?, ?)",
+        (key, value, now, now)
+    )
+    db.execute("DELETE FROM verdicts WHERE created_at < ?", (now - VERDICT_CACHE_TTL,))
+    overflow = db.execute("SELECT COUNT(*) FROM verdicts").fetchone()[0] - VERDICT_CACHE_MAX_ENTRIES
+    if overflow > 0:
+        db.execute(
+            "DELETE FROM verdicts WHERE key IN (SELECT key FROM verdicts ORDER BY last_used LIMIT ?)",
+            (overflow,)
+        )
+        cache_counters["evictions"] += overflow
+    db.commit()
+
+llm_executor = ThreadPoolExecutor(max_workers=LLM_THREAD_WORKERS, thread_name_prefix="g4f")
+llm_thread_slots: Optional[asyncio.Semaphore] = None
+# Сколько текущая попытка ждала свободного потока: это местная очередь, а не задержка провайдера
+llm_slot_wait: contextvars.ContextVar = contextvars.ContextVar("llm_slot_wait", default=0.0)
+
+class LocalSlotTimeout(Exception):
+    pass
+
+def _llm_thread_slots() -> asyncio.Semaphore:
+    global llm_thread_slots
+    if llm_thread_slots is None:
+        llm_thread_slots = asyncio.Semaphore(LLM_THREAD_WORKERS)
+    return llm_thread_slots
+
+def provider_supports_async(provider) -> bool:
+    # Без явного провайдера g4f сам выбирает его через асинхронный путь
+    return provider is None or hasattr(provider, "create_async_generator")
+
+@dataclass
+class StreamedCompletion:
+    content: str
+    verdict: Optional[str] = None  # "no" / "denial" при досрочной остановке, иначе None
+
+def early_verdict(text: str) -> Optional[str]:
+    # Отказ — по фразам из denials.txt (кириллица в начале ответа может ещё не появиться);
+    # "No" — когда после него уже пришёл хотя бы один символ, чтобы не спутать с началом слова
+    if contains_denial_phrase(text):
+        return "denial"
+    match = BATCH_APPLICABILITY.search(text)
+    if match and match.end() < len(text) and match.group(1).lower() == "no":
+        return "no"
+    return None
+
+async def stream_completion(async_client, provider, model: str, messages, timeout: float) -> StreamedCompletion:
+    stream = async_client.chat.completions.create(
+        model=model,
+        provider=provider,
+        messages=messages,
+        stream=True,
+        timeout=timeout
+    )
+    if asyncio.iscoroutine(stream):
+        stream = await stream
+    result = StreamedCompletion(content="")
+
+    async def consume():
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if not delta:
+                continue
+            result.content += delta
+            result.verdict = early_verdict(result.content)
+            if result.verdict is not None:
+                logging.debug("Этап: Поток прерван досрочно (%s) после %s символов", result.verdict, len(result.content))
+                STREAM_EARLY_STOPS.inc(verdict=result.verdict)
+                return
+
+    try:
+        await asyncio.wait_for(consume(), timeout=timeout)
+    finally:
+        # Закрываем поток, чтобы провайдер перестал генерировать ответ
+        aclose = getattr(stream, "aclose", None)
+        if aclose is not None:
+            try:
+                await aclose()
+            except Exception as e:
+                logging.debug("Этап: Ошибка при закрытии потока: %s", e)
+    return result
+
+async def request_completion(client, async_client, provider_name: str, model: str, prompt: str,
+                             timeout: float = LLM_CALL_TIMEOUT, early_stop: bool = False):
+    provider = getattr(g4f.Provider, provider_name, None)
+    messages = [{"role": "user", "content": prompt}]
+    route = MODEL_ROUTES.get(model_key(provider_name, model))
+    use_async = provider_supports_async(provider) and (route is None or route.async_ok)
+    if use_async and early_stop and (route is None or route.streaming):
+        logging.debug("Этап: Потоковый запрос к %s/%s", provider_name, model)
+        return await stream_completion(async_client, provider, model, messages, timeout)
+    if use_async:
+        logging.debug("Этап: Асинхронный запрос к %s/%s", provider_name, model)
+        return await asyncio.wait_for(
+            async_client.chat.completions.create(
+                model=model,
+                provider=provider,
+                messages=messages,
+                stream=False,
+                timeout=timeout
+            ),
+            timeout=timeout
+        )
+
+    # Синхронный провайдер выполняется в ограниченном пуле потоков.
+    # Слот освобождается только когда поток реально завершился,
+    # поэтому зависшие запросы не накапливаются сверх LLM_THREAD_WORKERS.
+    # Ожидание слота не расходует таймаут провайдера: у него свой предел — остаток бюджета задания
+    # (или LLM_CALL_TIMEOUT), а его истечение не считается ошибкой провайдера
+    slots = _llm_thread_slots()
+    remaining = remaining_budget()
+    wait_started = time.monotonic()
+    try:
+        await asyncio.wait_for(
+            slots.acquire(), timeout=LLM_CALL_TIMEOUT if remaining is None else max(remaining, 0.1)
+        )
+    except asyncio.TimeoutError:
+        raise LocalSlotTimeout(f"нет свободного потока за {time.monotonic() - wait_started:.0f} с") from None
+    finally:
+        llm_slot_wait.set(time.monotonic() - wait_started)
+    logging.debug("Этап: Запрос к %s/%s в пуле потоков", provider_name, model)
+    loop = asyncio.get_running_loop()
     try:
-        client = Client()
-        valid_response = None  # Храним первый валидный ответ
-        for _ in range(10):
-            now = time.time()
-            active_providers = [
-                p for p in PROVIDER_MODELS.keys()
-                if PROVIDER_MODELS[p] and (p not in provider_failures or now - provider_failures[p] > 1800)  # 30 минут = 1800 секунд
+        future = loop.run_in_executor(
+            llm_executor,
+            functools.partial(
+                client.chat.completions.create,
+                model=model,
+                provider=provider,
+                messages=messages,
+                stream=False,
+                timeout=timeout
+            )
+        )
+    except Exception:
+        slots.release()
+        raise
+    future.add_done_callback(lambda _: slots.release())
+    return await asyncio.wait_for(asyncio.shield(future), timeout=timeout)
+
+def iter_candidates(min_batch_size: int = 1, prompt_tokens: int = 0):
+    # Кандидаты (провайдер, модель): провайдер и порядок моделей выбираются маршрутизатором
+    tried_providers = set()
+    for _ in range(10):
+        selection = select_targets(tried_providers, min_batch_size, prompt_tokens)
+        if selection is None and tried_providers:
+            tried_providers.clear()
+            selection = select_targets(min_batch_size=min_batch_size, prompt_tokens=prompt_tokens)
+        if selection is None:
+            # Все автоматы разомкнуты — пробуем случайного провайдера, как раньше при очистке списка
+            providers = [
+                p for p in PROVIDER_MODELS
+                if PROVIDER_MODELS[p] and provider_batch_limit(p) >= min_batch_size
+                and any(fits_context(p, m, prompt_tokens) for m in PROVIDER_MODELS[p])
             ]
-            logging.info(f"Этап: Доступные провайдеры: {active_providers}")
-            if not active_providers:
-                provider_failures.clear()
-                active_providers = list(PROVIDER_MODELS.keys())
-                logging.info(f"Этап: Очищены провайдеры с ошибками, новые активные провайдеры: {active_providers}")
-            selected_provider = random.choice(active_providers)
-            available_models = PROVIDER_MODELS[selected_provider].copy()
+            if not providers:
+                logging.info("Этап: Нет провайдеров с контекстом для промпта в %s токенов", prompt_tokens)
+                return
+            selected_provider = random.choice(providers)
+            available_models = [m for m in PROVIDER_MODELS[selected_provider] if fits_context(selected_provider, m, prompt_tokens)]
             random.shuffle(available_models)
-            logging.info(f"Этап: Выбран провайдер {selected_provider} с моделями {available_models}")
-            for selected_model in available_models:
-                try:
-                    start_time = time.time()
-                    logging.info(f"Этап: Запрос к модели {selected_model} провайдера {selected_provider}")
-                    response = client.chat.completions.create(
-                        model=selected_model,
-                        provider=getattr(g4f.Provider, selected_provider, None),
-                        messages=[{"role": "user", "content": prompt}],
-                        stream=False,
-                        timeout=60
-                    )
-                    if asyncio.iscoroutine(response):
-                        response = await asyncio.wait_for(response, timeout=60)
-                    if response is None or not hasattr(response, 'choices') or not response.choices:
-                        logging.info(f"Этап: Ответ от {selected_model} пустой, исключаем провайдера {selected_provider} на 30 минут")
-                        provider_failures[selected_provider] = time.time()
-                        continue
-                    response_content = response.choices[0].message.content.strip()
-                    logging.info(f"Этап: Получен ответ от {selected_model}: {response_content[:50]}...")
-                    if is_denial_response(response_content):
-                        logging.info(f"Этап: Ответ от {selected_model} содержит отказ, пробуем другую модель")
-                        continue
-                    # Сохраняем первый валидный ответ
-                    if valid_response is None:
-                        valid_response = response_content
-                        logging.info(f"Этап: Сохранён валидный ответ от {selected_model}")
-                    # Если ответ быстрый (< 55 секунд), возвращаем его сразу
-                    if time.time() - start_time <= 55:
-                        logging.info(f"Этап: Успешный быстрый ответ от {selected_model}")
-                        return response_content
-                    logging.info(f"Этап: Ответ от {selected_model} медленный, но сохранён как запасной")
-                    continue
-                except asyncio.TimeoutError:
-                    logging.info(f"Этап: Таймаут при запросе к {selected_model}, исключаем провайдера {selected_provider} на 30 минут")
-                    provider_failures[selected_provider] = time.time()
-                    continue
-                except Exception as e:
-                    logging.error(f"Этап: Ошибка при запросе к {selected_model}: {str(e)}")
-                    provider_failures[selected_provider] = time.time()
+            logging.info("Этап: Все провайдеры исключены, выбран %s", selected_provider)
+        else:
+            selected_provider, available_models = selection
+        tried_providers.add(selected_provider)
+        logging.debug("Этап: Выбран провайдер %s, моделей %s", selected_provider, len(available_models))
+        for selected_model in available_models:
+            yield selected_provider, selected_model
+
+def attempt_timeout(provider: str, model: str, kind: str) -> Tuple[float, bool]:
+    # Возвращает (таймаут, урезан ли он остатком бюджета задания). Оценка — по полным ответам
+    # на запросы того же вида: короткие вердикты "No" и досрочно прерванные потоки её не занижают
+    timeout = LLM_CALL_TIMEOUT
+    for labels in ({"provider": provider, "model": model}, {"provider": provider}):
+        count, _ = ATTEMPT_LATENCY.totals(kind=kind, **labels)
+        if count >= ATTEMPT_TIMEOUT_MIN_SAMPLES:
+            p95 = ATTEMPT_LATENCY.quantile(0.95, kind=kind, **labels)
+            timeout = min(LLM_CALL_TIMEOUT, max(MIN_ATTEMPT_TIMEOUT, ATTEMPT_TIMEOUT_FACTOR * p95))
+            break
+    remaining = remaining_budget()
+    if remaining is not None and remaining < timeout:
+        return max(remaining, 0.1), True
+    return timeout, False
+
+async def attempt_completion(client, async_client, selected_provider: str, selected_model: str, prompt: str,
+                             early_stop: bool = False, kind: str = "article"):
+    # Возвращает (ответ, длительность) для валидного ответа, иначе None.
+    # kind — вид запроса (article, batch, final), по нему выбирается история задержек для таймаута
+    bind_log_context(provider=selected_provider, model=selected_model)
+    claim_target(selected_provider, selected_model)
+    timeout, budget_limited = attempt_timeout(selected_provider, selected_model, kind)
+    start_time = time.time()
+    llm_slot_wait.set(0.0)
+    try:
+        logging.debug("Этап: Запрос к модели %s провайдера %s, таймаут %.0f с", selected_model, selected_provider, timeout)
+        response = await request_completion(
+            client, async_client, selected_provider, selected_model, prompt, timeout=timeout, early_stop=early_stop
+        )
+        start_time += llm_slot_wait.get()
+        elapsed = time.time() - start_time
+        # Время досрочно прерванного потока короче полного ответа: в оценку задержки провайдера
+        # (EWMA маршрутизатора) оно не идёт, иначе выигрывали бы провайдеры, чаще отвечающие "No"
+        latency_sample = elapsed
+        if isinstance(response, StreamedCompletion):
+            response_content = response.content.strip()
+            if response.verdict is not None:
+                latency_sample = None
+            if response.verdict == "no":
+                # Обрезанный вердикт "No" без обоснования — валидный ответ, кириллицы в нём может не быть
+                record_outcome(selected_provider, selected_model, "success", latency_sample)
+                return response_content, elapsed
+            if not response_content:
+                logging.info("Этап: Ответ от %s пустой", selected_model)
+                record_outcome(selected_provider, selected_model, "error", elapsed, "пустой ответ")
+                return None
+        elif response is None or not hasattr(response, 'choices') or not response.choices:
+            logging.info("Этап: Ответ от %s пустой", selected_model)
+            record_outcome(selected_provider, selected_model, "error", elapsed, "пустой ответ")
+            return None
+        else:
+            response_content = response.choices[0].message.content.strip()
+        logging.debug("Этап: Получен ответ от %s: %s...", selected_model, response_content[:50])
+        if is_denial_response(response_content):
+            logging.info("Этап: Ответ от %s содержит отказ, пробуем другую модель", selected_model)
+            record_outcome(selected_provider, selected_model, "denial", latency_sample)
+            return None
+        record_outcome(selected_provider, selected_model, "success", latency_sample)
+        ATTEMPT_LATENCY.observe(elapsed, provider=selected_provider, model=selected_model, kind=kind)
+        return response_content, elapsed
+    except asyncio.TimeoutError:
+        if budget_limited:
+            # Таймаут из-за исчерпанного бюджета задания — не вина провайдера
+            logging.info("Этап: Бюджет задания истёк во время запроса к %s провайдера %s", selected_model, selected_provider)
+            release_probe(selected_provider, selected_model)
+            return None
+        logging.info("Этап: Таймаут при запросе к %s провайдера %s", selected_model, selected_provider)
+        record_outcome(
+            selected_provider, selected_model, "timeout", time.time() - start_time - llm_slot_wait.get(), "таймаут"
+        )
+        return None
+    except LocalSlotTimeout as e:
+        # Перегружен местный пул потоков, провайдер ни при чём
+        logging.warning("Этап: Запрос к %s провайдера %s не отправлен: %s", selected_model, selected_provider, e)
+        release_probe(selected_provider, selected_model)
+        return None
+    except asyncio.CancelledError:
+        release_probe(selected_provider, selected_model)
+        raise
+    except Exception as e:
+        logging.error("Этап: Ошибка при запросе к %s: %s", selected_model, e)
+        if CONTEXT_ERROR.search(str(e)):
+            record_context_overflow(selected_provider, selected_model, estimate_tokens(prompt))
+        record_outcome(selected_provider, selected_model, "error", None, str(e))
+        return None
+
+def _release_hedge(_):
+    global hedge_in_flight
+    hedge_in_flight -= 1
+
+async def call_g4f_model(prompt: str, min_batch_size: int = 1, early_stop: bool = False, kind: str = "article") -> str:
+    logging.debug("Этап: Вызов модели g4f")
+    running = {}
+    try:
+        remaining = remaining_budget()
+        if remaining is not None and remaining <= 0:
+            logging.info("Этап: Бюджет времени задания исчерпан, запрос не отправлен")
+            return "Ошибка: Время на анализ истекло."
+        client, async_client = get_llm_clients()
+        prompt_tokens = estimate_tokens(prompt)
+        PROMPT_TOKENS.inc(prompt_tokens)
+        candidates = iter_candidates(min_batch_size, prompt_tokens)
+        deferred = deque()
+
+        def take_candidate(avoid_providers):
+            # Для дублирующего запроса предпочитаем провайдера, к которому ещё нет запроса в полёте
+            for i, candidate in enumerate(deferred):
+                if candidate[0] not in avoid_providers:
+                    del deferred[i]
+                    return candidate
+            for candidate in candidates:
+                if candidate[0] not in avoid_providers:
+                    return candidate
+                deferred.append(candidate)
+            return deferred.popleft() if deferred else None
+
+        def launch(is_hedge: bool) -> bool:
+            global hedge_in_flight
+            candidate = take_candidate({provider for provider, _ in running.values()})
+            if candidate is None:
+                return False
+            task = asyncio.create_task(attempt_completion(client, async_client, *candidate, prompt, early_stop, kind))
+            if is_hedge:
+                hedge_in_flight += 1
+                task.add_done_callback(_release_hedge)
+                logging.debug("Этап: Дублирующий запрос к %s/%s, в полёте %s", candidate[0], candidate[1], len(running) + 1)
+            running[task] = candidate
+            return True
+
+        def can_hedge() -> bool:
+            return len(running) < HEDGE_MAX_PER_REQUEST and hedge_in_flight < HEDGE_GLOBAL_MAX
+
+        # Сразу запускаем основной запрос и, если настроено, ещё top-K дублей
+        if not launch(is_hedge=False):
+            logging.error("Этап: Нет провайдеров для запроса")
+            return "Ошибка: Не удалось получить ответ от провайдеров."
+        for _ in range(HEDGE_TOP_K - 1):
+            if not can_hedge() or not launch(is_hedge=True):
+                break
+
+        while running:
+            # Ждём не дольше HEDGE_DELAY (для дубля) и не дольше остатка бюджета задания
+            wait_timeout = HEDGE_DELAY if can_hedge() else None
+            remaining = remaining_budget()
+            if remaining is not None:
+                if remaining <= 0:
+                    break
+                wait_timeout = remaining if wait_timeout is None else min(wait_timeout, remaining)
+            done, _ = await asyncio.wait(
+                running.keys(),
+                timeout=wait_timeout,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                # Никто не ответил за HEDGE_DELAY — дублируем запрос к другому провайдеру
+                if can_hedge() and budget_left():
+                    launch(is_hedge=True)
+                continue
+            for task in done:
+                selected_provider, selected_model = running.pop(task)
+                outcome = task.result()
+                if outcome is None:
                     continue
-        # Если есть валидный ответ, возвращаем его, даже если он медленный
-        if valid_response is not None:
-            logging.info("Этап: Возвращён сохранённый валидный ответ")
-            return valid_response
+                # Первый валидный ответ возвращается сразу: время уже потрачено, ждать другой нет смысла
+                response_content, elapsed = outcome
+                logging.debug("Этап: Валидный ответ от %s (%s) за %.1f с", selected_model, selected_provider, elapsed)
+                return response_content
+            if not running and budget_left():
+                launch(is_hedge=False)
+
+        if not budget_left():
+            logging.info("Этап: Бюджет времени задания исчерпан до получения ответа")
+            return "Ошибка: Время на анализ истекло."
         logging.error("Этап: Не удалось получить ответ от всех провайдеров")
         return "Ошибка: Не удалось получить ответ от провайдеров."
     except Exception as e:
-        logging.error(f"Этап: Общая ошибка в call_g4f_model: {str(e)}")
+        logging.error("Этап: Общая ошибка в call_g4f_model: %s", e)
         return f"Ошибка: {str(e)}"
+    finally:
+        # Проигравшие запросы отменяются
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+
+async def probe_route(client, async_client, provider_name: str, model: str, semaphore: asyncio.Semaphore):
+    # Возвращает (маршрут, None) для пригодной модели или (None, причина)
+    provider = getattr(g4f.Provider, provider_name, None)
+    if provider is None:
+        return None, "провайдер отсутствует в g4f"
+    async_ok = provider_supports_async(provider)
+    reason = "нет ответа"
+    async with semaphore:
+        # Асинхронного провайдера сначала пробуем потоком, затем обычным запросом
+        for stream in ((True, False) if async_ok else (False,)):
+            started_at = time.monotonic()
+            try:
+                response = await request_completion(
+                    client, async_client, provider_name, model, PROBE_PROMPT, timeout=PROBE_TIMEOUT, early_stop=stream
+                )
+                if isinstance(response, StreamedCompletion):
+                    content = response.content
+                else:
+                    content = response.choices[0].message.content if response and response.choices else ""
+            except Exception as e:
+                reason = str(e)[:200] or type(e).__name__
+                continue
+            latency = time.monotonic() - started_at
+            if not content or not content.strip():
+                reason = "пустой ответ"
+                continue
+            if not is_cyrillic(content) or contains_denial_phrase(content):
+                return None, "ответ не на русском или отказ"
+            stats = model_stats.get(model_key(provider_name, model))
+            return ModelRoute(
+                provider=provider_name,
+                model=model,
+                context_tokens=stats.context_limit if stats else None,
+                russian=True,
+                streaming=stream,
+                async_ok=async_ok,
+                latency=round(latency, 2)
+            ), None
+    return None, reason
+
+async def probe_routes():
+    # Обслуживание: проба каждой модели из providerslist.txt коротким промптом и запись
+    # пригодных моделей в ROUTES_FILE по возрастанию задержки
+    MODEL_ROUTES.clear()
+    candidates = usable_models(load_providers(PROVIDERS_FILE))
+    pairs = [(provider, model) for provider, models in candidates.items() for model in models]
+    logging.info("Этап: Проба %s моделей, параллельно до %s", len(pairs), PROBE_CONCURRENCY)
+    client, async_client = get_llm_clients()
+    semaphore = asyncio.Semaphore(max(1, PROBE_CONCURRENCY))
+    results = await asyncio.gather(*(
+        probe_route(client, async_client, provider, model, semaphore) for provider, model in pairs
+    ))
+    for (provider, model), (route, reason) in zip(pairs, results):
+        if route is None:
+            logging.info("Этап: Модель %s/%s отброшена: %s", provider, model, reason)
+    routes = sorted((route for route, _ in results if route is not None), key=lambda route: route.latency)
+    tmp_file = ROUTES_FILE + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump([asdict(route) for route in routes], f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, ROUTES_FILE)
+    logging.info("Этап: Таблица маршрутов записана в %s: %s из %s моделей", ROUTES_FILE, len(routes), len(pairs))
+
+class TokenBucket:
+    # Ведро токенов с резервированием: каждый вызов занимает токен и получает время ожидания,
+    # так что отправки выстраиваются в очередь в порядке вызова
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def pause(self, seconds: float):
+        # retry_after от Telegram: сдвигаем ведро так, чтобы следующий токен появился не раньше
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+chat_buckets: Dict[int, TokenBucket] = {}
+
+def chat_bucket(chat_id: int) -> TokenBucket:
+    bucket = chat_buckets.get(chat_id)
+    if bucket is None:
+        # Отрицательный id — группа или канал, у них лимит строже
+        rate = TELEGRAM_GROUP_CHAT_RATE if chat_id < 0 else TELEGRAM_PRIVATE_CHAT_RATE
+        bucket = chat_buckets[chat_id] = TokenBucket(rate, TELEGRAM_CHAT_BURST)
+    return bucket
+
+async def telegram_call(chat_id: int, method, /, *args, **kwargs):
+    # Единая точка исходящих вызовов: соблюдает лимиты и повторяет запрос после retry_after
+    for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+        delay = max(global_bucket.reserve(), chat_bucket(chat_id).reserve())
+        if delay > 0:
+            logging.debug("Этап: Ожидание лимита Telegram %.2f с для чата %s", delay, chat_id)
+            await asyncio.sleep(delay)
+        started_at = time.monotonic()
+        try:
+            return await method(*args, **kwargs)
+        except TelegramRetryAfter as e:
+            if attempt == TELEGRAM_MAX_RETRIES:
+                raise
+            logging.warning("Этап: Telegram просит подождать %s с (чат %s)", e.retry_after, chat_id)
+            chat_bucket(chat_id).pause(e.retry_after)
+        finally:
+            TELEGRAM_LATENCY.observe(time.monotonic() - started_at, method=getattr(method, "__name__", "call"))
+
+@dataclass
+class ProgressEdit:
+    bot: Bot
+    chat_id: int
+    message_id: int
+    text: Optional[str] = None
+    sent_text: Optional[str] = None
+    sent_at: float = 0.0
+    deleted: bool = False
+    # Правки отменены (сообщение получило окончательный текст) — больше ничего не отправлять
+    discarded: bool = False
+    flusher: Optional[asyncio.Task] = None
+
+progress_edits: Dict[Tuple[int, int], ProgressEdit] = {}
+
+async def _flush_progress_edit(edit: ProgressEdit):
+    try:
+        wait = PROGRESS_EDIT_INTERVAL - (time.monotonic() - edit.sent_at)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        text = edit.text
+        if text is None or text == edit.sent_text or edit.deleted or edit.discarded:
+            return
+        edit.sent_at = time.monotonic()
+        ok = await _edit_message_text(edit.bot, text, edit.chat_id, edit.message_id)
+        edit.sent_text = text
+        if not ok:
+            edit.deleted = True
+    except Exception as e:
+        logging.error("Этап: Ошибка при обновлении прогресса: %s", e)
+    finally:
+        edit.flusher = None
+        # Пока ждали, мог прийти более свежий текст; отменённую правку не возобновляем
+        current = progress_edits.get((edit.chat_id, edit.message_id)) is edit
+        if current and not edit.deleted and not edit.discarded and edit.text != edit.sent_text:
+            edit.flusher = asyncio.create_task(_flush_progress_edit(edit))
+
+def queue_progress_edit(bot: Bot, text: str, chat_id: int, message_id: int) -> bool:
+    # Правки прогресса сливаются: отправляется только последний текст не чаще PROGRESS_EDIT_INTERVAL.
+    # Возвращает False, если сообщение уже удалено
+    key = (chat_id, message_id)
+    edit = progress_edits.get(key)
+    if edit is None:
+        edit = progress_edits[key] = ProgressEdit(bot=bot, chat_id=chat_id, message_id=message_id)
+    if edit.deleted:
+        return False
+    edit.text = text
+    if edit.flusher is None:
+        edit.flusher = asyncio.create_task(_flush_progress_edit(edit))
+    return True
+
+def discard_progress_edits(chat_id: int, message_id: int):
+    edit = progress_edits.pop((chat_id, message_id), None)
+    if edit is None:
+        return
+    edit.discarded = True
+    if edit.flusher is not None:
+        edit.flusher.cancel()
 
 async def safe_reply(message: Message, text: str, **kwargs):
-    logging.info(f"Этап: Проверка возможности ответа на сообщение {message.message_id} для пользователя {message.from_user.id}")
-    
-    # Задержка 10 секунд перед началом обработки
-    logging.info(f"Этап: Задержка 10 секунд перед отправкой ответа пользователю {message.from_user.id}")
-    await asyncio.sleep(10)
-    
-    logging.info(f"Этап: Отправка ответа пользователю {message.from_user.id}")
-    try:
-        sent = await message.reply(text, **kwargs)
-        logging.info(f"Этап: Ответ успешно отправлен пользователю {message.from_user.id}")
+    logging.debug("Этап: Отправка ответа на сообщение %s пользователю %s", message.message_id, message.from_user.id)
+    try:
+        sent = await telegram_call(message.chat.id, message.reply, text, **kwargs)
+        logging.debug("Этап: Ответ успешно отправлен пользователю %s", message.from_user.id)
         
         # Проверка, реально ли это был reply
         if sent.reply_to_message is None:
-            logging.warning(f"Этап: Сообщение {message.message_id} удалено во время обработки — не получилось ответить реплаем. Удаляем.")
-            await sent.delete()
-            user_busy.pop(message.from_user.id, None)
-            if message.from_user.id in user_queue:
-                user_queue.remove(message.from_user.id)
+            logging.warning("Этап: Сообщение %s удалено во время обработки — не получилось ответить реплаем. Удаляем.", message.message_id)
+            await telegram_call(message.chat.id, sent.delete)
+            cancel_user_job(message.from_user.id)
             return None
         else:
-            logging.info(f"Этап: Ответили реплаем на {message.message_id}")
+            logging.debug("Этап: Ответили реплаем на %s", message.message_id)
             return sent
     except TelegramBadRequest as e:
         if "REPLY_MESSAGE_NOT_FOUND" in str(e).lower():
-            logging.info(f"Этап: Сообщение удалено, освобождаем пользователя {message.from_user.id}")
-            user_busy.pop(message.from_user.id, None)
-            if message.from_user.id in user_queue:
-                user_queue.remove(message.from_user.id)
+            logging.info("Этап: Сообщение удалено, освобождаем пользователя %s", message.from_user.id)
+            cancel_user_job(message.from_user.id)
             return None
-        logging.error(f"Этап: Ошибка при отправке ответа: {str(e)}")
+        logging.error("Этап: Ошибка при отправке ответа: %s", e)
         raise
 
 async def safe_answer(message: Message, text: str, **kwargs):
-    logging.info(f"Этап: Отправка сообщения пользователю {message.from_user.id}")
+    logging.debug("Этап: Отправка сообщения пользователю %s", message.from_user.id)
     try:
-        response = await message.answer(text, **kwargs)
-        logging.info(f"Этап: Сообщение успешно отправлено пользователю {message.from_user.id}")
+        response = await telegram_call(message.chat.id, message.answer, text, **kwargs)
+        logging.debug("Этап: Сообщение успешно отправлено пользователю %s", message.from_user.id)
         return response
     except TelegramBadRequest as e:
         if "message to be replied not found" in str(e).lower():
-            logging.info(f"Этап: Сообщение для ответа не найдено, отправляем без reply_to")
+            logging.info("Этап: Сообщение для ответа не найдено, отправляем без reply_to")
             kwargs.pop("reply_to_message_id", None)
-            response = await message.answer(text, **kwargs)
-            logging.info(f"Этап: Сообщение отправлено без reply_to")
+            response = await telegram_call(message.chat.id, message.answer, text, **kwargs)
+            logging.info("Этап: Сообщение отправлено без reply_to")
             return response
-        logging.error(f"Этап: Ошибка при отправке сообщения: {str(e)}")
+        logging.error("Этап: Ошибка при отправке сообщения: %s", e)
         raise
 
 async def safe_edit_message_text(bot: Bot, text: str, chat_id: int, message_id: int):
-    logging.info(f"Этап: Редактирование сообщения {message_id} в чате {chat_id}")
+    # Немедленная правка; отложенные правки прогресса этого сообщения отменяются, чтобы не затереть текст
+    discard_progress_edits(chat_id, message_id)
+    return await _edit_message_text(bot, text, chat_id, message_id)
+
+async def _edit_message_text(bot: Bot, text: str, chat_id: int, message_id: int):
+    logging.debug("Этап: Редактирование сообщения %s в чате %s", message_id, chat_id)
     try:
-        await bot.edit_message_text(
+        await telegram_call(
+            chat_id,
+            bot.edit_message_text,
             text=text,
             chat_id=chat_id,
             message_id=message_id
         )
-        logging.info(f"Этап: Сообщение {message_id} успешно отредактировано")
+        logging.debug("Этап: Сообщение %s успешно отредактировано", message_id)
         return True
     except TelegramBadRequest as e:
         if "MESSAGE_ID_INVALID" in str(e) or "message to edit not found" in str(e).lower():
-            logging.info(f"Этап: Сообщение {message_id} не найдено для редактирования")
+            logging.info("Этап: Сообщение %s не найдено для редактирования", message_id)
             return False
-        logging.error(f"Этап: Ошибка при редактировании сообщения: {str(e)}")
+        logging.error("Этап: Ошибка при редактировании сообщения: %s", e)
         raise
 
-async def analyze_article(client, text, article_number, article_content, prompt_template):
-    logging.info(f"Этап: Анализ статьи {article_number}")
+# Реестр file_id статичных файлов: ключ — id бота и имя файла (file_id действителен только для своего бота),
+# вместе с file_id хранится отпечаток файла (размер, время изменения)
+asset_file_ids: Dict[str, dict] = {}
+
+def load_asset_file_ids():
+    try:
+        with open(ASSET_FILE_IDS_FILE, "r", encoding="utf-8") as f:
+            asset_file_ids.update(json.load(f))
+        logging.info("Этап: Загружено %s сохранённых file_id", len(asset_file_ids))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.error("Этап: Ошибка при чтении %s: %s", ASSET_FILE_IDS_FILE, e)
+
+def save_asset_file_ids(key: str):
+    # Файл общий для процессов-воркеров: дописываем только свою запись поверх того, что на диске
+    data = read_json_file(ASSET_FILE_IDS_FILE)
+    data[key] = asset_file_ids[key]
+    asset_file_ids.update(data)
+    write_json_file(ASSET_FILE_IDS_FILE, data)
+
+async def send_asset(bot: Bot, message: Message, method_name: str, filename: str, **kwargs) -> bool:
+    # Отправка статичного файла методом answer_photo / answer_document: по сохранённому file_id,
+    # а если файла ещё не было, он изменился или Telegram не узнал file_id — загрузкой с диска.
+    # Возвращает False, если файла нет
+    file_path = os.path.join(BASE_DIR, filename)
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return False
+    fingerprint = [stat.st_size, stat.st_mtime_ns]
+    key = f"{bot.id}:{filename}"
+    method = getattr(message, method_name)
+    entry = asset_file_ids.get(key)
+    if entry is not None and entry.get("fingerprint") == fingerprint:
+        try:
+            await telegram_call(message.chat.id, method, entry["file_id"], **kwargs)
+            return True
+        except TelegramBadRequest as e:
+            logging.warning("Этап: file_id файла %s не принят (%s), загружаем заново", filename, e)
+    logging.info("Этап: Загрузка файла %s в Telegram", filename)
+    sent = await telegram_call(message.chat.id, method, FSInputFile(file_path, filename=filename), **kwargs)
+    uploaded = sent.photo[-1] if sent.photo else sent.document
+    asset_file_ids[key] = {"file_id": uploaded.file_id, "fingerprint": fingerprint}
+    save_asset_file_ids(key)
+    return True
+
+load_asset_file_ids()
+
+def is_error_verdict(result: str) -> bool:
+    return "\nОшибка" in result
+
+def article_local_verdict(text, article_number, article_content, prompt_template, prefilter_score=None):
+    # Вердикт без обращения к провайдеру: отсев предотбором или попадание в кэш
+    would_skip = prefilter_score is not None and prefilter_score < PREFILTER_THRESHOLD
+    if prefilter_score is not None:
+        prefilter_counters["screened"] += 1
+    if would_skip and PREFILTER_MODE == "on":
+        prefilter_counters["skipped"] += 1
+        logging.debug("Этап: Статья %s отсеяна предотбором (оценка %.1f)", article_number, prefilter_score)
+        return f"Article {article_number}:\nApplicability: No\n"
+    cached = cache_get(verdict_cache_key("article", text, prompt_template, article_number, article_content))
+    if cached is not None:
+        return f"Article {article_number}:\n{cached}\n"
+    return None
+
+async def analyze_article(client, text, article_number, article_content, prompt_template, prefilter_score=None):
+    bind_log_context(article=article_number)
+    logging.debug("Этап: Анализ статьи %s", article_number)
     try:
         if article_content.startswith("Ошибка"):
-            logging.info(f"Этап: Статья {article_number} содержит ошибку: {article_content}")
+            logging.info("Этап: Статья %s содержит ошибку: %s", article_number, article_content)
             return f"Article {article_number}:\n{article_content}\n"
+        local = article_local_verdict(text, article_number, article_content, prompt_template, prefilter_score)
+        if local is not None:
+            return local
         prompt = prompt_template.format(
             article_content=article_content,
             user_input=text
         )
-        logging.info(f"Этап: Сформирован промпт для статьи {article_number}")
-        result = await call_g4f_model(prompt)
-        logging.info(f"Этап: Получен результат анализа статьи {article_number}: {result[:50]}...")
+        logging.debug("Этап: Сформирован промпт для статьи %s", article_number)
+        started_at = time.monotonic()
+        result = await call_g4f_model(prompt, early_stop=STREAM_EARLY_STOP)
+        ARTICLE_LATENCY.observe(time.monotonic() - started_at)
+        cache_put(verdict_cache_key("article", text, prompt_template, article_number, article_content), result)
+        logging.debug("Этап: Получен результат анализа статьи %s: %s...", article_number, result[:50])
+        if PREFILTER_MODE == "audit" and prefilter_score is not None:
+            would_skip = prefilter_score < PREFILTER_THRESHOLD
+            record_prefilter_audit(article_number, would_skip, "Applicability: Yes" in result, prefilter_score)
         return f"Article {article_number}:\n{result}\n"
     except Exception as e:
-        logging.error(f"Этап: Ошибка при анализе статьи {article_number}: {str(e)}")
+        logging.error("Этап: Ошибка при анализе статьи %s: %s", article_number, e)
         return f"Article {article_number}:\nОшибка: {str(e)}\n"
 
+BATCH_BLOCK_HEADER = re.compile(r"^[\s#=*\-]*(?:Article|Статья)\s+(\d+(?:\.\d+)?)[\s.:=*\-]*$", re.MULTILINE | re.IGNORECASE)
+# Модели часто выделяют вердикт жирным: "**Applicability: Yes**", "**Applicability:** Yes" — звёздочки
+# вокруг строки поглощаются, чтобы в отчёте осталась чистая "Applicability: Yes"
+BATCH_APPLICABILITY = re.compile(r"\**\s*Applicability\s*\**\s*:\s*\**\s*(Yes|No)\b\**", re.IGNORECASE)
+
+def parse_batch_verdicts(response: str, article_numbers) -> Dict[str, str]:
+    # Разбирает ответ на блоки "=== Article N ===", принимает только блоки со строкой Applicability
+    headers = list(BATCH_BLOCK_HEADER.finditer(response))
+    verdicts: Dict[str, str] = {}
+    for i, header in enumerate(headers):
+        number = header.group(1)
+        if number not in article_numbers or number in verdicts:
+            continue
+        end = headers[i + 1].start() if i + 1 < len(headers) else len(response)
+        block = response[header.end():end].strip()
+        applicability = BATCH_APPLICABILITY.search(block)
+        if not applicability:
+            continue
+        # Приводим строку к виду, который ищет analyze_text
+        block = block[:applicability.start()] + f"Applicability: {applicability.group(1).capitalize()}" + block[applicability.end():]
+        verdicts[number] = block
+    return verdicts
+
+def batch_article_block(number: str, content: str) -> str:
+    return f"--- Статья {number} ---\n{content}\n"
+
+def plan_batch_size(text: str, pending_articles, batch_prompt_template: str) -> int:
+    # Сколько статей из начала pending_articles отправить одним пакетом: не больше лимита провайдера,
+    # которого сейчас выбрал бы маршрутизатор, и столько, сколько помещается в контекст его моделей
+    selection = select_targets()
+    if selection is None:
+        # Все автоматы разомкнуты — запрос уйдёт случайному провайдеру, берём наибольший лимит
+        limits = [provider_batch_limit(p) for p in PROVIDER_MODELS] or [1]
+        return min(len(pending_articles), max(limits))
+    provider, models = selection
+    budgets = [context_budget(provider, model) for model in models]
+    budget = None if None in budgets else max(budgets)
+    tokens = estimate_tokens(batch_prompt_template.format(articles_block="", user_input=text))
+    size = 0
+    for number, content in pending_articles[:provider_batch_limit(provider)]:
+        tokens += estimate_tokens(batch_article_block(number, content))
+        if size and budget is not None and tokens > budget:
+            break
+        size += 1
+    return max(1, size)
+
+async def analyze_article_batch(text, batch, prompt_template, batch_prompt_template) -> Dict[str, str]:
+    # batch — список (номер, текст статьи); возвращает результаты только для разобранных статей
+    numbers = [number for number, _ in batch]
+    bind_log_context(article=",".join(numbers))
+    logging.info("Этап: Пакетный анализ статей %s", numbers)
+    articles_block = "\n".join(batch_article_block(number, content) for number, content in batch)
+    prompt = batch_prompt_template.format(articles_block=articles_block, user_input=text)
+    try:
+        response = await call_g4f_model(prompt, min_batch_size=len(batch), kind="batch")
+    except Exception as e:
+        logging.error("Этап: Ошибка пакетного анализа %s: %s", numbers, e)
+        return {}
+    verdicts = parse_batch_verdicts(response, numbers)
+    missing = [number for number in numbers if number not in verdicts]
+    if missing:
+        logging.info("Этап: В пакетном ответе нет вердиктов по статьям %s, они будут проверены поштучно", missing)
+    results = {}
+    for number, content in batch:
+        if number in verdicts:
+            cache_put(verdict_cache_key("article", text, prompt_template, number, content), verdicts[number])
+            results[number] = f"Article {number}:\n{verdicts[number]}\n"
+    return results
+
+PROMPT2_FALLBACK = "Добрый день! Следователь сейчас занят, но заключение экспертизы уже готово. Ознакомьтесь с ним во вложении."
+
 async def process_report_with_prompt2(report: str) -> str:
-    prompt2_file = os.path.join(BASE_DIR, "prompt2.txt")
-    logging.info(f"Этап: Чтение prompt2 из файла {prompt2_file}")
-    prompt2_template = read_file(prompt2_file)
-    if "Ошибка" in prompt2_template:
-        logging.error(f"Этап: Ошибка в prompt2: {prompt2_template}")
-        return prompt2_template
+    bind_log_context(article="report")
+    config = get_config()
+    if config is None:
+        logging.error("Этап: Ошибка в prompt2: %s", config_error)
+        return config_error
+    prompt2_template = config.prompt2_template
     prompt = prompt2_template.format(report_content=report)
-    logging.info("Этап: Сформирован промпт для обработки отчёта")
-    result = await call_g4f_model(prompt)
-    logging.info(f"Этап: Получен результат обработки отчёта: {result[:50]}...")
+    logging.debug("Этап: Сформирован промпт для обработки отчёта")
+    cache_key = verdict_cache_key("report", report, prompt2_template)
+    result = cache_get(cache_key)
+    if result is None:
+        started_at = time.monotonic()
+        result = await call_g4f_model(prompt, kind="final")
+        PROMPT2_LATENCY.observe(time.monotonic() - started_at)
+        cache_put(cache_key, result)
+    logging.debug("Этап: Получен результат обработки отчёта: %s...", result[:50])
     return result
 
 def clean_report(report: str) -> str:
-    logging.info("Этап: Очистка отчёта")
+    logging.debug("Этап: Очистка отчёта")
     # Удаляем markdown-блоки
     lines = report.split('\n')
     cleaned_lines = [line for line in lines if line.strip() not in ["```markdown", "```"]]
@@ -314,128 +2555,426 @@ def clean_report(report: str) -> str:
     sponsor_trigger = re.search(r"\n*[-]{3,}\s*\n*\s*\*\*Sponsor\*\*", cleaned_text, re.IGNORECASE)
     if sponsor_trigger:
         cleaned_text = cleaned_text[:sponsor_trigger.start()].rstrip()
-    logging.info("Этап: Отчёт успешно очищен")
+    logging.debug("Этап: Отчёт успешно очищен")
     return cleaned_text
 
-async def analyze_text(text, prompt_template, articles, message: Message, bot: Bot):
-    logging.info(f"Этап: Начало анализа текста для пользователя {message.from_user.id}")
-    if len(text) > 2000:
-        logging.info(f"Этап: Текст слишком длинный (>2000 символов), пользователь {message.from_user.id}")
-        await safe_reply(message, "Извините, мы не принимаем тексты длиннее 2000 символов.")
+def spool_report(report_id: str, report_data: bytes):
+    # Выполняется в пуле потоков: сохраняет отчёт под именем задания и чистит старые файлы
+    try:
+        os.makedirs(REPORT_SPOOL_DIR, exist_ok=True)
+        report_file = os.path.join(REPORT_SPOOL_DIR, f"report_{report_id}.txt")
+        with open(report_file, "wb") as f:
+            f.write(report_data)
+        logging.info("Этап: Отчёт сохранён в архив %s", report_file)
+        now = time.time()
+        reports = sorted(
+            (entry for entry in os.scandir(REPORT_SPOOL_DIR) if entry.name.startswith("report_") and entry.is_file()),
+            key=lambda entry: entry.stat().st_mtime,
+            reverse=True
+        )
+        for i, entry in enumerate(reports):
+            if i >= REPORT_SPOOL_MAX_FILES or now - entry.stat().st_mtime > REPORT_SPOOL_MAX_AGE:
+                os.remove(entry.path)
+    except Exception as e:
+        logging.error("Этап: Ошибка при сохранении отчёта в архив: %s", e)
+
+SENTENCE_END = re.compile(r"(?<=[.!?…])\s+|\n+")
+# Окна, израсходованные пользователем за последний час (время начала каждого задания и число окон)
+user_window_usage: Dict[int, deque] = {}
+
+def split_text_windows(text: str, size: int = TEXT_WINDOW_SIZE, overlap: int = TEXT_WINDOW_OVERLAP) -> list:
+    # Окна собираются из целых предложений; следующее окно начинается с хвоста предыдущего
+    # длиной до overlap символов, чтобы фраза на границе попала в анализ целиком. Каждое окно стоит
+    # полного набора запросов по статьям, поэтому короткий остаток (меньше overlap) дописывается
+    # к предыдущему окну, а не становится отдельным
+    if len(text) <= size:
+        return [text]
+    sentences = []
+    for sentence in SENTENCE_END.split(text):
+        sentence = sentence.strip()
+        # Предложение длиннее окна режется по словам, соседние куски перекрываются на overlap символов
+        while len(sentence) > size:
+            cut = sentence.rfind(" ", 0, size)
+            cut = cut if cut > 0 else size
+            if len(sentence) - cut < overlap:
+                break
+            sentences.append(sentence[:cut])
+            start = cut - min(overlap, cut // 2)
+            space = sentence.find(" ", start, cut)
+            sentence = sentence[start if space == -1 else space:].strip()
+        if sentence:
+            sentences.append(sentence)
+    windows = []
+    current = []
+    # Сколько предложений в начале current повторяют хвост предыдущего окна
+    carried = 0
+    for sentence in sentences:
+        if current and len(" ".join(current + [sentence])) > size:
+            windows.append(" ".join(current))
+            tail = []
+            for previous in reversed(current):
+                if len(" ".join([previous] + tail + [sentence])) > min(overlap + len(sentence), size):
+                    break
+                tail.insert(0, previous)
+            current = tail
+            carried = len(tail)
+        current.append(sentence)
+    added = " ".join(current[carried:])
+    if windows and len(added) < overlap:
+        windows[-1] += " " + added
+    elif current:
+        windows.append(" ".join(current))
+    return windows
+
+def charge_user_windows(user_id: int, windows: int) -> bool:
+    # Скользящее окно в час: задание не запускается, если превысит лимит пользователя
+    if USER_WINDOWS_PER_HOUR <= 0:
+        return True
+    now = time.monotonic()
+    usage = user_window_usage.setdefault(user_id, deque())
+    while usage and usage[0][0] < now - 3600:
+        usage.popleft()
+    if sum(count for _, count in usage) + windows > USER_WINDOWS_PER_HOUR:
+        return False
+    usage.append((now, windows))
+    return True
+
+def merge_window_verdicts(article_number, verdicts: list) -> str:
+    # Статья применима, если применима хотя бы к одному окну; обоснования окон собираются вместе
+    positive = [verdict for verdict in verdicts if "Applicability: Yes" in verdict]
+    if not positive:
+        return verdicts[0]
+    if len(positive) == 1:
+        return positive[0]
+    header = f"Article {article_number}:"
+    fragments = [
+        f"Фрагмент {i}:\n" + verdict.replace(header, "", 1).replace("Applicability: Yes", "", 1).strip()
+        for i, verdict in enumerate(positive, 1)
+    ]
+    return f"{header}\nApplicability: Yes\n" + "\n".join(fragments) + "\n"
+
+# Одинаковые тексты, отправленные одновременно разными пользователями, анализируются один раз:
+# ключ — нормализованный текст, версия конфигурации, промпт и режим анализа
+@dataclass
+class AnalysisSubscriber:
+    message: Message
+    bot: Bot
+    progress_message_id: int
+    # Задание подписчика: контрольные точки общего анализа пишутся под задания всех подписчиков,
+    # чтобы отмена одного не удаляла их у остальных
+    job_id: Optional[str] = None
+
+@dataclass
+class SharedAnalysis:
+    key: str
+    task: Optional[asyncio.Task] = None
+    subscribers: List[AnalysisSubscriber] = field(default_factory=list)
+    status: str = "Производится лингвистическая экспертиза: [          ] 0%"
+
+shared_analyses: Dict[str, SharedAnalysis] = {}
+
+def shared_analysis_key(text: str, prompt_template: str) -> str:
+    config = get_config()
+    version = config.version if config is not None else ""
+    return content_hash("\n".join((normalize_text(text), version, ANALYSIS_MODE, content_hash(prompt_template))))
+
+def forget_shared_analysis(shared: SharedAnalysis):
+    if shared_analyses.get(shared.key) is shared:
+        del shared_analyses[shared.key]
+
+def notify_subscribers(shared: SharedAnalysis, text: str) -> bool:
+    # Прогресс уходит каждому подписчику в его собственное сообщение. Удаливший сообщение
+    # выбывает (его задание отменяется), анализ продолжается, пока остаётся хотя бы один
+    shared.status = text
+    for subscriber in list(shared.subscribers):
+        chat_id = subscriber.message.chat.id
+        if queue_progress_edit(bot=subscriber.bot, text=text, chat_id=chat_id, message_id=subscriber.progress_message_id):
+            continue
+        logging.info("Этап: Сообщение удалено, анализ прерван для %s", subscriber.message.from_user.id)
+        discard_progress_edits(chat_id, subscriber.progress_message_id)
+        if subscriber in shared.subscribers:
+            shared.subscribers.remove(subscriber)
+        cancel_user_job(subscriber.message.from_user.id)
+    return bool(shared.subscribers)
+
+async def edit_subscribers(shared: SharedAnalysis, text: str):
+    shared.status = text
+    for subscriber in list(shared.subscribers):
+        discard_progress_edits(subscriber.message.chat.id, subscriber.progress_message_id)
+    await asyncio.gather(*(
+        safe_edit_message_text(
+            bot=subscriber.bot,
+            text=text,
+            chat_id=subscriber.message.chat.id,
+            message_id=subscriber.progress_message_id
+        )
+        for subscriber in list(shared.subscribers)
+    ))
+
+async def analyze_text(text, prompt_template, articles, message: Message, bot: Bot, explicit: bool = True):
+    # explicit — пользователь сам попросил проверку (/analyze или личный чат). Пассивные сообщения
+    # из групп лимит окон не расходуют, а отказы по ним в группу не пишутся
+    logging.info("Этап: Начало анализа текста для пользователя %s", message.from_user.id)
+    windows = split_text_windows(text)
+    if len(windows) > MAX_WINDOWS_PER_JOB:
+        logging.info("Этап: Текст слишком длинный (%s окон), пользователь %s", len(windows), message.from_user.id)
+        if explicit:
+            await safe_reply(message, "Извините, мы не принимаем тексты такой длины. Сократите текст и отправьте снова.")
+        return None
+    key = shared_analysis_key(text, prompt_template)
+    shared = shared_analyses.get(key)
+    # Присоединение к уже идущему анализу лимит окон не расходует: провайдеры повторно не вызываются
+    if explicit and shared is None and not charge_user_windows(message.from_user.id, len(windows)):
+        logging.info("Этап: Пользователь %s исчерпал лимит окон в час", message.from_user.id)
+        await safe_reply(message, "Гражданин, за последний час вы уже достаточно наговорили. Приходите позже.")
         return None
 
-    progress_message = await safe_reply(message, "Производится лингвистическая экспертиза: [          ] 0%")
+    status = shared.status if shared is not None else "Производится лингвистическая экспертиза: [          ] 0%"
+    progress_message = await safe_reply(message, status)
     if not progress_message:
-        logging.info(f"Этап: Сообщение удалено, анализ прерван для {message.from_user.id}")
+        logging.info("Этап: Сообщение удалено, анализ прерван для %s", message.from_user.id)
         return None
 
-    client = Client()
-    results = []
-    total_articles = len([a for a in articles if not articles[a].startswith("Ошибка")])
-    completed = 0
-    logging.info(f"Этап: Начало анализа {total_articles} статей")
+    subscriber = AnalysisSubscriber(
+        message=message, bot=bot, progress_message_id=progress_message.message_id, job_id=current_job_id.get()
+    )
+    # Пока отправлялось сообщение, общий анализ мог начаться или закончиться
+    shared = shared_analyses.get(key)
+    if shared is None:
+        shared = SharedAnalysis(key=key)
+        shared_analyses[key] = shared
+        # Задача наследует контекст первого подписчика: срок задания и контрольные точки его job_id для чтения
+        shared.task = asyncio.create_task(run_shared_analysis(shared, text, windows, prompt_template, articles))
+        shared.task.add_done_callback(lambda _: forget_shared_analysis(shared))
+    else:
+        logging.info("Этап: Пользователь %s присоединён к идущему анализу %s", message.from_user.id, key[:12])
+        SINGLEFLIGHT_JOINS.inc()
+        if shared.subscribers:
+            job_store_copy_checkpoints(shared.subscribers[0].job_id, subscriber.job_id)
+        if shared.status != status:
+            queue_progress_edit(
+                bot=bot, text=shared.status, chat_id=message.chat.id, message_id=progress_message.message_id
+            )
+    shared.subscribers.append(subscriber)
+    try:
+        # shield: отмена одного подписчика не отменяет анализ, которого ждут остальные
+        return await asyncio.shield(shared.task)
+    except asyncio.CancelledError:
+        discard_progress_edits(message.chat.id, progress_message.message_id)
+        raise
+    finally:
+        if subscriber in shared.subscribers:
+            shared.subscribers.remove(subscriber)
+        if not shared.subscribers and not shared.task.done():
+            logging.info("Этап: У анализа %s не осталось подписчиков, анализ отменён", key[:12])
+            shared.task.cancel()
 
+async def analyze_windows(windows, prompt_template, articles, on_progress=None, semaphore=None, checkpoint_owners=None):
+    # Анализ текста, разбитого на окна, по всем статьям: возвращает итоговые вердикты по статьям,
+    # число непроверенных частей и их общее число. on_progress(completed, total) -> False прерывает анализ.
+    # semaphore — общий предел запросов на несколько анализов (batch.py), иначе ARTICLE_CONCURRENCY на задание.
+    # checkpoint_owners() — задания, под которыми сохранять контрольные точки (по умолчанию текущее)
+    client, _ = get_llm_clients()
+    eligible = []
     for article_number, article_content in articles.items():
         if article_content.startswith("Ошибка"):
-            completed += 1
-            logging.info(f"Этап: Пропущена статья {article_number} из-за ошибки")
-        else:
-            result = await analyze_article(client, text, article_number, article_content, prompt_template)
-            if "Applicability: Yes" in result:
-                results.append(result)
-            completed += 1
-            progress = int((completed / total_articles) * 100)
-            filled = int(progress / 10)
-            bar = "█" * filled + " " * (10 - filled)
-            logging.info(f"Этап: Прогресс анализа: {progress}%")
-            ok = await safe_edit_message_text(
-                bot=bot,
-                text=f"Анализ: [{bar}] {progress}%",
-                chat_id=message.chat.id,
-                message_id=progress_message.message_id
+            logging.info("Этап: Пропущена статья %s из-за ошибки", article_number)
+            continue
+        eligible.append((article_number, article_content))
+    contents = dict(eligible)
+    total_units = len(eligible) * len(windows)
+    logging.info(
+        "Этап: Начало анализа %s статей в %s окнах, параллельно до %s", len(eligible), len(windows), ARTICLE_CONCURRENCY
+    )
+
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(max(1, ARTICLE_CONCURRENCY))
+    # Анализ статей укладывается в срок задания за вычетом запаса на финальный ответ
+    if job_deadline.get() is None:
+        job_deadline.set(time.monotonic() + JOB_DEADLINE)
+    articles_deadline = job_deadline.get() - PROMPT2_RESERVE
+    window_scores = None
+    config = get_config()
+    if PREFILTER_MODE in ("on", "audit") and config is not None:
+        window_scores = [prefilter_scores(window, config.prefilter_index) for window in windows]
+        logging.debug("Этап: Оценки предотбора: %s", window_scores)
+
+    def score(article_number, window_index):
+        return window_scores[window_index].get(article_number, 0.0) if window_scores is not None else None
+
+    def unit_key(article_number, window_index):
+        # Ключ контрольной точки: для одного окна — просто номер статьи
+        return article_number if len(windows) == 1 else f"{article_number}#{window_index}"
+
+    async def run_article(article_number, article_content, window_index):
+        job_deadline.set(articles_deadline)
+        async with semaphore:
+            return [((article_number, window_index), await analyze_article(
+                client, windows[window_index], article_number, article_content, prompt_template,
+                prefilter_score=score(article_number, window_index)
+            ))]
+
+    async def run_batch(batch, window_index):
+        # Статьи, которых нет в пакетном ответе, возвращаются с None и уходят в поштучный анализ
+        job_deadline.set(articles_deadline)
+        async with semaphore:
+            verdicts = await analyze_article_batch(
+                windows[window_index], batch, prompt_template, config.batch_prompt_template
+            )
+        return [((number, window_index), verdicts.get(number)) for number, _ in batch]
+
+    # Результаты по (статья, окно) собираются по мере готовности, в отчёт идут в порядке статей.
+    # Части с контрольной точкой (задание восстановлено после сбоя) повторно не анализируются
+    job_id = current_job_id.get()
+    checkpoints = job_store_checkpoints(job_id)
+    window_results = {}
+    remaining = []
+    for window_index in range(len(windows)):
+        for article_number, article_content in eligible:
+            key = unit_key(article_number, window_index)
+            if key in checkpoints:
+                window_results[(article_number, window_index)] = checkpoints[key]
+            else:
+                remaining.append((article_number, article_content, window_index))
+    if window_results:
+        logging.info("Этап: Восстановлено %s готовых результатов задания %s", len(window_results), job_id)
+
+    tasks = []
+    if ANALYSIS_MODE == "batch" and config is not None and config.batch_prompt_template:
+        for window_index in range(len(windows)):
+            pending_articles = []
+            for article_number, article_content, unit_window in remaining:
+                if unit_window != window_index:
+                    continue
+                local = article_local_verdict(
+                    windows[window_index], article_number, article_content, prompt_template,
+                    score(article_number, window_index)
+                )
+                if local is not None:
+                    window_results[(article_number, window_index)] = local
+                else:
+                    pending_articles.append((article_number, article_content))
+            while pending_articles:
+                size = plan_batch_size(windows[window_index], pending_articles, config.batch_prompt_template)
+                tasks.append(asyncio.create_task(run_batch(pending_articles[:size], window_index)))
+                pending_articles = pending_articles[size:]
+    else:
+        for article_number, article_content, window_index in remaining:
+            tasks.append(asyncio.create_task(run_article(article_number, article_content, window_index)))
+    completed = len(window_results)
+
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, timeout=max(0.0, articles_deadline - time.monotonic()), return_when=asyncio.FIRST_COMPLETED
             )
-            if not ok:
-                logging.info(f"Этап: Сообщение удалено, анализ прерван для {message.from_user.id}")
-                user_busy.pop(message.from_user.id, None)
-                if message.from_user.id in user_queue:
-                    user_queue.remove(message.from_user.id)
+            if not done:
+                logging.info("Этап: Срок анализа статей истёк, незавершённых задач: %s", len(pending))
+                break
+            for task in done:
+                for (article_number, window_index), result in task.result():
+                    if result is None:
+                        fallback = asyncio.create_task(
+                            run_article(article_number, contents[article_number], window_index)
+                        )
+                        tasks.append(fallback)
+                        pending.add(fallback)
+                        continue
+                    window_results[(article_number, window_index)] = result
+                    if not is_error_verdict(result):
+                        for owner in (checkpoint_owners() if checkpoint_owners is not None else [job_id]):
+                            job_store_checkpoint(owner, unit_key(article_number, window_index), result)
+                    completed += 1
+            if on_progress is not None and not on_progress(completed, total_units):
                 return None
+    finally:
+        # Отменяем незавершённые анализы статей (удаление сообщения, ошибка, отмена задачи)
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
-    logging.info("Этап: Анализ завершён")
-    await safe_edit_message_text(
-        bot=bot,
-        text="Экспертиза завешена: [██████████] 100%",
-        chat_id=message.chat.id,
-        message_id=progress_message.message_id
+    article_results = {}
+    for article_number, _ in eligible:
+        verdicts = [
+            window_results[(article_number, window_index)]
+            for window_index in range(len(windows))
+            if (article_number, window_index) in window_results
+        ]
+        if verdicts:
+            article_results[article_number] = merge_window_verdicts(article_number, verdicts)
+    # Непроверенные части (истёк срок или все провайдеры ответили ошибкой) — отчёт будет частичным
+    unchecked = total_units - sum(1 for result in window_results.values() if not is_error_verdict(result))
+    if unchecked:
+        logging.info("Этап: Экспертиза неполная, не проверено %s из %s", unchecked, total_units)
+    return article_results, unchecked, total_units
+
+async def run_shared_analysis(shared: SharedAnalysis, text, windows, prompt_template, articles):
+    def on_progress(completed, total_units):
+        progress = int((completed / max(1, total_units)) * 100)
+        filled = int(progress / 10)
+        bar = "█" * filled + " " * (10 - filled)
+        logging.debug("Этап: Прогресс анализа: %s%%", progress)
+        if notify_subscribers(shared, f"Анализ: [{bar}] {progress}%"):
+            return True
+        logging.info("Этап: Все подписчики удалили сообщения, анализ %s прерван", shared.key[:12])
+        return False
+
+    analysis = await analyze_windows(
+        windows, prompt_template, articles, on_progress,
+        checkpoint_owners=lambda: [subscriber.job_id for subscriber in shared.subscribers]
     )
+    if analysis is None:
+        return None
+    article_results, unchecked, total_units = analysis
+    results = [
+        article_results[article_number]
+        for article_number in articles
+        if article_number in article_results and "Applicability: Yes" in article_results[article_number]
+    ]
+
+    logging.info("Этап: Анализ завершён")
+    await edit_subscribers(shared, "Экспертиза завешена: [██████████] 100%")
     await asyncio.sleep(0.5)
-    await safe_edit_message_text(
-        bot=bot,
-        text="Ожидайте ответа вашего следователя...",
-        chat_id=message.chat.id,
-        message_id=progress_message.message_id
-    )
+    await edit_subscribers(shared, "Ожидайте ответа вашего следователя...")
 
     if not results:
         logging.info("Этап: Состав преступления не обнаружен")
+        if unchecked:
+            return (
+                "Состава преступления не обнаружено, но экспертиза проведена не полностью "
+                f"(не проверено {unchecked} из {total_units}). Это еще ничего не значит."
+            )
         return "Состава преступления не обнаружено. Но это еще ничего не значит."
 
     report = "\n".join(results)
     logging.info("Этап: Формирование отчёта")
     cleaned_report = clean_report(report)
     report_id = str(uuid.uuid4())
-    report_file = os.path.join(BASE_DIR, "report.txt")
-    with open(report_file, "w", encoding="utf-8") as f:
-        f.write(cleaned_report)
-    logging.info(f"Этап: Отчёт сохранён в файл {report_file}")
+    # Отчёт живёт в памяти задания и отправляется прямо из буфера
+    report_text = cleaned_report
+    if unchecked:
+        report_text += f"\n\nЭкспертиза проведена не полностью: не проверено {unchecked} из {total_units}."
+    report_data = report_text.encode("utf-8")
+    if REPORT_SPOOL_DIR:
+        asyncio.get_running_loop().run_in_executor(None, spool_report, report_id, report_data)
 
     final_response = await process_report_with_prompt2(cleaned_report)
+    if final_response.startswith("Ошибка"):
+        # Следователь не успел или не ответил — отдаём заключение экспертизы без его речи
+        logging.info("Этап: Финальный ответ не получен (%s), отправляется только отчёт", final_response)
+        final_response = PROMPT2_FALLBACK
     logging.info("Этап: Получен финальный ответ после обработки отчёта")
-    return final_response, report_file, report_id
-
-async def start_command(message: Message):
-    logging.info(f"Этап: Обработка команды /start для пользователя {message.from_user.id}")
-    await safe_answer(
-        message,
-        "Здравствуйте! Хорошо, что вы к нам вовремя обратились. Расскажите же нам скорее все,",
-        reply_to_message_id=message.message_id
-    )
-
-async def analyze_command(message: Message, bot: Bot):
-    logging.info(f"Этап: Обработка команды /analyze для пользователя {message.from_user.id}")
-    prompt_file = os.path.join(BASE_DIR, "prompt.txt")
-    prompt_template = read_file(prompt_file)
-    if "Ошибка" in prompt_template:
-        logging.error(f"Этап: Ошибка в prompt: {prompt_template}")
-        await safe_reply(message, prompt_template)
-        return
-
-    articles = load_articles()
-    if "error" in articles:
-        logging.error(f"Этап: Ошибка при загрузке статей: {articles['error']}")
-        await safe_reply(message, articles["error"])
-        return
-
-    text = message.text.replace("/analyze", "").strip()
-    if not text:
-        logging.info(f"Этап: Пустой текст для анализа, пользователь {message.from_user.id}")
-        await safe_reply(
-            message,
-            "Гражданин, отправьте сообщение для анализа не более 2000 символов длиной"
-        )
-        return
-
-    result = await analyze_text(text, prompt_template, articles, message, bot)
-    if not result:
-        logging.info(f"Этап: Анализ текста не выполнен для пользователя {message.from_user.id}")
-        return
+    return final_response, report_data, report_id
 
+async def send_analysis_result(message: Message, bot: Bot, result):
     if isinstance(result, str):
-        logging.info(f"Этап: Отправка результата анализа (строка): {result[:50]}...")
+        logging.info("Этап: Отправка результата анализа (строка): %s...", result[:50])
         await safe_reply(message, result)
         return
 
-    final_response, report_file, report_id = result
+    final_response, report_data, report_id = result
     MAX_LEN = 4000
     logging.info("Этап: Отправка финального ответа пользователю")
     for part in (final_response[i:i + MAX_LEN] for i in range(0, len(final_response), MAX_LEN)):
@@ -447,192 +2986,277 @@ async def analyze_command(message: Message, bot: Bot):
         reply_markup=get_post_analysis_keyboard()
     )
 
-    logging.info(f"Этап: Отправка документа с отчётом {report_file}")
-    await bot.send_document(
+    logging.info("Этап: Отправка документа с отчётом %s", report_id)
+    await telegram_call(
+        message.chat.id,
+        bot.send_document,
         chat_id=message.chat.id,
-        document=FSInputFile(report_file, filename=f"report_{report_id}.txt"),
+        document=BufferedInputFile(report_data, filename=f"report_{report_id}.txt"),
         caption="Здесь результаты лингвистической экспертизы.",
         reply_to_message_id=message.message_id
     )
 
-async def text_message(message: Message, bot: Bot):
-    logging.info(f"Этап: Обработка текстового сообщения от пользователя {message.from_user.id}")
-    prompt_file = os.path.join(BASE_DIR, "prompt.txt")
-    prompt_template = read_file(prompt_file)
-    if "Ошибка" in prompt_template:
-        logging.error(f"Этап: Ошибка в prompt: {prompt_template}")
-        await safe_reply(message, prompt_template)
+async def start_command(message: Message):
+    logging.info("Этап: Обработка команды /start для пользователя %s", message.from_user.id)
+    await safe_answer(
+        message,
+        "Здравствуйте! Хорошо, что вы к нам вовремя обратились. Расскажите же нам скорее все,",
+        reply_to_message_id=message.message_id
+    )
+
+async def stats_command(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        logging.info("Этап: Команда /stats от не-администратора %s проигнорирована", message.from_user.id)
         return
+    await safe_answer(message, stats_summary(), reply_to_message_id=message.message_id)
 
-    articles = load_articles()
-    if "error" in articles:
-        logging.error(f"Этап: Ошибка при загрузке статей: {articles['error']}")
-        await safe_reply(message, articles["error"])
+async def analyze_command(message: Message, bot: Bot):
+    logging.info("Этап: Обработка команды /analyze для пользователя %s", message.from_user.id)
+    config = get_config()
+    if config is None:
+        logging.error("Этап: Конфигурация не загружена: %s", config_error)
+        await safe_reply(message, config_error)
         return
 
-    text = message.text.strip()
-    result = await analyze_text(text, prompt_template, articles, message, bot)
-    if not result:
-        logging.info(f"Этап: Анализ текста не выполнен для пользователя {message.from_user.id}")
+    text = message.text.replace("/analyze", "").strip()
+    if not text:
+        logging.info("Этап: Пустой текст для анализа, пользователь %s", message.from_user.id)
+        await safe_reply(
+            message,
+            "Гражданин, отправьте сообщение для анализа"
+        )
         return
 
-    if isinstance(result, str):
-        logging.info(f"Этап: Отправка результата анализа (строка): {result[:50]}...")
-        await safe_reply(message, result)
+    result = await analyze_text(text, config.prompt_template, config.articles, message, bot)
+    if not result:
+        logging.info("Этап: Анализ текста не выполнен для пользователя %s", message.from_user.id)
         return
 
-    final_response, report_file, report_id = result
-    MAX_LEN = 4000
-    logging.info("Этап: Отправка финального ответа пользователю")
-    for part in (final_response[i:i + MAX_LEN] for i in range(0, len(final_response), MAX_LEN)):
-        await safe_reply(message, part)
+    await send_analysis_result(message, bot, result)
 
-    await safe_reply(
-        message,
-        "Ваша судьба в ваших руках, гражданин.",
-        reply_markup=get_post_analysis_keyboard()
-    )
+async def text_message(message: Message, bot: Bot):
+    logging.info("Этап: Обработка текстового сообщения от пользователя %s", message.from_user.id)
+    config = get_config()
+    if config is None:
+        logging.error("Этап: Конфигурация не загружена: %s", config_error)
+        await safe_reply(message, config_error)
+        return
 
-    logging.info(f"Этап: Отправка документа с отчётом {report_file}")
-    await bot.send_document(
-        chat_id=message.chat.id,
-        document=FSInputFile(report_file, filename=f"report_{report_id}.txt"),
-        caption="Здесь результаты лингвистической экспертизы.",
-        reply_to_message_id=message.message_id
+    text = message.text.strip()
+    result = await analyze_text(
+        text, config.prompt_template, config.articles, message, bot, explicit=message.chat.type == "private"
     )
+    if not result:
+        logging.info("Этап: Анализ текста не выполнен для пользователя %s", message.from_user.id)
+        return
+
+    await send_analysis_result(message, bot, result)
 
 def get_post_analysis_keyboard():
-    logging.info("Этап: Формирование клавиатуры после анализа")
+    logging.debug("Этап: Формирование клавиатуры после анализа")
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="💳 Штраф на месте", callback_data="pay_fine")],
         [InlineKeyboardButton(text="💾 Бланк самодоноса", callback_data="get_blank")],
         [InlineKeyboardButton(text="📞 Звонок другу", callback_data="repent")],
         [InlineKeyboardButton(text="💼 Брянск-Север", callback_data="bryansk_north")]
     ])
-    logging.info("Этап: Клавиатура сформирована")
+    logging.debug("Этап: Клавиатура сформирована")
     return keyboard
 
-def main():
-    logging.info("Этап: Запуск бота")
-    bot = Bot(token=BOT_TOKEN)
+def build_dispatcher(bot: Bot) -> Dispatcher:
     dp = Dispatcher(bot=bot)
+    dp.startup.register(start_job_workers)
+    dp.startup.register(start_job_store_poller)
+    dp.shutdown.register(stop_job_store_poller)
+    dp.shutdown.register(stop_job_workers)
+    dp.shutdown.register(save_provider_stats)
+    dp.startup.register(start_config_watcher)
+    dp.startup.register(start_metrics_server)
+    dp.shutdown.register(stop_metrics_server)
+    dp.shutdown.register(stop_config_watcher)
 
     dp.message.register(start_command, Command(commands=["start"]))
+    dp.message.register(stats_command, Command(commands=["stats"]))
 
     @dp.message(Command(commands=["analyze"]))
     async def analyze_handler(message: Message):
-        logging.info(f"Этап: Регистрация команды /analyze для пользователя {message.from_user.id}")
+        logging.debug("Этап: Регистрация команды /analyze для пользователя %s", message.from_user.id)
         await handle_with_queue(analyze_command, message, bot)
 
     @dp.message(F.text)
     async def text_handler(message: Message):
         text = message.text.strip()
-        logging.info(f"Этап: Обработка текста от пользователя {message.from_user.id}, длина: {len(text)}")
+        logging.debug("Этап: Обработка текста от пользователя %s, длина: %s", message.from_user.id, len(text))
 
         # ПОРОГ СРАБАТЫВАНИЯ, 50 СИМВОЛОВ
         if len(text) <= 50:
-            logging.info(f"Этап: Текст короче 50 символов, игнорируем")
+            logging.debug("Этап: Текст короче 50 символов, игнорируем")
             return
 
-        async def reply_analyze(message: Message, bot: Bot):
-            logging.info(f"Этап: Начало анализа текста для пользователя {message.from_user.id}")
-            prompt_file = os.path.join(BASE_DIR, "prompt.txt")
-            prompt_template = read_file(prompt_file)
-            if "Ошибка" in prompt_template:
-                logging.error(f"Этап: Ошибка в prompt: {prompt_template}")
-                await safe_reply(message, prompt_template)
-                return
-
-            articles = load_articles()
-            if "error" in articles:
-                logging.error(f"Этап: Ошибка при загрузке статей: {articles['error']}")
-                await safe_reply(message, articles["error"])
-                return
-
-            text = message.text.strip()
-            result = await analyze_text(text, prompt_template, articles, message, bot)
-            if not result:
-                logging.info(f"Этап: Анализ текста не выполнен")
-                return
-
-            if isinstance(result, str):
-                logging.info(f"Этап: Отправка результата анализа (строка): {result[:50]}...")
-                await safe_reply(message, result)
-                return
-
-            final_response, report_file, report_id = result
-            MAX_LEN = 4000
-            logging.info("Этап: Отправка финального ответа пользователю")
-            for part in (final_response[i:i + MAX_LEN] for i in range(0, len(final_response), MAX_LEN)):
-                await safe_reply(message, part)
-
-            await safe_reply(
-                message,
-                "Ваша судьба в ваших руках, гражданин.",
-                reply_markup=get_post_analysis_keyboard()
-            )
-
-            logging.info(f"Этап: Отправка документа с отчётом {report_file}")
-            await bot.send_document(
-                chat_id=message.chat.id,
-                document=FSInputFile(report_file, filename=f"report_{report_id}.txt"),
-                caption="Здесь результаты лингвистической экспертизы.",
-                reply_to_message_id=message.message_id
-            )
-        await handle_with_queue(reply_analyze, message, bot)
+        await handle_with_queue(text_message, message, bot)
 
     @dp.callback_query(lambda c: c.data == "pay_fine")
     async def handle_pay_fine(callback: CallbackQuery):
-        logging.info(f"Этап: Обработка callback pay_fine для пользователя {callback.from_user.id}")
-        file_path = os.path.join(BASE_DIR, "qrcode.png")
-        if os.path.exists(file_path):
-            logging.info(f"Этап: Отправка QR-кода пользователю {callback.from_user.id}")
-            await safe_answer(
-                callback.message,
-                "💳 Отсканируйте QR-код для моментальной оплаты.",
-                reply_to_message_id=callback.message.message_id
-            )
-            await callback.message.answer_photo(
-                photo=FSInputFile(file_path),
-                caption=None
-            )
+        logging.info("Этап: Обработка callback pay_fine для пользователя %s", callback.from_user.id)
+        # Наличие файла проверяет send_asset: лишний stat на каждое нажатие не нужен
+        if await send_asset(
+            bot,
+            callback.message,
+            "answer_photo",
+            "qrcode.png",
+            caption="💳 Отсканируйте QR-код для моментальной оплаты.",
+            reply_to_message_id=callback.message.message_id
+        ):
+            logging.info("Этап: QR-код отправлен пользователю %s", callback.from_user.id)
         else:
-            logging.error(f"Этап: QR-код не найден: {file_path}")
+            logging.error("Этап: QR-код не найден: %s", os.path.join(BASE_DIR, "qrcode.png"))
             await safe_answer(callback.message, "QR-код не найден, напишите в поддержку.",
                               reply_to_message_id=callback.message.message_id)
         await callback.answer()
 
     @dp.callback_query(lambda c: c.data == "get_blank")
     async def handle_get_blank(callback: CallbackQuery):
-        logging.info(f"Этап: Обработка callback get_blank для пользователя {callback.from_user.id}")
-        file_path = os.path.join(BASE_DIR, "blank.doc")
-        if os.path.exists(file_path):
-            logging.info(f"Этап: Отправка бланка самодоноса пользователю {callback.from_user.id}")
-            await callback.message.answer_document(
-                FSInputFile(file_path, filename="blank.doc"),
-                caption="Вот ваш бланк для самодоноса. Заполните, распечатайте и вышлите нам копию заказным письмом.",
-                reply_to_message_id=callback.message.message_id
-            )
+        logging.info("Этап: Обработка callback get_blank для пользователя %s", callback.from_user.id)
+        if await send_asset(
+            bot,
+            callback.message,
+            "answer_document",
+            "blank.doc",
+            caption="Вот ваш бланк для самодоноса. Заполните, распечатайте и вышлите нам копию заказным письмом.",
+            reply_to_message_id=callback.message.message_id
+        ):
+            logging.info("Этап: Бланк самодоноса отправлен пользователю %s", callback.from_user.id)
         else:
-            logging.error(f"Этап: Бланк не найден: {file_path}")
+            logging.error("Этап: Бланк не найден: %s", os.path.join(BASE_DIR, "blank.doc"))
             await safe_answer(callback.message, "Бланк не найден.",
                               reply_to_message_id=callback.message.message_id)
         await callback.answer()
 
     @dp.callback_query(lambda c: c.data == "repent")
     async def handle_repent(callback: CallbackQuery):
-        logging.info(f"Этап: Обработка callback repent для пользователя {callback.from_user.id}")
+        logging.info("Этап: Обработка callback repent для пользователя %s", callback.from_user.id)
         await safe_answer(callback.message, "Вы уже использовали свое право на звонок.",
                           reply_to_message_id=callback.message.message_id)
         await callback.answer()
 
     @dp.callback_query(lambda c: c.data == "bryansk_north")
     async def handle_bryansk(callback: CallbackQuery):
-        logging.info(f"Этап: Обработка callback bryansk_north для пользователя {callback.from_user.id}")
+        logging.info("Этап: Обработка callback bryansk_north для пользователя %s", callback.from_user.id)
         await safe_answer(callback.message, "Статус 17 подтверждён.",
                           reply_to_message_id=callback.message.message_id)
         await callback.answer()
 
+    return dp
+
+def webhook_route(update: dict) -> int:
+    # Ключ маршрутизации: отправитель (или чат) из первого вложенного объекта обновления
+    for event in update.values():
+        if not isinstance(event, dict):
+            continue
+        sender = event.get("from") or {}
+        chat = event.get("chat") or (event.get("message") or {}).get("chat") or {}
+        return int(sender.get("id") or chat.get("id") or 0)
+    return 0
+
+async def feed_webhook_update(dp: Dispatcher, bot: Bot, update: dict):
+    try:
+        await dp.feed_raw_update(bot, update)
+    except Exception as e:
+        logging.exception("Этап: Ошибка обработки обновления %s: %s", update.get("update_id"), e)
+
+async def run_webhook_worker(index: int, updates):
+    global METRICS_PORT
+    # У каждого процесса свой порт метрик, чтобы воркеры не конфликтовали
+    if METRICS_PORT > 0:
+        METRICS_PORT += index
+    bot = Bot(token=BOT_TOKEN)
+    dp = build_dispatcher(bot)
+    loop = asyncio.get_running_loop()
+    tasks = set()
+    await dp.emit_startup(bot=bot)
+    logging.info("Этап: Воркер вебхука %s запущен (pid %s)", index, os.getpid())
+    try:
+        while True:
+            update = await loop.run_in_executor(None, updates.get)
+            if update is None:
+                break
+            task = asyncio.create_task(feed_webhook_update(dp, bot, update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            logging.info("Этап: Воркер вебхука %s дожидается %s обновлений", index, len(tasks))
+            _, pending = await asyncio.wait(tasks, timeout=WEBHOOK_DRAIN_TIMEOUT)
+            for task in pending:
+                task.cancel()
+    finally:
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+        logging.info("Этап: Воркер вебхука %s остановлен", index)
+
+def webhook_worker_process(index: int, updates):
+    asyncio.run(run_webhook_worker(index, updates))
+
+def run_webhook():
+    from aiohttp import web
+
+    context = multiprocessing.get_context("spawn")
+    worker_count = max(1, WEBHOOK_WORKERS)
+    queues = [context.Queue() for _ in range(worker_count)]
+    processes = [
+        context.Process(target=webhook_worker_process, args=(index, queues[index]), name=f"webhook-worker-{index}")
+        for index in range(worker_count)
+    ]
+    bot = Bot(token=BOT_TOKEN)
+
+    async def webhook_handler(request):
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        # Подтверждаем сразу, обработка идёт в процессе-воркере
+        queues[webhook_route(update) % worker_count].put_nowait(update)
+        return web.Response()
+
+    async def on_startup(app):
+        for process in processes:
+            process.start()
+        if WEBHOOK_URL:
+            allowed_updates = build_dispatcher(bot).resolve_used_update_types()
+            await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None, allowed_updates=allowed_updates)
+            logging.info("Этап: Вебхук установлен на %s", WEBHOOK_URL)
+        else:
+            logging.warning("Этап: WEBHOOK_URL не задан, вебхук должен быть настроен вручную")
+
+    async def on_cleanup(app):
+        for updates in queues:
+            updates.put(None)
+        loop = asyncio.get_running_loop()
+        for process in processes:
+            await loop.run_in_executor(None, process.join, WEBHOOK_DRAIN_TIMEOUT + 10)
+            if process.is_alive():
+                logging.warning("Этап: Воркер %s не завершился, принудительная остановка", process.name)
+                process.terminate()
+        await bot.session.close()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, webhook_handler)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    logging.info("Этап: Приём вебхуков на %s:%s%s, воркеров: %s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, worker_count)
+    web.run_app(app, host=WEBHOOK_HOST, port=WEBHOOK_PORT, print=None)
+
+def main():
+    if sys.argv[1:2] == ["probe-routes"]:
+        asyncio.run(probe_routes())
+        return
+    logging.info("Этап: Запуск бота")
+    if RUN_MODE == "webhook":
+        run_webhook()
+        return
+    bot = Bot(token=BOT_TOKEN)
+    dp = build_dispatcher(bot)
     logging.info("Этап: Запуск поллинга бота")
     asyncio.run(dp.start_polling(bot))
 
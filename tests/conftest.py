@@ -0,0 +1,43 @@
+import os
+import sys
+
+import pytest
+
+# Модули бота лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import major
+
+
+class FakeMessage:
+    def __init__(self, message_id: int = 1):
+        self.message_id = message_id
+
+    def model_dump_json(self, **kwargs) -> str:
+        return "{}"
+
+
+async def fake_handler(message, bot):
+    pass
+
+
+def make_job(user_id: int, chat_id: int = None, message_id: int = 1) -> major.AnalysisJob:
+    return major.AnalysisJob(
+        handler_func=fake_handler, message=FakeMessage(message_id), bot=None,
+        user_id=user_id, chat_id=user_id if chat_id is None else chat_id
+    )
+
+
+@pytest.fixture
+def job_store(tmp_path, monkeypatch):
+    # Отдельный файл хранилища на тест, очередь в памяти пустая
+    monkeypatch.setattr(major, "JOB_STORE_ENABLED", True)
+    monkeypatch.setattr(major, "JOB_STORE_FILE", str(tmp_path / "jobs.sqlite3"))
+    monkeypatch.setattr(major, "JOB_STORE_WORKER_ID", "host:1")
+    monkeypatch.setattr(major, "job_store_db", None)
+    monkeypatch.setattr(major, "user_queue", {})
+    monkeypatch.setattr(major, "user_busy", {})
+    monkeypatch.setattr(major, "job_store_pending_finish", {})
+    db = major.get_job_store()
+    yield db
+    db.close()
@@ -0,0 +1,68 @@
+import json
+
+import batch
+
+
+def write_lines(path, lines):
+    path.write_bytes(b"".join(line + b"\n" for line in lines))
+
+
+def test_read_records_jsonl(tmp_path):
+    source = tmp_path / "messages.jsonl"
+    write_lines(source, [
+        json.dumps({"id": 7, "text": "первое"}, ensure_ascii=False).encode(),
+        b"",
+        json.dumps({"text": ["часть ", {"type": "bold", "text": "жирная"}]}, ensure_ascii=False).encode(),
+    ])
+    records = list(batch.read_records(str(source), "jsonl", "text", "id"))
+    # Без id запись получает номер своей строки в файле (пустые строки тоже считаются)
+    assert records == [("7", "первое", ""), ("3", "часть жирная", "")]
+
+
+def test_read_records_invalid_lines_do_not_stop_reading(tmp_path):
+    source = tmp_path / "messages.jsonl"
+    write_lines(source, [
+        b"{broken",
+        b"",
+        b"[1, 2]",
+        b'{"id": "x", "text": "\xff"}',
+        json.dumps({"id": "1", "text": "после ошибок"}, ensure_ascii=False).encode(),
+    ])
+    records = list(batch.read_records(str(source), "jsonl", "text", "id"))
+    assert [(record_id, text) for record_id, text, _ in records] == [
+        ("line:1", None), ("line:3", None), ("line:4", None), ("1", "после ошибок")
+    ]
+    assert all(error for _, text, error in records if text is None)
+
+
+def test_read_records_csv(tmp_path):
+    source = tmp_path / "export.csv"
+    write_lines(source, [
+        b"message_id,message",
+        "10,\"многострочное\nсообщение\"".encode(),
+        b"11,\"\xff\"",
+        "12,третье".encode(),
+    ])
+    records = list(batch.read_records(str(source), "csv", "message", "message_id"))
+    assert records[0] == ("10", "многострочное\nсообщение", "")
+    assert records[1][0] == "line:4" and records[1][1] is None
+    assert records[2] == ("12", "третье", "")
+
+
+def test_load_done(tmp_path):
+    output = tmp_path / "verdicts.jsonl"
+    output.write_text("\n".join([
+        json.dumps({"id": "1", "status": "ok"}),
+        json.dumps({"id": "2", "status": "error"}),
+        json.dumps({"id": "3", "status": "skipped"}),
+        json.dumps({"id": "line:4", "status": "invalid"}),
+        # Позже записанная ошибка не отменяет готовую запись с тем же id
+        json.dumps({"id": "1", "status": "error"}),
+        json.dumps({"id": "5", "status": "partial"}),
+        '{"id": "6", "sta',
+    ]), encoding="utf-8")
+    assert batch.load_done(str(output)) == {"1", "3", "line:4"}
+
+
+def test_load_done_missing_file(tmp_path):
+    assert batch.load_done(str(tmp_path / "missing.jsonl")) == set()
@@ -0,0 +1,119 @@
+import sqlite3
+import time
+
+import major
+from conftest import make_job
+
+
+def row(db, job):
+    return db.execute(
+        "SELECT state, worker, attempts, lease_until FROM jobs WHERE job_id = ?", (job.job_id,)
+    ).fetchone()
+
+
+def expire_lease(db, job):
+    db.execute("UPDATE jobs SET lease_until = ? WHERE job_id = ?", (time.time() - 1, job.job_id))
+    db.commit()
+
+
+def test_claim_own_queued_job(job_store):
+    job = make_job(1)
+    assert major.job_store_add(job)
+    state, worker, attempts, _ = row(job_store, job)
+    assert (state, worker, attempts) == ("queued", "host:1", 0)
+    assert major.job_store_claim(job)
+    state, worker, attempts, _ = row(job_store, job)
+    assert (state, worker, attempts) == ("running", "host:1", 1)
+    # Второй раз то же задание не выдаётся
+    assert not major.job_store_claim(job)
+
+
+def test_live_queued_job_of_another_worker_is_not_claimed(job_store, monkeypatch):
+    job = make_job(1)
+    monkeypatch.setattr(major, "JOB_STORE_WORKER_ID", "host:2")
+    major.job_store_add(job)
+    monkeypatch.setattr(major, "JOB_STORE_WORKER_ID", "host:1")
+    assert major.job_store_recoverable() == []
+    assert not major.job_store_claim(job)
+    assert row(job_store, job)[:2] == ("queued", "host:2")
+
+
+def test_expired_running_job_is_recovered_with_checkpoints(job_store, monkeypatch):
+    job = make_job(1)
+    monkeypatch.setattr(major, "JOB_STORE_WORKER_ID", "host:2")
+    major.job_store_add(job)
+    assert major.job_store_claim(job)
+    major.job_store_checkpoint(job.job_id, "148", "Article 148: готово")
+    expire_lease(job_store, job)
+    monkeypatch.setattr(major, "JOB_STORE_WORKER_ID", "host:1")
+    recovered = major.job_store_recoverable()
+    assert [r[0] for r in recovered] == [job.job_id]
+    assert major.job_store_claim(job)
+    state, worker, attempts, _ = row(job_store, job)
+    assert (state, worker, attempts) == ("running", "host:1", 2)
+    assert major.job_store_checkpoints(job.job_id) == {"148": "Article 148: готово"}
+
+
+def test_job_out_of_attempts_is_failed(job_store, monkeypatch):
+    monkeypatch.setattr(major, "JOB_MAX_ATTEMPTS", 1)
+    job = make_job(1)
+    major.job_store_add(job)
+    assert major.job_store_claim(job)
+    expire_lease(job_store, job)
+    assert major.job_store_recoverable() == []
+    assert row(job_store, job)[0] == "failed"
+
+
+def test_finished_job_is_not_recovered(job_store):
+    job = make_job(1)
+    major.job_store_add(job)
+    assert major.job_store_claim(job)
+    major.job_store_checkpoint(job.job_id, "148", "Article 148: готово")
+    major.job_store_finish(job, "done")
+    expire_lease(job_store, job)
+    assert row(job_store, job)[0] == "done"
+    assert major.job_store_recoverable() == []
+    assert major.job_store_checkpoints(job.job_id) == {}
+
+
+def test_lost_claim_closes_own_row(job_store, monkeypatch):
+    # У пользователя уже выполняется задание в другом процессе
+    running = make_job(1)
+    monkeypatch.setattr(major, "JOB_STORE_WORKER_ID", "host:2")
+    major.job_store_add(running)
+    assert major.job_store_claim(running)
+    monkeypatch.setattr(major, "JOB_STORE_WORKER_ID", "host:1")
+    job = make_job(1, message_id=2)
+    major.job_store_add(job)
+    assert not major.job_store_claim(job)
+    state, worker, _, lease_until = row(job_store, job)
+    assert (state, worker, lease_until) == ("superseded", None, 0)
+
+
+def test_job_that_was_not_stored_runs_in_memory(job_store, monkeypatch):
+    job = make_job(1)
+
+    class LockedStore:
+        def execute(self, *args):
+            raise sqlite3.OperationalError("database is locked")
+
+        def rollback(self):
+            pass
+
+    with monkeypatch.context() as patch:
+        patch.setattr(major, "get_job_store", lambda: LockedStore())
+        job.stored = major.job_store_add(job)
+    assert not job.stored
+    assert major.job_store_claim(job)
+
+
+def test_poller_renews_only_jobs_held_in_memory(job_store):
+    held, orphan = make_job(1), make_job(2)
+    major.job_store_add(held)
+    major.job_store_add(orphan)
+    major.user_queue[held.user_id] = held
+    expire_lease(job_store, held)
+    expire_lease(job_store, orphan)
+    major.job_store_recoverable()
+    assert row(job_store, held)[3] > time.time()
+    assert row(job_store, orphan)[3] < time.time()
@@ -0,0 +1,98 @@
+import pytest
+
+import major
+
+
+def test_parse_batch_verdicts_plain():
+    response = (
+        "=== Article 148 ===\nApplicability: Yes\nJustification: оскорбление\n"
+        "=== Article 280 ===\nApplicability: No\nJustification: нет призывов\n"
+    )
+    verdicts = major.parse_batch_verdicts(response, ["148", "280"])
+    assert verdicts["148"].startswith("Applicability: Yes")
+    assert verdicts["280"].startswith("Applicability: No")
+
+
+@pytest.mark.parametrize("line", [
+    "**Applicability: Yes**",
+    "**Applicability:** Yes",
+    "Applicability: **Yes**",
+    "**Applicability**: yes",
+])
+def test_parse_batch_verdicts_strips_bold(line):
+    response = f"=== Article 148 ===\n{line}\nJustification: оскорбление"
+    verdict = major.parse_batch_verdicts(response, ["148"])["148"]
+    assert verdict.splitlines()[0] == "Applicability: Yes"
+    assert "*" not in verdict
+
+
+def test_parse_batch_verdicts_skips_unknown_duplicate_and_incomplete_blocks():
+    response = (
+        "=== Article 148 ===\nApplicability: No\n"
+        "=== Article 148 ===\nApplicability: Yes\n"
+        "=== Article 999 ===\nApplicability: Yes\n"
+        "=== Article 280 ===\nJustification: без вердикта\n"
+    )
+    verdicts = major.parse_batch_verdicts(response, ["148", "280"])
+    assert list(verdicts) == ["148"]
+    assert verdicts["148"].startswith("Applicability: No")
+
+
+def test_split_text_windows_short_text_is_one_window():
+    assert major.split_text_windows("Короткий текст.", size=100, overlap=20) == ["Короткий текст."]
+
+
+def test_split_text_windows_overlaps_sentences():
+    sentences = [f"Предложение номер {i} о чём-то важном." for i in range(20)]
+    windows = major.split_text_windows(" ".join(sentences), size=200, overlap=60)
+    assert len(windows) > 1
+    assert all(len(window) <= 200 for window in windows)
+    for previous, window in zip(windows, windows[1:]):
+        # Следующее окно начинается с последнего предложения предыдущего
+        assert window.split(". ")[0] in previous
+    for sentence in sentences:
+        assert any(sentence in window for window in windows)
+
+
+def test_split_text_windows_overlaps_hard_cuts():
+    words = [f"слово{i}" for i in range(400)]
+    windows = major.split_text_windows(" ".join(words), size=500, overlap=100)
+    assert all(len(window) <= 500 for window in windows)
+    for previous, window in zip(windows, windows[1:]):
+        assert window.split()[0] in previous.split()
+    for word in words:
+        assert any(word in window.split() for window in windows)
+
+
+def test_split_text_windows_merges_short_tail():
+    # Остаток короче перекрытия не становится отдельным окном (каждое окно — полный набор запросов)
+    words = " ".join(["слово"] * 166) + " хвост"
+    assert len(words) < 1000 + 100
+    assert major.split_text_windows(words, size=1000, overlap=100) == [words]
+    sentences = "Первое предложение. " * 50 + "Хвост."
+    windows = major.split_text_windows(sentences, size=1000, overlap=100)
+    assert len(windows) == 1
+    assert windows[0].endswith("Хвост.")
+
+
+def test_compact_article_text():
+    text = (
+        "Статья 148. Нарушение права\n"
+        "Подготовлена\nредакция\nдокумента с изменениями, не вступившими в силу\n"
+        "\"Уголовный кодекс Российской Федерации\" от 13.06.1996 N 63-ФЗ\n"
+        "УК РФ Статья 148. Нарушение права\n"
+        "(в ред. Федерального\nзакона\nот 29.06.2013 N 136-ФЗ)\n"
+        "1. Публичные действия, -\n"
+        "наказываются штрафом.\n"
+        "2. Деяния, предусмотренные\nчастью первой\nнастоящей статьи , совершенные -\n"
+        "наказываются штрафом.\n"
+        "Примечание. Утратило силу.\n"
+        "Открыть полный текст документа\nссылки"
+    )
+    assert major.compact_article_text(text) == (
+        "Статья 148. Нарушение права\n"
+        "1. Публичные действия, -\n"
+        "наказываются штрафом.\n"
+        "2. Деяния, предусмотренные частью первой настоящей статьи, совершенные -\n"
+        "наказываются штрафом."
+    )